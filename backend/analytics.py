@@ -0,0 +1,274 @@
+"""Incremental analytics rollups for the dashboard.
+
+Counters are maintained on the write path instead of aggregating
+emails_collection on every dashboard load:
+
+- analytics_totals: one document per user with sent/failed/received totals
+- analytics_daily: one document per user per UTC day with sent/received,
+  by the day a message was sent or received
+- analytics_recipients: one counter per (user, recipient), indexed by count
+  so the top-K recipients is a bounded index read
+
+send_email, campaign delivery and inbox sync call the record_* helpers.
+Received mail is every stored message outside the sent folder, spam and
+filtered mail included, on both paths. A periodic reconciliation job
+recomputes the rollups of every user from the source collections with
+server-side aggregations, to correct any drift (lost increments, manual
+data fixes) and to backfill users whose mail predates the rollups. It
+rewrites every day of the last ANALYTICS_RECONCILE_DAYS, and counts a
+campaign's recipients once they are delivered (failures excluded); the
+recipients a running campaign has not checkpointed yet are left to the
+live counters until a later run.
+"""
+import asyncio
+import logging
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional
+
+from pymongo import DESCENDING, UpdateOne
+
+from database import (
+    analytics_daily_collection, analytics_recipients_collection, analytics_totals_collection,
+    campaigns_collection, emails_collection, users_collection
+)
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_RECENT_DAYS = 7
+ANALYTICS_TOP_RECIPIENTS = 5
+ANALYTICS_RECONCILE_INTERVAL = float(os.environ.get('ANALYTICS_RECONCILE_INTERVAL', '21600'))
+ANALYTICS_RECONCILE_DAYS = int(os.environ.get('ANALYTICS_RECONCILE_DAYS', '30'))
+# Users read per page by the reconciliation job
+RECONCILE_USER_BATCH = 1000
+
+
+def _day(when: datetime) -> str:
+    return when.strftime("%Y-%m-%d")
+
+
+async def record_sent(
+    user_id: str,
+    sent: int,
+    recipients: Iterable[str],
+    failed: int = 0,
+    when: Optional[datetime] = None
+):
+    """Count sent messages, their recipients and failed deliveries for a user"""
+    if not sent and not failed:
+        return
+    recipient_counts = Counter(recipients)
+
+    when = when or datetime.utcnow()
+    await analytics_totals_collection.update_one(
+        {"user_id": user_id},
+        {"$inc": {"sent": sent, "failed": failed}},
+        upsert=True
+    )
+    if sent:
+        await analytics_daily_collection.update_one(
+            {"user_id": user_id, "date": _day(when)},
+            {"$inc": {"sent": sent}},
+            upsert=True
+        )
+    if recipient_counts:
+        await analytics_recipients_collection.bulk_write([
+            UpdateOne(
+                {"user_id": user_id, "email": email},
+                {"$inc": {"count": count}, "$set": {"updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+            for email, count in recipient_counts.items()
+        ], ordered=False)
+
+
+async def record_received(user_id: str, received_at: Iterable[datetime]):
+    """Count newly stored incoming messages (any folder but sent) for a user, on the day each was received"""
+    by_day = Counter(_day(when) for when in received_at)
+    if not by_day:
+        return
+
+    await analytics_totals_collection.update_one(
+        {"user_id": user_id},
+        {"$inc": {"received": sum(by_day.values())}},
+        upsert=True
+    )
+    await analytics_daily_collection.bulk_write([
+        UpdateOne({"user_id": user_id, "date": day}, {"$inc": {"received": count}}, upsert=True)
+        for day, count in by_day.items()
+    ], ordered=False)
+
+
+async def get_dashboard(user_id: str) -> Dict:
+    """Read the dashboard from the rollups: three small indexed reads"""
+    today = datetime.utcnow()
+    days = [_day(today - timedelta(days=i)) for i in range(ANALYTICS_RECENT_DAYS)]
+
+    totals, daily, top = await asyncio.gather(
+        analytics_totals_collection.find_one({"user_id": user_id}),
+        analytics_daily_collection.find({"user_id": user_id, "date": {"$gte": days[-1]}}).to_list(),
+        analytics_recipients_collection.find(
+            {"user_id": user_id}, {"_id": 0, "email": 1, "count": 1}
+        ).sort("count", DESCENDING).limit(ANALYTICS_TOP_RECIPIENTS).to_list()
+    )
+
+    totals = totals or {}
+    sent = totals.get("sent", 0)
+    failed = totals.get("failed", 0)
+    by_day = {entry["date"]: entry for entry in daily}
+
+    return {
+        "total_emails_sent": sent,
+        "total_emails_received": totals.get("received", 0),
+        # Opens, clicks and unsubscribes are not tracked yet
+        "open_rate": None,
+        "click_rate": None,
+        "bounce_rate": round(failed / (sent + failed), 4) if sent + failed else 0.0,
+        "unsubscribe_rate": None,
+        "recent_activity": [
+            {"type": activity, "count": by_day.get(day, {}).get(field, 0), "date": day}
+            for day in days
+            for activity, field in (("email_sent", "sent"), ("email_received", "received"))
+        ],
+        "top_recipients": top
+    }
+
+
+def _by_day(date_field: str) -> Dict:
+    return {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": f"${date_field}"}}, "count": {"$sum": 1}}}
+
+
+async def reconcile_user(user_id: str):
+    """Recompute one user's rollups from emails and campaigns, overwriting the counters"""
+    started = datetime.utcnow()
+    # Whole UTC days, so a recounted day is never overwritten with a partial count
+    since = datetime.strptime(_day(started - timedelta(days=ANALYTICS_RECONCILE_DAYS)), "%Y-%m-%d")
+    window = [_day(since + timedelta(days=i)) for i in range((started - since).days + 1)]
+
+    (sent, received, sent_by_day, received_by_day, recipient_counts, campaigns, campaign_recipient_counts,
+     campaign_failure_counts) = await asyncio.gather(
+        emails_collection.count_documents({"user_id": user_id, "folder": "sent"}),
+        emails_collection.count_documents({"user_id": user_id, "folder": {"$ne": "sent"}}),
+        emails_collection.aggregate([
+            {"$match": {"user_id": user_id, "folder": "sent", "sent_at": {"$gte": since}}},
+            _by_day("sent_at")
+        ]).to_list(),
+        emails_collection.aggregate([
+            {"$match": {"user_id": user_id, "folder": {"$ne": "sent"}, "received_at": {"$gte": since}}},
+            _by_day("received_at")
+        ]).to_list(),
+        emails_collection.aggregate([
+            {"$match": {"user_id": user_id, "folder": "sent"}},
+            {"$unwind": "$to"},
+            {"$group": {"_id": "$to", "count": {"$sum": 1}}}
+        ]).to_list(),
+        campaigns_collection.find(
+            {"user_id": user_id, "sent_count": {"$gt": 0}},
+            {"_id": 0, "sent_count": 1, "failed_count": 1, "completed_at": 1, "started_at": 1}
+        ).to_list(),
+        # Recipients of completed campaigns and those before a running campaign's checkpoint are
+        # settled; the rest of a running campaign is still being delivered
+        campaigns_collection.aggregate([
+            {"$match": {"user_id": user_id, "status": {"$in": ["sending", "completed"]}}},
+            {"$project": {"_id": 0, "status": 1, "recipients": 1, "checkpoint": {"$ifNull": ["$delivered_through", 0]}}},
+            {"$unwind": {"path": "$recipients", "includeArrayIndex": "position"}},
+            {"$group": {
+                "_id": {
+                    "email": "$recipients",
+                    "settled": {"$or": [{"$eq": ["$status", "completed"]}, {"$lt": ["$position", "$checkpoint"]}]}
+                },
+                "count": {"$sum": 1}
+            }}
+        ]).to_list(),
+        campaigns_collection.aggregate([
+            {"$match": {"user_id": user_id, "status": {"$in": ["sending", "completed"]}}},
+            {"$unwind": "$failed_recipients"},
+            {"$group": {"_id": "$failed_recipients", "count": {"$sum": 1}}}
+        ]).to_list()
+    )
+
+    daily_sent: Counter = Counter({entry["_id"]: entry["count"] for entry in sent_by_day})
+    daily_received: Counter = Counter({entry["_id"]: entry["count"] for entry in received_by_day})
+    for campaign in campaigns:
+        when = campaign.get("completed_at") or campaign.get("started_at")
+        if when and when >= since:
+            daily_sent[_day(when)] += campaign["sent_count"]
+
+    recipients: Counter = Counter({entry["_id"]: entry["count"] for entry in recipient_counts})
+    in_flight = set()
+    for entry in campaign_recipient_counts:
+        if entry["_id"]["settled"]:
+            recipients[entry["_id"]["email"]] += entry["count"]
+        else:
+            in_flight.add(entry["_id"]["email"])
+    recipients.subtract({entry["_id"]: entry["count"] for entry in campaign_failure_counts})
+    # Counters of recipients a running campaign may still be sending to are left to the live path
+    recipients = {email: count for email, count in recipients.items() if count > 0 and email not in in_flight}
+
+    await analytics_totals_collection.update_one(
+        {"user_id": user_id},
+        {"$set": {
+            "sent": sent + sum(c["sent_count"] for c in campaigns),
+            "failed": sum(c.get("failed_count", 0) for c in campaigns),
+            "received": received,
+            "reconciled_at": datetime.utcnow()
+        }},
+        upsert=True
+    )
+    # Every day in the window is rewritten, so days with nothing to count are zeroed rather than left as they were
+    await analytics_daily_collection.bulk_write([
+        UpdateOne(
+            {"user_id": user_id, "date": day},
+            {"$set": {"sent": daily_sent.get(day, 0), "received": daily_received.get(day, 0)}},
+            upsert=bool(daily_sent.get(day) or daily_received.get(day))
+        )
+        for day in window
+    ], ordered=False)
+    # Upserted in place so live $inc upserts on the same unique index never race a delete and reinsert
+    if recipients:
+        await analytics_recipients_collection.bulk_write([
+            UpdateOne(
+                {"user_id": user_id, "email": email},
+                {"$set": {"count": count, "updated_at": started}},
+                upsert=True
+            )
+            for email, count in recipients.items()
+        ], ordered=False)
+    # Recipients neither recounted here nor incremented since this run started no longer exist
+    stale = {"user_id": user_id, "updated_at": {"$not": {"$gte": started}}}
+    if in_flight:
+        stale["email"] = {"$nin": sorted(in_flight)}
+    await analytics_recipients_collection.delete_many(stale)
+
+
+async def reconcile_all() -> int:
+    """Reconcile every user, including ones with no rollups yet; returns the number of users processed"""
+    processed = 0
+    last_id = ""
+    while True:
+        users = await users_collection.find(
+            {"id": {"$gt": last_id}}, {"_id": 0, "id": 1}
+        ).sort("id", 1).limit(RECONCILE_USER_BATCH).to_list()
+        for user in users:
+            try:
+                await reconcile_user(user["id"])
+            except Exception:
+                logger.exception("Analytics reconciliation failed for user %s", user["id"])
+        processed += len(users)
+        if len(users) < RECONCILE_USER_BATCH:
+            return processed
+        last_id = users[-1]["id"]
+
+
+async def run_reconciliation(interval: float = ANALYTICS_RECONCILE_INTERVAL):
+    """Background loop started from the app lifespan"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            count = await reconcile_all()
+            logger.info("Reconciled analytics for %d users", count)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Analytics reconciliation loop error")
@@ -0,0 +1,347 @@
+"""Attachment storage with streaming uploads and content-addressed dedup.
+
+Uploads are copied to the blob store in ATTACHMENT_CHUNK_SIZE pieces while
+a SHA-256 is computed, so memory stays flat whatever the file size. Blobs
+are keyed by that digest in attachment_blobs: when the same file is
+uploaded again (e.g. for every recipient of a campaign) the new copy is
+discarded and the existing blob is reused. Each upload still gets its own
+per-user attachments record carrying the filename.
+
+The store is GridFS by default, or a directory when ATTACHMENT_STORE=local.
+Image thumbnails are rendered with Pillow in a process pool after the
+upload completes, and downloads are streamed with HTTP Range support.
+"""
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import re
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import gridfs
+import magic
+from bson import ObjectId
+from fastapi import UploadFile
+from PIL import Image
+from pymongo.errors import DuplicateKeyError
+
+from database import attachment_blobs_collection, attachments_collection, get_db, run_in_db_thread
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_STORE = os.environ.get('ATTACHMENT_STORE', 'gridfs')
+ATTACHMENT_DIR = os.environ.get('ATTACHMENT_DIR', '/tmp/startupmail-attachments')
+ATTACHMENT_MAX_BYTES = int(os.environ.get('ATTACHMENT_MAX_BYTES', str(25 * 1024 * 1024)))
+# Matches the GridFS default chunk size so each read fills one chunk
+ATTACHMENT_CHUNK_SIZE = 255 * 1024
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', '2'))
+THUMBNAIL_SIZE = (256, 256)
+# Larger images are not buffered for thumbnailing
+THUMBNAIL_MAX_SOURCE_BYTES = 10 * 1024 * 1024
+
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class GridFSBlobStore:
+    """Blobs as GridFS files; every call blocks and runs on the database pool"""
+
+    def __init__(self, database=None):
+        self._database = database
+        self._bound = (None, None)
+
+    @property
+    def bucket(self) -> gridfs.GridFSBucket:
+        # Rebuilt when this process's client changes, e.g. in a forked worker
+        database = get_db() if self._database is None else self._database
+        bound_client, bucket = self._bound
+        if bound_client is not database.client:
+            bucket = gridfs.GridFSBucket(database, bucket_name="attachments")
+            self._bound = (database.client, bucket)
+        return bucket
+
+    async def run(self, fn, *args):
+        return await run_in_db_thread(fn, *args)
+
+    def open_writer(self):
+        return self.bucket.open_upload_stream(str(uuid.uuid4()), chunk_size_bytes=ATTACHMENT_CHUNK_SIZE)
+
+    def write(self, writer, chunk: bytes):
+        writer.write(chunk)
+
+    def commit(self, writer, sha256: str) -> str:
+        writer.close()
+        return str(writer._id)
+
+    def abort(self, writer):
+        writer.abort()
+
+    def read_range(self, location: str, start: int, end: int) -> Iterator[bytes]:
+        """Blocking iterator over bytes [start, end] of a blob"""
+        grid_out = self.bucket.open_download_stream(ObjectId(location))
+        try:
+            grid_out.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = grid_out.read(min(ATTACHMENT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            grid_out.close()
+
+
+class LocalBlobStore:
+    """Blobs as files named by their digest under ATTACHMENT_DIR"""
+
+    def __init__(self, root: str = ATTACHMENT_DIR):
+        self.root = root
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    async def run(self, fn, *args):
+        return await asyncio.to_thread(fn, *args)
+
+    def _path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def open_writer(self):
+        return open(os.path.join(self.root, "tmp", str(uuid.uuid4())), "wb")
+
+    def write(self, writer, chunk: bytes):
+        writer.write(chunk)
+
+    def commit(self, writer, sha256: str) -> str:
+        writer.close()
+        path = self._path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(writer.name, path)
+        return sha256
+
+    def abort(self, writer):
+        writer.close()
+        os.unlink(writer.name)
+
+    def read_range(self, location: str, start: int, end: int) -> Iterator[bytes]:
+        with open(self._path(location), "rb") as blob:
+            blob.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = blob.read(min(ATTACHMENT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+blob_store = LocalBlobStore() if ATTACHMENT_STORE == "local" else GridFSBlobStore()
+
+_thumbnail_pool: Optional[ProcessPoolExecutor] = None
+_thumbnail_tasks = set()
+
+
+def render_thumbnail(data: bytes) -> bytes:
+    """Runs in a worker process: downscale an image to a PNG thumbnail"""
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail(THUMBNAIL_SIZE)
+        output = io.BytesIO()
+        image.save(output, format="PNG")
+        return output.getvalue()
+
+
+def shutdown_thumbnail_pool():
+    global _thumbnail_pool
+    if _thumbnail_pool is not None:
+        _thumbnail_pool.shutdown(wait=False, cancel_futures=True)
+        _thumbnail_pool = None
+
+
+async def _store_stream(chunks) -> Tuple[str, int, Optional[str], Optional[str], Optional[bytes]]:
+    """Copy an async chunk iterator into the store.
+
+    Returns (sha256, size, sniffed content type, location, image bytes); location is
+    None when a blob with the same digest already exists and the copy was discarded.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    content_type = None
+    image = bytearray()
+    writer = await blob_store.run(blob_store.open_writer)
+    try:
+        async for chunk in chunks:
+            if content_type is None:
+                content_type = magic.from_buffer(chunk, mime=True)
+            size += len(chunk)
+            if size > ATTACHMENT_MAX_BYTES:
+                raise AttachmentTooLarge(f"Attachments are limited to {ATTACHMENT_MAX_BYTES} bytes")
+            digest.update(chunk)
+            if image is not None and content_type.startswith("image/"):
+                image += chunk
+                if len(image) > THUMBNAIL_MAX_SOURCE_BYTES:
+                    image = None
+            await blob_store.run(blob_store.write, writer, chunk)
+        sha256 = digest.hexdigest()
+
+        if await attachment_blobs_collection.find_one({"sha256": sha256}, {"_id": 1}):
+            await blob_store.run(blob_store.abort, writer)
+            return sha256, size, content_type, None, None
+        location = await blob_store.run(blob_store.commit, writer, sha256)
+        return sha256, size, content_type, location, bytes(image) if image else None
+    except BaseException:
+        await blob_store.run(blob_store.abort, writer)
+        raise
+
+
+async def _read_upload(upload: UploadFile):
+    while True:
+        chunk = await upload.read(ATTACHMENT_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def save_upload(user_id: str, upload: UploadFile) -> Dict[str, Any]:
+    """Store an uploaded file, deduplicating its content, and return the attachment record"""
+    sha256, size, content_type, location, image = await _store_stream(_read_upload(upload))
+    content_type = content_type or upload.content_type or "application/octet-stream"
+
+    if location is not None:
+        try:
+            await attachment_blobs_collection.insert_one({
+                "sha256": sha256,
+                "store": ATTACHMENT_STORE,
+                "location": location,
+                "size": size,
+                "content_type": content_type,
+                "created_at": datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            # A concurrent upload of the same content won the race; drop our copy
+            await _discard(location)
+        else:
+            if image:
+                _schedule_thumbnail(sha256, image)
+
+    attachment = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "sha256": sha256,
+        "filename": upload.filename or "attachment",
+        "content_type": content_type,
+        "size": size,
+        "created_at": datetime.utcnow()
+    }
+    await attachments_collection.insert_one(attachment)
+    attachment.pop("_id", None)
+    return attachment
+
+
+async def _discard(location: str):
+    # Local blobs are named by digest, so the losing upload already wrote the winner's file
+    if isinstance(blob_store, GridFSBlobStore):
+        await run_in_db_thread(blob_store.bucket.delete, ObjectId(location))
+
+
+def _schedule_thumbnail(sha256: str, image: bytes):
+    task = asyncio.create_task(_make_thumbnail(sha256, image))
+    _thumbnail_tasks.add(task)
+    task.add_done_callback(_thumbnail_tasks.discard)
+
+
+async def _make_thumbnail(sha256: str, image: bytes):
+    global _thumbnail_pool
+    if _thumbnail_pool is None:
+        _thumbnail_pool = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+    try:
+        thumbnail = await asyncio.get_running_loop().run_in_executor(_thumbnail_pool, render_thumbnail, image)
+
+        async def chunks():
+            yield thumbnail
+
+        thumb_sha, thumb_size, _, thumb_location, _ = await _store_stream(chunks())
+        if thumb_location is not None:
+            try:
+                await attachment_blobs_collection.insert_one({
+                    "sha256": thumb_sha,
+                    "store": ATTACHMENT_STORE,
+                    "location": thumb_location,
+                    "size": thumb_size,
+                    "content_type": "image/png",
+                    "created_at": datetime.utcnow()
+                })
+            except DuplicateKeyError:
+                await _discard(thumb_location)
+        await attachment_blobs_collection.update_one({"sha256": sha256}, {"$set": {"thumbnail_sha256": thumb_sha}})
+    except Exception:
+        logger.exception("Thumbnail generation failed for blob %s", sha256)
+
+
+async def get_attachment(user_id: str, attachment_id: str) -> Optional[Dict[str, Any]]:
+    return await attachments_collection.find_one({"id": attachment_id, "user_id": user_id}, {"_id": 0})
+
+
+async def resolve_attachments(user_id: str, attachment_ids: List[str]) -> List[Dict[str, Any]]:
+    """Attachment metadata for outgoing mail; raises ValueError for ids the user does not own"""
+    if not attachment_ids:
+        return []
+    found = await attachments_collection.find(
+        {"id": {"$in": list(attachment_ids)}, "user_id": user_id},
+        {"_id": 0, "id": 1, "sha256": 1, "filename": 1, "content_type": 1, "size": 1}
+    ).to_list()
+    by_id = {attachment["id"]: attachment for attachment in found}
+    missing = [attachment_id for attachment_id in attachment_ids if attachment_id not in by_id]
+    if missing:
+        raise ValueError(f"Attachments not found: {', '.join(missing)}")
+    return [by_id[attachment_id] for attachment_id in attachment_ids]
+
+
+async def get_blob(sha256: str) -> Optional[Dict[str, Any]]:
+    return await attachment_blobs_collection.find_one({"sha256": sha256}, {"_id": 0})
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive (start, end) for a single `bytes=` range, None for the whole blob"""
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        # Multiple or malformed ranges: serve the full content, as RFC 9110 allows
+        return None
+    if not match.group(1):
+        # Suffix range: the last N bytes
+        length = int(match.group(2))
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+async def stream_blob(blob: Dict[str, Any], start: int, end: int):
+    """Async iterator over bytes [start, end] of a blob, one chunk per database/disk read"""
+    if end < start:
+        return
+    iterator = blob_store.read_range(blob["location"], start, end)
+    sentinel = object()
+    try:
+        while True:
+            chunk = await blob_store.run(next, iterator, sentinel)
+            if chunk is sentinel:
+                break
+            yield chunk
+    finally:
+        await blob_store.run(iterator.close)
@@ -0,0 +1,136 @@
+"""In-process caches used by the StartupMail API"""
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, Hashable, Optional, Set
+
+
+class TTLCache:
+    """LRU cache whose entries also expire after a per-entry deadline"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, deadline = entry
+        if time.monotonic() >= deadline:
+            self._discard(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Store a value; `ttl` can only shorten the cache-wide TTL"""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            self.invalidate(key)
+            return
+
+        if key in self._entries:
+            self._discard(key)
+        self._entries[key] = (value, time.monotonic() + ttl)
+
+        while len(self._entries) > self.maxsize:
+            oldest = next(iter(self._entries))
+            self._discard(oldest)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        if key in self._entries:
+            self._discard(key)
+
+    def clear(self):
+        for key in list(self._entries):
+            self._discard(key)
+
+    def _discard(self, key: Hashable):
+        del self._entries[key]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+class WeightedTTLCache(TTLCache):
+    """TTLCache that also keeps the total weight of its values (e.g. their size in bytes) under maxweight"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0, maxweight: int = 64 * 1024 * 1024,
+                 weigh: Callable[[Any], int] = len):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.weight = 0
+        self._weights: Dict[Hashable, int] = {}
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        weight = self.weigh(value)
+        if weight > self.maxweight:
+            # Would evict everything else and still not fit
+            self.invalidate(key)
+            return
+        super().set(key, value, ttl)
+        if key not in self._entries:
+            return
+        self._weights[key] = weight
+        self.weight += weight
+        while self.weight > self.maxweight:
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _discard(self, key: Hashable):
+        super()._discard(key)
+        self.weight -= self._weights.pop(key, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "weight": self.weight, "maxweight": self.maxweight}
+
+
+class SessionCache(TTLCache):
+    """Maps session tokens to resolved user documents, indexed by user id for invalidation"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+
+    def set_session(self, session_token: str, user: Dict, expires_at: datetime):
+        """Cache a user for a session, never beyond the session's own expiry"""
+        remaining = (expires_at - datetime.utcnow()).total_seconds()
+        self.set(session_token, user, ttl=remaining)
+        if session_token in self._entries:
+            self._tokens_by_user.setdefault(user["id"], set()).add(session_token)
+
+    def invalidate_user(self, user_id: str):
+        """Drop every cached session belonging to a user"""
+        for session_token in list(self._tokens_by_user.get(user_id, ())):
+            self.invalidate(session_token)
+
+    def _discard(self, key: Hashable):
+        user, _ = self._entries.pop(key)
+        tokens = self._tokens_by_user.get(user["id"])
+        if tokens is not None:
+            tokens.discard(key)
+            if not tokens:
+                del self._tokens_by_user[user["id"]]
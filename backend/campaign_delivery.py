@@ -0,0 +1,305 @@
+"""Background delivery of bulk email campaigns.
+
+A scheduler loop claims due campaigns with an atomic find_one_and_update,
+so several API workers can run it side by side. Each claim holds a lease
+that is renewed whenever progress is flushed; a campaign whose lease
+expires (worker crashed) is picked up again from its last checkpoint,
+which makes delivery at-least-once for the recipients in flight.
+"""
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+
+from pymongo import ReturnDocument
+
+from analytics import record_sent
+from database import campaigns_collection, email_accounts_collection
+from templates import compile_template, load_template
+
+logger = logging.getLogger(__name__)
+
+CAMPAIGN_CONCURRENCY = int(os.environ.get('CAMPAIGN_CONCURRENCY', '50'))
+CAMPAIGN_RATE_PER_ACCOUNT = float(os.environ.get('CAMPAIGN_RATE_PER_ACCOUNT', '20'))
+CAMPAIGN_MAX_ATTEMPTS = int(os.environ.get('CAMPAIGN_MAX_ATTEMPTS', '3'))
+CAMPAIGN_SEND_TIMEOUT = float(os.environ.get('CAMPAIGN_SEND_TIMEOUT', '30'))
+CAMPAIGN_POLL_INTERVAL = float(os.environ.get('CAMPAIGN_POLL_INTERVAL', '5'))
+CAMPAIGN_LEASE_SECONDS = float(os.environ.get('CAMPAIGN_LEASE_SECONDS', '60'))
+CAMPAIGN_PROGRESS_BATCH = int(os.environ.get('CAMPAIGN_PROGRESS_BATCH', '500'))
+CAMPAIGN_PROGRESS_INTERVAL = float(os.environ.get('CAMPAIGN_PROGRESS_INTERVAL', '2'))
+RETRY_BASE_DELAY = 0.5
+
+
+class TokenBucket:
+    """Async token bucket allowing `rate` acquisitions per second with bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class LeaseLost(Exception):
+    """Another worker has taken over the campaign"""
+
+
+class _Progress:
+    """Tracks completed recipients and the contiguous prefix that is safe to checkpoint"""
+
+    def __init__(self, start: int):
+        self.low_water = start
+        self._done = set()
+        self.sent = 0
+        self.failed = 0
+        self.pending = 0
+        self.sent_recipients = []
+        self.failed_recipients = []
+
+    def record(self, index: int, recipient: str, ok: bool):
+        if ok:
+            self.sent += 1
+            self.sent_recipients.append(recipient)
+        else:
+            self.failed += 1
+            self.failed_recipients.append(recipient)
+        self.pending += 1
+        self._done.add(index)
+        while self.low_water in self._done:
+            self._done.discard(self.low_water)
+            self.low_water += 1
+
+
+class CampaignDeliveryEngine:
+    """Claims due campaigns and sends them through a rate-limited worker pool"""
+
+    def __init__(
+        self,
+        provider_for: Callable[[str], Any],
+        concurrency: int = CAMPAIGN_CONCURRENCY,
+        rate_per_account: float = CAMPAIGN_RATE_PER_ACCOUNT,
+        max_attempts: int = CAMPAIGN_MAX_ATTEMPTS,
+        poll_interval: float = CAMPAIGN_POLL_INTERVAL
+    ):
+        self.provider_for = provider_for
+        self.concurrency = concurrency
+        self.rate_per_account = rate_per_account
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # Per-account rate limits shared by the deliveries in progress for that account
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._bucket_users: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                campaign = await self.claim_due_campaign()
+                if campaign is None:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                await self.deliver(campaign)
+            except asyncio.CancelledError:
+                raise
+            except LeaseLost:
+                logger.warning("Lost campaign lease, another worker took over")
+            except Exception:
+                logger.exception("Campaign delivery loop error")
+                await asyncio.sleep(self.poll_interval)
+
+    async def claim_due_campaign(self) -> Optional[Dict]:
+        """Atomically take ownership of the next due (or abandoned) campaign"""
+        now = datetime.utcnow()
+        claim = {"$set": {
+            "status": "sending",
+            "worker_id": self.worker_id,
+            "lease_expires_at": now + timedelta(seconds=CAMPAIGN_LEASE_SECONDS),
+            "started_at": now
+        }}
+        # Two single-range claims instead of one $or, so each is served by its own index
+        for query in (
+            {"status": "scheduled", "schedule_at": {"$lte": now}},
+            {"status": "sending", "lease_expires_at": {"$lt": now}}
+        ):
+            campaign = await campaigns_collection.find_one_and_update(
+                query,
+                claim,
+                sort=[("schedule_at", 1)],
+                return_document=ReturnDocument.AFTER
+            )
+            if campaign:
+                return campaign
+        return None
+
+    def _bucket(self, account_id: str) -> TokenBucket:
+        bucket = self._buckets.get(account_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate_per_account)
+            self._buckets[account_id] = bucket
+        self._bucket_users[account_id] = self._bucket_users.get(account_id, 0) + 1
+        return bucket
+
+    def _release_bucket(self, account_id: str):
+        """Drop the account's bucket once no delivery is using it"""
+        users = self._bucket_users.pop(account_id) - 1
+        if users:
+            self._bucket_users[account_id] = users
+        else:
+            del self._buckets[account_id]
+
+    async def _send_with_retry(self, provider, account: Dict, bucket: TokenBucket, payload: Dict) -> bool:
+        for attempt in range(self.max_attempts):
+            await bucket.acquire()
+            try:
+                await asyncio.wait_for(
+                    provider.send_email(account["access_token"], payload),
+                    timeout=CAMPAIGN_SEND_TIMEOUT
+                )
+                return True
+            except Exception as e:
+                if attempt == self.max_attempts - 1:
+                    logger.info("Giving up on %s after %d attempts: %s", payload["to"][0], attempt + 1, e)
+                    return False
+                # Exponential backoff with jitter
+                await asyncio.sleep(RETRY_BASE_DELAY * 2 ** attempt * (1 + random.random()))
+        return False
+
+    async def _flush(self, campaign: Dict, progress: _Progress):
+        campaign_id = campaign["id"]
+        sent, failed, sent_recipients = progress.sent, progress.failed, progress.sent_recipients
+        failed_recipients = progress.failed_recipients
+        progress.sent = progress.failed = progress.pending = 0
+        progress.sent_recipients = []
+        progress.failed_recipients = []
+        try:
+            result = await campaigns_collection.update_one(
+                {"id": campaign_id, "worker_id": self.worker_id},
+                {
+                    "$inc": {"sent_count": sent, "failed_count": failed},
+                    # Analytics reconciliation counts a campaign's recipients without these
+                    "$push": {"failed_recipients": {"$each": failed_recipients}},
+                    "$set": {
+                        "delivered_through": progress.low_water,
+                        "lease_expires_at": datetime.utcnow() + timedelta(seconds=CAMPAIGN_LEASE_SECONDS)
+                    }
+                }
+            )
+        except BaseException:
+            # Not written: hand the counts back (workers may have recorded more meanwhile) for the next flush
+            progress.sent += sent
+            progress.failed += failed
+            progress.pending += sent + failed
+            progress.sent_recipients.extend(sent_recipients)
+            progress.failed_recipients.extend(failed_recipients)
+            raise
+        if result.matched_count == 0:
+            raise LeaseLost(campaign_id)
+        await record_sent(campaign["user_id"], sent, sent_recipients, failed=failed)
+
+    async def _finish(self, campaign_id: str, status: str, error: Optional[str] = None):
+        update = {"status": status, "completed_at": datetime.utcnow()}
+        if error:
+            update["error"] = error
+        await campaigns_collection.update_one(
+            {"id": campaign_id, "worker_id": self.worker_id},
+            {"$set": update, "$unset": {"lease_expires_at": ""}}
+        )
+
+    async def deliver(self, campaign: Dict):
+        """Send a claimed campaign to every recipient after its checkpoint"""
+        template = await load_template(campaign["template_id"], campaign["user_id"])
+        account = await email_accounts_collection.find_one({"user_id": campaign["user_id"], "is_primary": True})
+        if not template or not account:
+            await self._finish(campaign["id"], "failed", "Template not found" if not template else "No primary email account")
+            return
+
+        compiled = compile_template(template)
+        shared_variables = campaign.get("variables") or {}
+        recipient_variables = campaign.get("recipient_variables") or {}
+        provider = self.provider_for(account["provider"])
+        start = campaign.get("delivered_through", 0)
+        recipients = enumerate(campaign["recipients"][start:], start)
+        progress = _Progress(start)
+        flushed_at = time.monotonic()
+        flush_lock = asyncio.Lock()
+        lease_lost = False
+
+        async def maybe_flush(force: bool = False):
+            nonlocal flushed_at, lease_lost
+            async with flush_lock:
+                if lease_lost:
+                    return
+                due = progress.pending >= CAMPAIGN_PROGRESS_BATCH or time.monotonic() - flushed_at >= CAMPAIGN_PROGRESS_INTERVAL
+                if progress.pending and (force or due):
+                    flushed_at = time.monotonic()
+                    try:
+                        await self._flush(campaign, progress)
+                    except LeaseLost:
+                        lease_lost = True
+                        raise
+
+        async def worker():
+            # Workers share one enumerate iterator, so each recipient is taken exactly once
+            for index, recipient in recipients:
+                if lease_lost:
+                    return
+                subject, body = compiled.render(
+                    {"email": recipient, **(recipient_variables.get(recipient) or {})},
+                    shared_variables
+                )
+                ok = await self._send_with_retry(provider, account, bucket, {
+                    "to": [recipient],
+                    "cc": [],
+                    "bcc": [],
+                    "subject": subject,
+                    "body": body,
+                    "is_html": compiled.is_html,
+                    # Metadata only; every recipient shares the same stored blobs
+                    "attachments": campaign.get("attachments", [])
+                })
+                progress.record(index, recipient, ok)
+                await maybe_flush()
+
+        bucket = self._bucket(account["id"])
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            # The first worker to fail fails the delivery; the lease then hands the campaign on from its checkpoint
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self._release_bucket(account["id"])
+        await maybe_flush(force=True)
+        await self._finish(campaign["id"], "completed")
@@ -0,0 +1,228 @@
+"""Coordination between API workers.
+
+With several workers (gunicorn running uvicorn workers, or several hosts)
+every in-process cache and subscriber list exists once per worker. Two
+pieces keep them consistent:
+
+- a broadcast bus. Modules subscribe a handler to a channel and publish
+  small JSON-able messages to it; handlers run in every worker, the
+  publisher's included. CLUSTER_BUS=local (the default) only reaches the
+  current process and is right for a single worker. CLUSTER_BUS=mongo
+  also inserts each message into cluster_events, which every worker tails
+  with a change stream (MongoDB must run as a replica set). A worker that
+  loses its stream reconnects from the current position, so anything it
+  missed is only corrected by the affected cache's TTL.
+- leases: named locks in Mongo held by at most one worker at a time, for
+  background loops that must not run once per worker.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from database import cluster_events_collection, leases_collection, run_in_db_thread
+from metrics import CLUSTER_EVENTS
+
+logger = logging.getLogger(__name__)
+
+CLUSTER_BUS = os.environ.get('CLUSTER_BUS', 'local')
+# How long a change stream read waits server-side before returning empty
+CLUSTER_BUS_AWAIT_MS = int(os.environ.get('CLUSTER_BUS_AWAIT_MS', '1000'))
+CLUSTER_LEASE_SECONDS = float(os.environ.get('CLUSTER_LEASE_SECONDS', '30'))
+CLUSTER_RECONNECT_MAX = 30
+# Longest wait before a failed leased job is restarted
+CLUSTER_JOB_RESTART_MAX = 300
+
+Handler = Callable[[Dict[str, Any]], None]
+
+_identity = (None, None)
+
+
+def worker_id() -> str:
+    """Identifies this process to other workers; recomputed after a fork"""
+    global _identity
+    pid, identity = _identity
+    if pid != os.getpid():
+        identity = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        _identity = (os.getpid(), identity)
+    return identity
+
+
+class LocalBus:
+    """Delivers messages to this process's subscribers only"""
+
+    def __init__(self):
+        self._handlers: Dict[str, List[Handler]] = {}
+
+    def subscribe(self, channel: str, handler: Handler):
+        self._handlers.setdefault(channel, []).append(handler)
+
+    async def publish(self, channel: str, message: Dict[str, Any]):
+        self._deliver(channel, message, "local")
+
+    def _deliver(self, channel: str, message: Dict[str, Any], origin: str):
+        CLUSTER_EVENTS.inc(channel, origin)
+        for handler in self._handlers.get(channel, ()):
+            try:
+                handler(message)
+            except Exception:
+                logger.exception("Cluster bus handler failed on channel %s", channel)
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class ChangeStreamBus(LocalBus):
+    """Relays messages between workers through a Mongo change stream on cluster_events"""
+
+    def __init__(self, collection=cluster_events_collection, await_ms: int = CLUSTER_BUS_AWAIT_MS):
+        super().__init__()
+        self.collection = collection
+        self.await_ms = await_ms
+        self._listener: Optional[asyncio.Task] = None
+
+    async def publish(self, channel: str, message: Dict[str, Any]):
+        # This worker's subscribers see the message at once, the others through their streams
+        self._deliver(channel, message, "local")
+        await self.collection.insert_one({
+            "channel": channel,
+            "message": message,
+            "origin": worker_id(),
+            "created_at": datetime.utcnow()
+        })
+
+    def start(self):
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+
+    def _open(self):
+        return self.collection.delegate.watch(
+            [{"$match": {"operationType": "insert", "fullDocument.origin": {"$ne": worker_id()}}}],
+            max_await_time_ms=self.await_ms
+        )
+
+    async def _listen(self):
+        delay = 1.0
+        while True:
+            stream = None
+            try:
+                stream = await run_in_db_thread(self._open)
+                delay = 1.0
+                while True:
+                    # Each read parks a database thread for up to await_ms
+                    change = await run_in_db_thread(stream.try_next)
+                    if change is not None:
+                        event = change["fullDocument"]
+                        self._deliver(event["channel"], event["message"], "remote")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Cluster event stream failed, reconnecting: %s", e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, CLUSTER_RECONNECT_MAX)
+            finally:
+                if stream is not None:
+                    await run_in_db_thread(stream.close)
+
+
+def create_bus(kind: str = CLUSTER_BUS) -> LocalBus:
+    if kind == "mongo":
+        return ChangeStreamBus()
+    if kind != "local":
+        raise ValueError(f"Unknown CLUSTER_BUS {kind!r}")
+    return LocalBus()
+
+
+class Lease:
+    """A named lock in Mongo that at most one worker holds until it stops renewing it"""
+
+    def __init__(self, name: str, ttl: float = CLUSTER_LEASE_SECONDS, collection=leases_collection):
+        self.name = name
+        self.ttl = ttl
+        self.collection = collection
+
+    async def acquire(self) -> bool:
+        """Take or renew the lease; False while another worker holds it"""
+        now = datetime.utcnow()
+        try:
+            # The unique index on name turns the upsert into a failed insert when someone else holds it
+            await self.collection.update_one(
+                {"name": self.name, "$or": [{"holder": worker_id()}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"holder": worker_id(), "expires_at": now + timedelta(seconds=self.ttl)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def release(self):
+        await self.collection.delete_one({"name": self.name, "holder": worker_id()})
+
+    async def run(self, job: Callable[[], Awaitable]):
+        """Run `job` in this worker while it holds the lease, cancelling it if the lease is lost.
+
+        A job that fails is logged and restarted after an exponential backoff.
+        """
+        task: Optional[asyncio.Task] = None
+        renewed_at = None
+        started_at = 0.0
+        failures = 0
+        restart_at = 0.0
+        try:
+            while True:
+                try:
+                    held = await self.acquire()
+                    if held:
+                        renewed_at = time.monotonic()
+                except Exception:
+                    logger.exception("Failed to renew lease %s", self.name)
+                    # Keep going until the lease could have expired for the other workers
+                    held = renewed_at is not None and time.monotonic() - renewed_at < self.ttl
+                if not held:
+                    renewed_at = None
+                if task is not None and task.done():
+                    if not task.cancelled() and task.exception() is not None:
+                        # A job that ran longer than the longest backoff starts a new failure streak
+                        failures = 1 if time.monotonic() - started_at > CLUSTER_JOB_RESTART_MAX else failures + 1
+                        delay = min(CLUSTER_JOB_RESTART_MAX, self.ttl / 3 * 2 ** (failures - 1))
+                        restart_at = time.monotonic() + delay
+                        logger.error(
+                            "Job under lease %s failed, restarting in %.0f s", self.name, delay,
+                            exc_info=task.exception()
+                        )
+                    else:
+                        failures = 0
+                    task = None
+                if held and task is None and time.monotonic() >= restart_at:
+                    logger.info("Worker %s took lease %s", worker_id(), self.name)
+                    started_at = time.monotonic()
+                    task = asyncio.create_task(job())
+                elif not held and task is not None:
+                    logger.info("Worker %s lost lease %s", worker_id(), self.name)
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    task = None
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await self.release()
+
+
+cluster_bus = create_bus()
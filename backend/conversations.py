@@ -0,0 +1,242 @@
+"""Conversation threading with an incrementally maintained thread index.
+
+Thread ids are assigned once, when a message is first stored (provider
+sync, IMAP ingest or send), so listing conversations never groups
+messages at read time:
+
+- a message joins the thread of any stored message its In-Reply-To or
+  References headers name, looked up by Message-ID
+- otherwise it joins the most recently active thread with the same
+  normalized subject ("Re: Fwd: Budget" -> "budget") that shares a
+  participant and was active within THREAD_SUBJECT_WINDOW_DAYS
+- otherwise it starts a new thread
+
+Each thread has a summary document in threads_collection with its last
+activity, message and unread counts, participants and latest message.
+After a batch of writes the summaries of the touched threads are
+recomputed by one aggregation over the (user_id, thread_id) index, so the
+counts stay exact when a resync changes read state, and thread listings
+read summaries only. Run `python conversations.py --backfill` once to
+thread mail stored before threading existed.
+"""
+import asyncio
+import os
+import re
+import sys
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import DeleteOne, UpdateOne
+
+from database import emails_collection, threads_collection
+
+THREAD_SUBJECT_WINDOW_DAYS = int(os.environ.get('THREAD_SUBJECT_WINDOW_DAYS', '30'))
+# Oldest references are dropped; the nearest ancestors are the ones likely to be stored
+MAX_REFERENCES = 20
+MAX_PARTICIPANTS = 50
+SNIPPET_LENGTH = 200
+BACKFILL_BATCH_SIZE = 500
+
+THREAD_LIST_PROJECTION = {"_id": 0, "subject_key": 0}
+
+# Reply and forward markers in common mail clients' languages, and [list] tags
+SUBJECT_PREFIX_RE = re.compile(r"^\s*(?:(?:re|fwd?|aw|wg|sv|vs|antw|tr|rif|enc)(?:\[\d+\])?\s*:\s*|\[[^\]]*\]\s*)+",
+                               re.IGNORECASE)
+WHITESPACE_RE = re.compile(r"\s+")
+MESSAGE_ID_RE = re.compile(r"<[^<>\s]+>")
+
+
+def display_subject(subject: Optional[str]) -> str:
+    return WHITESPACE_RE.sub(" ", SUBJECT_PREFIX_RE.sub("", subject or "")).strip()
+
+
+def subject_key(subject: Optional[str]) -> str:
+    return display_subject(subject).lower()
+
+
+def parse_message_ids(value: Optional[str]) -> List[str]:
+    """Message-IDs in a References or In-Reply-To header value"""
+    return MESSAGE_ID_RE.findall(value or "")
+
+
+def message_references(doc: Dict) -> List[str]:
+    """Message-IDs a message refers to, nearest ancestor last"""
+    references = list(doc.get("references") or [])
+    in_reply_to = doc.get("in_reply_to")
+    if in_reply_to and in_reply_to not in references:
+        references.append(in_reply_to)
+    return references[-MAX_REFERENCES:]
+
+
+def counterparties(doc: Dict) -> List[str]:
+    """The people a message was exchanged with: recipients of sent mail, the sender otherwise"""
+    if doc.get("folder") == "sent":
+        addresses = list(doc.get("to") or []) + list(doc.get("cc") or []) + list(doc.get("bcc") or [])
+    else:
+        addresses = [doc.get("from")]
+    return [address.lower() for address in addresses if address]
+
+
+def _activity(doc: Dict) -> datetime:
+    return doc.get("received_at") or doc.get("sent_at") or datetime.min
+
+
+async def assign_threads(user_id: str, docs: List[Dict]):
+    """Set thread_id on message documents that have none, oldest first, in place"""
+    pending = [doc for doc in docs if not doc.get("thread_id")]
+    if not pending:
+        return
+
+    thread_by_message_id: Dict[str, str] = {}
+    references = {reference for doc in pending for reference in message_references(doc)}
+    if references:
+        for found in await emails_collection.find(
+            {"user_id": user_id, "message_id": {"$in": list(references)}, "thread_id": {"$exists": True}},
+            {"_id": 0, "message_id": 1, "thread_id": 1}
+        ).to_list():
+            thread_by_message_id[found["message_id"]] = found["thread_id"]
+
+    # subject key -> [{"id", "participants"}], most recently active first
+    candidates: Dict[str, List[Dict]] = {}
+    keys = {subject_key(doc.get("subject")) for doc in pending} - {""}
+    if keys:
+        cutoff = datetime.utcnow() - timedelta(days=THREAD_SUBJECT_WINDOW_DAYS)
+        for thread in await threads_collection.find(
+            {"user_id": user_id, "subject_key": {"$in": list(keys)}, "last_activity": {"$gte": cutoff}},
+            {"_id": 0, "id": 1, "subject_key": 1, "participants": 1}
+        ).sort("last_activity", -1).to_list():
+            candidates.setdefault(thread["subject_key"], []).append(
+                {"id": thread["id"], "participants": set(thread.get("participants") or [])}
+            )
+
+    for doc in sorted(pending, key=_activity):
+        thread_id = next(
+            (thread_by_message_id[reference] for reference in reversed(message_references(doc))
+             if reference in thread_by_message_id),
+            None
+        )
+        key = subject_key(doc.get("subject"))
+        people = set(counterparties(doc))
+        if thread_id is None and key:
+            thread_id = next(
+                (candidate["id"] for candidate in candidates.get(key, ()) if candidate["participants"] & people),
+                None
+            )
+        if thread_id is None:
+            thread_id = str(uuid.uuid4())
+        doc["thread_id"] = thread_id
+
+        # Later messages in the same batch can reply to or continue this one
+        if doc.get("message_id"):
+            thread_by_message_id[doc["message_id"]] = thread_id
+        if key:
+            bucket = candidates.setdefault(key, [])
+            candidate = next((candidate for candidate in bucket if candidate["id"] == thread_id), None)
+            if candidate is None:
+                bucket.insert(0, {"id": thread_id, "participants": people})
+            else:
+                candidate["participants"] |= people
+
+
+async def refresh_threads(user_id: str, thread_ids: Iterable[str]):
+    """Recompute the summaries of the given threads from their messages"""
+    thread_ids = list({thread_id for thread_id in thread_ids if thread_id})
+    if not thread_ids:
+        return
+
+    summaries = await emails_collection.aggregate([
+        {"$match": {"user_id": user_id, "thread_id": {"$in": thread_ids}}},
+        {"$project": {
+            "_id": 0, "id": 1, "thread_id": 1, "subject": 1, "folder": 1, "is_read": 1, "is_important": 1,
+            "from": 1, "from_email": 1, "to": 1, "cc": 1, "bcc": 1, "body": 1,
+            "at": {"$ifNull": ["$received_at", "$sent_at"]}
+        }},
+        {"$sort": {"at": -1}},
+        {"$group": {
+            "_id": "$thread_id",
+            "message_count": {"$sum": 1},
+            "unread_count": {"$sum": {"$cond": [{"$eq": ["$is_read", False]}, 1, 0]}},
+            "last_activity": {"$first": "$at"},
+            "last_message_id": {"$first": "$id"},
+            "last_from": {"$first": {"$ifNull": ["$from", "$from_email"]}},
+            "last_subject": {"$first": "$subject"},
+            "last_body": {"$first": "$body"},
+            "first_subject": {"$last": "$subject"},
+            "senders": {"$addToSet": {"$cond": [{"$eq": ["$folder", "sent"]}, None, "$from"]}},
+            "recipients": {"$push": {"$concatArrays": [
+                {"$ifNull": ["$to", []]}, {"$ifNull": ["$cc", []]}, {"$ifNull": ["$bcc", []]}
+            ]}},
+            "folders": {"$addToSet": "$folder"},
+            "is_important": {"$max": "$is_important"}
+        }}
+    ]).to_list()
+
+    now = datetime.utcnow()
+    operations = []
+    for summary in summaries:
+        participants = {
+            address.lower()
+            for address in summary["senders"] + [address for group in summary["recipients"] for address in group]
+            if address
+        }
+        operations.append(UpdateOne(
+            {"id": summary["_id"], "user_id": user_id},
+            {
+                "$set": {
+                    "message_count": summary["message_count"],
+                    "unread_count": summary["unread_count"],
+                    "last_activity": summary["last_activity"],
+                    "last_message": {
+                        "id": summary["last_message_id"],
+                        "from": summary["last_from"],
+                        "subject": summary["last_subject"],
+                        "snippet": WHITESPACE_RE.sub(" ", summary["last_body"] or "")[:SNIPPET_LENGTH].strip()
+                    },
+                    "participants": sorted(participants)[:MAX_PARTICIPANTS],
+                    "folders": sorted(folder for folder in summary["folders"] if folder),
+                    "is_important": bool(summary["is_important"]),
+                    "updated_at": now
+                },
+                "$setOnInsert": {
+                    "id": summary["_id"],
+                    "user_id": user_id,
+                    "subject": display_subject(summary["first_subject"]),
+                    "subject_key": subject_key(summary["first_subject"]),
+                    "created_at": now
+                }
+            },
+            upsert=True
+        ))
+    found = {summary["_id"] for summary in summaries}
+    operations.extend(
+        DeleteOne({"id": thread_id, "user_id": user_id}) for thread_id in thread_ids if thread_id not in found
+    )
+    await threads_collection.bulk_write(operations, ordered=False)
+
+
+async def backfill_threads(batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """Thread every stored message that has no thread_id yet; returns messages threaded"""
+    threaded = 0
+    for user_id in await emails_collection.distinct("user_id", {"thread_id": {"$exists": False}}):
+        while True:
+            docs = await emails_collection.find(
+                {"user_id": user_id, "thread_id": {"$exists": False}},
+                {"_id": 0, "id": 1, "subject": 1, "from": 1, "to": 1, "cc": 1, "bcc": 1, "folder": 1,
+                 "message_id": 1, "in_reply_to": 1, "references": 1, "received_at": 1, "sent_at": 1}
+            ).limit(batch_size).to_list()
+            if not docs:
+                break
+            await assign_threads(user_id, docs)
+            await emails_collection.bulk_write(
+                [UpdateOne({"id": doc["id"]}, {"$set": {"thread_id": doc["thread_id"]}}) for doc in docs],
+                ordered=False
+            )
+            await refresh_threads(user_id, [doc["thread_id"] for doc in docs])
+            threaded += len(docs)
+    return threaded
+
+
+if __name__ == "__main__":
+    if "--backfill" in sys.argv:
+        print(f"Threaded {asyncio.run(backfill_threads())} messages")
@@ -0,0 +1,193 @@
+"""MongoDB access layer for the StartupMail API.
+
+pymongo is a blocking driver, so every collection call is dispatched to a
+bounded thread pool and awaited instead of running on the event loop.
+
+The client and the thread pool belong to one process. Both are created on
+first use and dropped in a forked child, so every API worker opens its own
+connection pool after the fork; the app lifespan closes them on shutdown.
+"""
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import Any, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+from metrics import mongo_command_metrics
+
+load_dotenv()
+
+MONGO_URL = os.environ.get('MONGO_URL')
+MONGO_POOL_SIZE = int(os.environ.get('MONGO_POOL_SIZE', '32'))
+MONGO_BATCH_SIZE = 500
+
+_client: Optional[MongoClient] = None
+_executor: Optional[ThreadPoolExecutor] = None
+# Bumped whenever the client is replaced so collection proxies rebind
+_generation = 0
+
+
+def get_client() -> MongoClient:
+    """This process's MongoClient"""
+    global _client
+    if _client is None:
+        _client = MongoClient(MONGO_URL, maxPoolSize=MONGO_POOL_SIZE, event_listeners=[mongo_command_metrics])
+    return _client
+
+
+def get_db():
+    return get_client().startupmail
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        # One thread per pooled connection so queries never wait on a free socket
+        _executor = ThreadPoolExecutor(max_workers=MONGO_POOL_SIZE, thread_name_prefix="mongo")
+    return _executor
+
+
+def _forget():
+    global _client, _executor, _generation
+    _client, _executor = None, None
+    _generation += 1
+
+
+def close_client():
+    """Close this process's client and database threads"""
+    client, executor = _client, _executor
+    _forget()
+    if executor is not None:
+        executor.shutdown(wait=True)
+    if client is not None:
+        client.close()
+
+
+# Sockets and threads do not survive a fork; the child starts its own on first use
+os.register_at_fork(after_in_child=_forget)
+
+
+def __getattr__(name: str):
+    # database.db / database.mongo_client resolve to the current process's client
+    if name == "db":
+        return get_db()
+    if name == "mongo_client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+async def run_in_db_thread(fn: Callable, *args, **kwargs) -> Any:
+    """Run a blocking pymongo call on the database thread pool"""
+    loop = asyncio.get_running_loop()
+    # Carry the caller's context so command metrics are charged to the right request
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_get_executor(), context.run, partial(fn, *args, **kwargs))
+
+
+class AsyncCursor:
+    """Awaitable wrapper around a lazily created pymongo cursor"""
+
+    def __init__(self, factory: Callable):
+        self._factory = factory
+        self._modifiers = []
+
+    def sort(self, key, direction=None) -> "AsyncCursor":
+        self._modifiers.append(("sort", (key, direction) if direction is not None else (key,)))
+        return self
+
+    def skip(self, count: int) -> "AsyncCursor":
+        self._modifiers.append(("skip", (count,)))
+        return self
+
+    def limit(self, count: int) -> "AsyncCursor":
+        self._modifiers.append(("limit", (count,)))
+        return self
+
+    def batch_size(self, count: int) -> "AsyncCursor":
+        self._modifiers.append(("batch_size", (count,)))
+        return self
+
+    def _build(self):
+        cursor = self._factory()
+        for name, args in self._modifiers:
+            cursor = getattr(cursor, name)(*args)
+        return cursor
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict]:
+        """Materialise the cursor (or its first `length` documents) off the event loop"""
+        def fetch():
+            cursor = self._build()
+            return list(cursor if length is None else islice(cursor, length))
+        return await run_in_db_thread(fetch)
+
+    async def __aiter__(self):
+        cursor = await run_in_db_thread(self._build)
+        try:
+            while True:
+                batch = await run_in_db_thread(lambda: list(islice(cursor, MONGO_BATCH_SIZE)))
+                if not batch:
+                    break
+                for document in batch:
+                    yield document
+        finally:
+            cursor.close()
+
+
+class AsyncCollection:
+    """Collection proxy whose methods are coroutines executed on the database pool"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._bound = (-1, None)
+
+    @property
+    def delegate(self):
+        """The pymongo collection on this process's current client"""
+        generation, collection = self._bound
+        if generation != _generation or collection is None:
+            collection = get_db()[self.name]
+            self._bound = (_generation, collection)
+        return collection
+
+    def find(self, *args, **kwargs) -> AsyncCursor:
+        return AsyncCursor(lambda: self.delegate.find(*args, **kwargs))
+
+    def aggregate(self, pipeline: List[Dict], **kwargs) -> AsyncCursor:
+        return AsyncCursor(lambda: self.delegate.aggregate(pipeline, **kwargs))
+
+    def __getattr__(self, name: str):
+        method = getattr(self.delegate, name)
+        if not callable(method):
+            return method
+
+        async def call(*args, **kwargs):
+            return await run_in_db_thread(method, *args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+
+# Collections; each resolves to the current process's client when used
+users_collection = AsyncCollection("users")
+emails_collection = AsyncCollection("emails")
+drafts_collection = AsyncCollection("drafts")
+contacts_collection = AsyncCollection("contacts")
+templates_collection = AsyncCollection("templates")
+campaigns_collection = AsyncCollection("campaigns")
+scheduled_emails_collection = AsyncCollection("scheduled_emails")
+sessions_collection = AsyncCollection("sessions")
+email_accounts_collection = AsyncCollection("email_accounts")
+filters_collection = AsyncCollection("filters")
+attachments_collection = AsyncCollection("attachments")
+attachment_blobs_collection = AsyncCollection("attachment_blobs")
+threads_collection = AsyncCollection("threads")
+analytics_totals_collection = AsyncCollection("analytics_totals")
+analytics_daily_collection = AsyncCollection("analytics_daily")
+analytics_recipients_collection = AsyncCollection("analytics_recipients")
+cluster_events_collection = AsyncCollection("cluster_events")
+leases_collection = AsyncCollection("leases")
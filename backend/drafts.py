@@ -0,0 +1,175 @@
+"""Draft autosave with deduplicated, delta and coalesced writes.
+
+The frontend autosaves while the user types, so most saves repeat the
+stored content or change a single field. Each draft document carries a
+`content_hash`, and the autosaver remembers the per-field hashes it last
+wrote for every draft it has seen:
+
+- a save whose hash matches the last write only reads the stored
+  content_hash to confirm nobody changed the draft since, and is then
+  skipped without a write
+- otherwise only the changed fields are `$set` in one update_one whose
+  filter carries the ownership check and the previous content_hash, so no
+  read is needed and a concurrent writer (another tab or worker) is detected
+- with DRAFT_COALESCE_WINDOW > 0, saves to a known draft are buffered and
+  only the latest content is flushed when the window closes
+
+Outcomes are counted on the draft_autosave_total metric.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from cache import TTLCache
+from database import drafts_collection
+from metrics import DRAFT_AUTOSAVES
+
+logger = logging.getLogger(__name__)
+
+DRAFT_FIELDS = ("to", "cc", "bcc", "subject", "body", "is_html")
+# Seconds to buffer rapid saves to the same draft; 0 writes every save through
+DRAFT_COALESCE_WINDOW = float(os.environ.get('DRAFT_COALESCE_WINDOW', '0'))
+DRAFT_STATE_CACHE_SIZE = int(os.environ.get('DRAFT_STATE_CACHE_SIZE', '50000'))
+DRAFT_STATE_CACHE_TTL = 3600
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def content_hashes(fields: Dict[str, Any]) -> Tuple[str, Dict[str, str]]:
+    """(content hash, per-field hashes) for a draft's editable fields"""
+    field_hashes = {
+        field: _digest(json.dumps(fields.get(field), sort_keys=True).encode())
+        for field in DRAFT_FIELDS
+    }
+    content_hash = _digest("".join(field_hashes[field] for field in DRAFT_FIELDS).encode())
+    return content_hash, field_hashes
+
+
+class DraftAutosaver:
+    def __init__(self, coalesce_window: float = DRAFT_COALESCE_WINDOW):
+        self.coalesce_window = coalesce_window
+        # (user_id, draft_id) -> (content hash, field hashes) last known to be stored
+        self._stored = TTLCache(maxsize=DRAFT_STATE_CACHE_SIZE, ttl=DRAFT_STATE_CACHE_TTL)
+        self._pending: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._timers: Dict[Tuple[str, str], asyncio.TimerHandle] = {}
+        self._flushes = set()
+
+    async def create(self, user_id: str, fields: Dict[str, Any]) -> str:
+        content_hash, field_hashes = content_hashes(fields)
+        now = datetime.utcnow()
+        draft_doc = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            **fields,
+            "content_hash": content_hash,
+            "created_at": now,
+            "updated_at": now
+        }
+        await drafts_collection.insert_one(draft_doc)
+        self._stored.set((user_id, draft_doc["id"]), (content_hash, field_hashes))
+        DRAFT_AUTOSAVES.inc("created")
+        return draft_doc["id"]
+
+    async def save(self, user_id: str, draft_id: str, fields: Dict[str, Any]) -> bool:
+        """Save a draft's fields; returns False if the user has no such draft"""
+        key = (user_id, draft_id)
+        # Only drafts already confirmed to belong to the user are buffered, so a 404 is never deferred
+        if self.coalesce_window > 0 and self._stored.get(key) is not None:
+            if key in self._pending:
+                DRAFT_AUTOSAVES.inc("coalesced")
+            self._pending[key] = fields
+            if key not in self._timers:
+                self._timers[key] = asyncio.get_running_loop().call_later(
+                    self.coalesce_window, self._start_flush, key
+                )
+            return True
+        return await self._write(user_id, draft_id, fields)
+
+    def pending(self, user_id: str, draft_id: str) -> Optional[Dict[str, Any]]:
+        """Buffered fields not yet flushed, so reads can see the latest save"""
+        return self._pending.get((user_id, draft_id))
+
+    def forget(self, user_id: str, draft_id: str):
+        key = (user_id, draft_id)
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        self._pending.pop(key, None)
+        self._stored.invalidate(key)
+
+    async def flush_all(self):
+        """Write every buffered save now (shutdown)"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        pending, self._pending = self._pending, {}
+        await asyncio.gather(*(self._flush(key, fields) for key, fields in pending.items()))
+        if self._flushes:
+            await asyncio.gather(*self._flushes)
+
+    def _start_flush(self, key: Tuple[str, str]):
+        self._timers.pop(key, None)
+        fields = self._pending.pop(key, None)
+        if fields is None:
+            return
+        task = asyncio.create_task(self._flush(key, fields))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, key: Tuple[str, str], fields: Dict[str, Any]):
+        try:
+            await self._write(key[0], key[1], fields)
+        except Exception:
+            logger.exception("Failed to flush draft %s", key[1])
+
+    async def _write(self, user_id: str, draft_id: str, fields: Dict[str, Any]) -> bool:
+        key = (user_id, draft_id)
+        content_hash, field_hashes = content_hashes(fields)
+        now = datetime.utcnow()
+
+        stored = self._stored.get(key)
+        if stored is not None and stored[0] == content_hash:
+            # Another tab or worker may have written different content since our last write
+            if await drafts_collection.count_documents(
+                {"id": draft_id, "user_id": user_id, "content_hash": content_hash}, limit=1
+            ):
+                DRAFT_AUTOSAVES.inc("unchanged")
+                return True
+        elif stored is not None:
+            stored_hash, stored_field_hashes = stored
+            changed = {field: fields[field] for field in DRAFT_FIELDS if field_hashes[field] != stored_field_hashes[field]}
+            result = await drafts_collection.update_one(
+                {"id": draft_id, "user_id": user_id, "content_hash": stored_hash},
+                {"$set": {**changed, "content_hash": content_hash, "updated_at": now}}
+            )
+            if result.matched_count:
+                self._stored.set(key, (content_hash, field_hashes))
+                DRAFT_AUTOSAVES.inc("delta")
+                return True
+            # Changed elsewhere since our last write; fall back to a full write
+
+        result = await drafts_collection.update_one(
+            {"id": draft_id, "user_id": user_id, "content_hash": {"$ne": content_hash}},
+            {"$set": {**fields, "content_hash": content_hash, "updated_at": now}}
+        )
+        if result.matched_count:
+            self._stored.set(key, (content_hash, field_hashes))
+            DRAFT_AUTOSAVES.inc("full")
+            return True
+
+        # Nothing matched: either the stored content is already identical or the draft is not the user's
+        if not await drafts_collection.count_documents({"id": draft_id, "user_id": user_id}, limit=1):
+            return False
+        self._stored.set(key, (content_hash, field_hashes))
+        DRAFT_AUTOSAVES.inc("unchanged")
+        return True
+
+
+draft_autosaver = DraftAutosaver()
@@ -0,0 +1,319 @@
+"""Email filter rules compiled into fast matchers.
+
+A filter is a set of `conditions` (all must match) and `actions` applied to
+incoming mail during inbox sync:
+
+    conditions: from, from_domain (address or list), subject_contains,
+                body_contains (case-insensitive substring), subject_matches,
+                body_matches (regular expression)
+    actions:    add_labels (list), mark_important, mark_read (bool),
+                move_to (folder)
+
+A user's filters compile into a RuleSet. Rules keyed on a sender or domain
+are reached through hash lookups on the message's address, and the subject
+and body patterns of the remaining rules are folded into one combined
+regex per field, so a message that matches none of them is rejected with
+a single search instead of one per rule. Plain substrings are matched
+against lowercased text, and their pre-check is a case-sensitive prefix
+trie that the regex engine can scan quickly. Compiled rule sets are cached
+per user and invalidated on every worker whenever that user's filters change.
+
+Patterns run on the event loop for every synced message, so their length is
+capped at FILTER_PATTERN_MAX_LENGTH.
+"""
+import logging
+import os
+import re
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from cache import TTLCache
+from cluster import cluster_bus
+from database import filters_collection
+
+logger = logging.getLogger(__name__)
+
+FILTER_CACHE_TTL = float(os.environ.get('FILTER_CACHE_TTL', '300'))
+FILTER_CACHE_SIZE = int(os.environ.get('FILTER_CACHE_SIZE', '10000'))
+FILTER_PATTERN_MAX_LENGTH = int(os.environ.get('FILTER_PATTERN_MAX_LENGTH', '200'))
+
+CONDITION_KEYS = {"from", "from_domain", "subject_contains", "subject_matches", "body_contains", "body_matches"}
+ACTION_KEYS = {"add_labels", "mark_important", "mark_read", "move_to"}
+
+
+def _as_list(value) -> List[str]:
+    values = value if isinstance(value, (list, tuple)) else [value]
+    if not all(isinstance(item, str) and item for item in values):
+        raise ValueError("address conditions must be non-empty strings")
+    return [item.lower() for item in values]
+
+
+def _check_text_conditions(conditions: Dict[str, Any]):
+    for field in ("subject", "body"):
+        for key in (f"{field}_contains", f"{field}_matches"):
+            if key in conditions and not (isinstance(conditions[key], str) and conditions[key]):
+                raise ValueError(f"{key} must be a non-empty string")
+        pattern = conditions.get(f"{field}_matches")
+        if pattern is not None and len(pattern) > FILTER_PATTERN_MAX_LENGTH:
+            raise ValueError(f"{field}_matches is longer than {FILTER_PATTERN_MAX_LENGTH} characters")
+
+
+def _field_pattern(conditions: Dict[str, Any], field: str) -> Optional[str]:
+    """Combine a field's substring and regex conditions into one pattern (both must match)"""
+    parts = []
+    if conditions.get(f"{field}_contains"):
+        parts.append(re.escape(conditions[f"{field}_contains"]))
+    if conditions.get(f"{field}_matches"):
+        parts.append(conditions[f"{field}_matches"])
+    if not parts:
+        return None
+    if len(parts) == 1:
+        return parts[0]
+    # Lookaheads let a single search require every part
+    return "".join(f"(?=.*?(?:{part}))" for part in parts)
+
+
+def _field_literal(conditions: Dict[str, Any], field: str) -> Optional[str]:
+    """The plain substring a field must contain, when that is its only condition"""
+    if conditions.get(f"{field}_contains") and not conditions.get(f"{field}_matches"):
+        return conditions[f"{field}_contains"].lower()
+    return None
+
+
+class CompiledRule:
+    """One filter with its conditions compiled"""
+
+    __slots__ = ("order", "filter_id", "senders", "domains", "subject_pattern", "body_pattern",
+                 "subject_literal", "body_literal", "subject_re", "body_re", "actions")
+
+    def __init__(self, order: int, filter_doc: Dict[str, Any]):
+        conditions = filter_doc.get("conditions") or {}
+        actions = filter_doc.get("actions") or {}
+        unknown = (set(conditions) - CONDITION_KEYS) | (set(actions) - ACTION_KEYS)
+        if unknown:
+            raise ValueError(f"Unsupported filter keys: {', '.join(sorted(unknown))}")
+        if not conditions:
+            raise ValueError("A filter needs at least one condition")
+        if not actions:
+            raise ValueError("A filter needs at least one action")
+        _check_text_conditions(conditions)
+
+        self.order = order
+        self.filter_id = filter_doc.get("id")
+        self.senders = frozenset(_as_list(conditions["from"])) if "from" in conditions else None
+        self.domains = frozenset(d.lstrip("@") for d in _as_list(conditions["from_domain"])) \
+            if "from_domain" in conditions else None
+        self.subject_pattern = _field_pattern(conditions, "subject")
+        self.body_pattern = _field_pattern(conditions, "body")
+        self.subject_literal = _field_literal(conditions, "subject")
+        self.body_literal = _field_literal(conditions, "body")
+        try:
+            # Substring-only fields are checked with `in` on lowercased text instead
+            self.subject_re = re.compile(self.subject_pattern, re.IGNORECASE | re.DOTALL) \
+                if self.subject_pattern and self.subject_literal is None else None
+            self.body_re = re.compile(self.body_pattern, re.IGNORECASE | re.DOTALL) \
+                if self.body_pattern and self.body_literal is None else None
+        except re.error as e:
+            raise ValueError(f"Invalid pattern: {e}")
+
+        labels = actions.get("add_labels") or []
+        if not isinstance(labels, list) or not all(isinstance(label, str) for label in labels):
+            raise ValueError("add_labels must be a list of strings")
+        if "move_to" in actions and not isinstance(actions["move_to"], str):
+            raise ValueError("move_to must be a folder name")
+        self.actions = actions
+
+    @property
+    def needs_subject(self) -> bool:
+        return self.subject_pattern is not None
+
+    @property
+    def needs_body(self) -> bool:
+        return self.body_pattern is not None
+
+    def matches(self, sender: str, domain: str, subject: str, body: str,
+                subject_lower: str, body_lower: str) -> bool:
+        if self.senders is not None and sender not in self.senders:
+            return False
+        if self.domains is not None and domain not in self.domains:
+            return False
+        if self.subject_literal is not None and self.subject_literal not in subject_lower:
+            return False
+        if self.body_literal is not None and self.body_literal not in body_lower:
+            return False
+        if self.subject_re is not None and not self.subject_re.search(subject):
+            return False
+        if self.body_re is not None and not self.body_re.search(body):
+            return False
+        return True
+
+
+BACKREFERENCE_RE = re.compile(r"\\\d|\(\?P=")
+MATCH_ALL = re.compile("")
+
+
+MAX_TRIE_LITERAL = 200
+
+
+def _trie_pattern(literals: Iterable[str]) -> str:
+    """Regex for a set of substrings that shares common prefixes, e.g. foo|fob -> fo(?:o|b)"""
+    trie: Dict[str, Any] = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: Dict[str, Any]) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        return f"(?:{pattern})?" if "" in node else pattern
+
+    return build(trie)
+
+
+def _combined(rules: Iterable[CompiledRule], field: str):
+    """(literal trie for lowercased text, case-insensitive regex alternation) covering a field's rules"""
+    literals, patterns = set(), []
+    for rule in rules:
+        literal = getattr(rule, f"{field}_literal")
+        if literal is not None and len(literal) <= MAX_TRIE_LITERAL:
+            literals.add(literal)
+        else:
+            patterns.append(getattr(rule, f"{field}_pattern"))
+
+    literal_re = re.compile(_trie_pattern(literals)) if literals else None
+    if not patterns:
+        return literal_re, None
+    # Backreferences would be renumbered inside the alternation, so skip the pre-check for them
+    if any(BACKREFERENCE_RE.search(pattern) for pattern in patterns):
+        return literal_re, MATCH_ALL
+    try:
+        return literal_re, re.compile("|".join(f"(?:{pattern})" for pattern in patterns), re.IGNORECASE | re.DOTALL)
+    except re.error:
+        # e.g. duplicate group names or inline flags that are only valid on their own
+        return literal_re, MATCH_ALL
+
+
+def _any_hit(prechecks, text: str, text_lower: str) -> bool:
+    literal_re, pattern_re = prechecks
+    return (literal_re is not None and literal_re.search(text_lower) is not None) or \
+        (pattern_re is not None and pattern_re.search(text) is not None)
+
+
+class RuleSet:
+    """A user's filters, indexed for per-message evaluation"""
+
+    def __init__(self, filter_docs: Sequence[Dict[str, Any]]):
+        self.rules = []
+        for order, doc in enumerate(filter_docs):
+            try:
+                self.rules.append(CompiledRule(order, doc))
+            except ValueError as e:
+                # Stored before the current validation rules; it never matches rather than failing the sync
+                logger.warning("Skipping invalid filter %s: %s", doc.get("id"), e)
+        self._by_sender: Dict[str, List[CompiledRule]] = defaultdict(list)
+        self._by_domain: Dict[str, List[CompiledRule]] = defaultdict(list)
+        # Sender-independent rules, bucketed by which text fields they inspect
+        self._any_sender: Dict[Tuple[bool, bool], List[CompiledRule]] = defaultdict(list)
+
+        for rule in self.rules:
+            if rule.senders is not None:
+                for sender in rule.senders:
+                    self._by_sender[sender].append(rule)
+            elif rule.domains is not None:
+                for domain in rule.domains:
+                    self._by_domain[domain].append(rule)
+            else:
+                self._any_sender[(rule.needs_subject, rule.needs_body)].append(rule)
+
+        # Cheap pre-checks: one search tells whether any sender-independent rule can match a field
+        self._subject_prechecks = _combined((
+            rule for (needs_subject, _), rules in self._any_sender.items() if needs_subject for rule in rules
+        ), "subject")
+        self._body_prechecks = _combined((
+            rule for (_, needs_body), rules in self._any_sender.items() if needs_body for rule in rules
+        ), "body")
+        self._by_sender = dict(self._by_sender)
+        self._by_domain = dict(self._by_domain)
+        self._any_sender = dict(self._any_sender)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def match(self, message: Dict[str, Any]) -> List[CompiledRule]:
+        """Rules matching a message, in filter order"""
+        sender = (message.get("from") or "").lower()
+        domain = sender.rpartition("@")[2]
+        subject = message.get("subject") or ""
+        body = message.get("body") or ""
+        subject_lower = subject.lower()
+        body_lower = body.lower()
+
+        candidates = self._by_sender.get(sender, []) + self._by_domain.get(domain, [])
+        if self._any_sender:
+            subject_hit = _any_hit(self._subject_prechecks, subject, subject_lower)
+            body_hit = _any_hit(self._body_prechecks, body, body_lower)
+            for (needs_subject, needs_body), rules in self._any_sender.items():
+                if (needs_subject and not subject_hit) or (needs_body and not body_hit):
+                    continue
+                candidates = candidates + rules
+
+        matched = [
+            rule for rule in candidates if rule.matches(sender, domain, subject, body, subject_lower, body_lower)
+        ]
+        if len(matched) > 1:
+            matched.sort(key=lambda rule: rule.order)
+        return matched
+
+    def apply(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Field changes produced by the matching rules; later filters win on conflicts"""
+        changes: Dict[str, Any] = {}
+        for rule in self.match(message):
+            actions = rule.actions
+            if actions.get("add_labels"):
+                labels = changes.get("labels", list(message.get("labels") or []))
+                changes["labels"] = labels + [label for label in actions["add_labels"] if label not in labels]
+            if "mark_important" in actions:
+                changes["is_important"] = bool(actions["mark_important"])
+            if "mark_read" in actions:
+                changes["is_read"] = bool(actions["mark_read"])
+            if actions.get("move_to"):
+                changes["folder"] = actions["move_to"]
+        return changes
+
+
+EMPTY_RULE_SET = RuleSet([])
+
+_rule_sets = TTLCache(maxsize=FILTER_CACHE_SIZE, ttl=FILTER_CACHE_TTL)
+
+
+def validate_filter(conditions: Dict[str, Any], actions: Dict[str, Any]):
+    """Raise ValueError if a filter cannot be compiled"""
+    CompiledRule(0, {"conditions": conditions, "actions": actions})
+
+
+async def get_rule_set(user_id: str) -> RuleSet:
+    """The user's compiled filters, from cache when possible"""
+    rule_set = _rule_sets.get(user_id)
+    if rule_set is None:
+        filter_docs = await filters_collection.find(
+            {"user_id": user_id, "enabled": {"$ne": False}}, {"_id": 0}
+        ).sort("created_at", 1).to_list()
+        rule_set = RuleSet(filter_docs) if filter_docs else EMPTY_RULE_SET
+        _rule_sets.set(user_id, rule_set)
+    return rule_set
+
+
+async def invalidate_rule_set(user_id: str):
+    """Drop the user's compiled filters on every worker"""
+    await cluster_bus.publish("filters", {"user_id": user_id})
+
+
+cluster_bus.subscribe("filters", lambda message: _rule_sets.invalidate(message["user_id"]))
+
+
+def filter_cache_stats() -> Dict[str, Any]:
+    return _rule_sets.stats()
@@ -0,0 +1,28 @@
+"""Gunicorn settings for serving the API from several uvicorn worker processes.
+
+    cd backend && gunicorn -c gunicorn.conf.py server:app
+
+preload_app stays off so each worker imports the app after the fork and
+opens its own Mongo client, HTTP pools and background loops from the app
+lifespan. Caches and SSE subscribers are then per worker; with more than
+one worker set CLUSTER_BUS=mongo (MongoDB as a replica set) so session and
+filter invalidations and new-mail events reach all of them.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8001')
+workers = int(os.environ.get('WEB_CONCURRENCY', str(multiprocessing.cpu_count())))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = False
+# Time for lifespans to flush buffered drafts and finish in-flight sends
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+
+
+def on_starting(server):
+    if workers > 1 and os.environ.get('CLUSTER_BUS', 'local') == 'local':
+        server.log.warning(
+            "Running %d workers with CLUSTER_BUS=local: logouts, filter edits and new-mail "
+            "events only reach the worker that handled them", workers
+        )
@@ -0,0 +1,383 @@
+"""Push ingestion of new mail over IMAP IDLE.
+
+Instead of asking the provider for changes whenever a client opens the
+inbox, IMAPIngestor keeps one connection per connected account parked in
+IDLE (RFC 2177). The server announces new mail with an untagged EXISTS,
+and only then does the worker fetch, and only UIDs above the account's
+stored `imap_last_uid`: it lists their UIDs, then fetches the flags, size
+and the first IMAP_MAX_BODY_BYTES of each message IMAP_FETCH_BATCH
+messages at a time, so a backlog after an outage is never one huge FETCH.
+Small messages arrive whole, large ones (attachments) only as far as their
+leading text. Headers are parsed from the fetched bytes on first access,
+and the MIME tree only when the body is extracted.
+
+Messages are written through mail_sync.store_messages (filters, search
+tokens, analytics and client notifications included). While an account has
+an established IDLE session its `imap_live_until` is kept IMAP_LIVE_SECONDS
+in the future, and every worker's polling sync skips it; an account whose
+login fails, or whose ingesting worker dies, goes back to being polled once
+that lapses. The worker is enabled by IMAP_HOST;
+IMAP_USERNAME/IMAP_PASSWORD default to each account's email and access token.
+With several API workers only the holder of the ingestion lease runs it, so
+each account has a single IDLE connection.
+"""
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from email import policy
+from email.parser import BytesHeaderParser, BytesParser
+from email.utils import parseaddr
+from typing import Dict, List, Optional, Sequence
+
+import aioimaplib
+
+from conversations import parse_message_ids
+from database import email_accounts_collection
+from mail_sync import store_messages
+from messages import ProviderMessage
+from metrics import IMAP_COMMANDS, IMAP_MESSAGES_INGESTED
+
+logger = logging.getLogger(__name__)
+
+# .env ships these keys blank until configured, so empty values fall back to defaults
+IMAP_HOST = os.environ.get('IMAP_HOST') or None
+IMAP_USE_SSL = (os.environ.get('IMAP_USE_SSL') or 'true').lower() == 'true'
+IMAP_PORT = int(os.environ.get('IMAP_PORT') or ('993' if IMAP_USE_SSL else '143'))
+IMAP_USERNAME = os.environ.get('IMAP_USERNAME') or None
+IMAP_PASSWORD = os.environ.get('IMAP_PASSWORD') or None
+IMAP_MAILBOX = os.environ.get('IMAP_MAILBOX', 'INBOX')
+# RFC 2177 asks clients to re-issue IDLE at least every 29 minutes
+IMAP_IDLE_SECONDS = float(os.environ.get('IMAP_IDLE_SECONDS', str(29 * 60)))
+IMAP_TIMEOUT = float(os.environ.get('IMAP_TIMEOUT', '30'))
+# Most recent messages fetched the first time an account (or a new UIDVALIDITY) is seen
+IMAP_BACKFILL = int(os.environ.get('IMAP_BACKFILL', '50'))
+IMAP_MAX_BODY_BYTES = int(os.environ.get('IMAP_MAX_BODY_BYTES', str(256 * 1024)))
+# Messages fetched and stored per batch when catching up on a backlog
+IMAP_FETCH_BATCH = 200
+IMAP_ACCOUNT_REFRESH = float(os.environ.get('IMAP_ACCOUNT_REFRESH', '60'))
+# How long an IDLE session counts as live without renewal; renewed every IMAP_ACCOUNT_REFRESH
+IMAP_LIVE_SECONDS = float(os.environ.get('IMAP_LIVE_SECONDS', str(3 * IMAP_ACCOUNT_REFRESH)))
+IMAP_RECONNECT_MAX = 300
+
+FETCH_ITEMS = f"(UID FLAGS INTERNALDATE RFC822.SIZE BODY.PEEK[]<0.{IMAP_MAX_BODY_BYTES}>)"
+
+FETCH_LINE_RE = re.compile(rb"^\d+ FETCH \(")
+UID_RE = re.compile(rb"\bUID (\d+)")
+FLAGS_RE = re.compile(rb"\bFLAGS \(([^)]*)\)")
+INTERNALDATE_RE = re.compile(rb'\bINTERNALDATE "([^"]+)"')
+SIZE_RE = re.compile(rb"\bRFC822\.SIZE (\d+)")
+EXISTS_RE = re.compile(rb"^\d+ EXISTS$")
+UIDVALIDITY_RE = re.compile(rb"\[UIDVALIDITY (\d+)\]")
+UIDNEXT_RE = re.compile(rb"\[UIDNEXT (\d+)\]")
+
+_header_parser = BytesHeaderParser(policy=policy.default)
+_message_parser = BytesParser(policy=policy.default)
+
+
+class IMAPIngestError(Exception):
+    pass
+
+
+class FetchedMessage:
+    """One FETCH response: the message, or its first IMAP_MAX_BODY_BYTES; headers are parsed on first access"""
+
+    __slots__ = ("uid", "flags", "internal_date", "size", "literal", "_headers")
+
+    def __init__(self, uid: int, flags: Sequence[str], internal_date: datetime, size: int, literal: bytes):
+        self.uid = uid
+        self.flags = flags
+        self.internal_date = internal_date
+        self.size = size
+        self.literal = literal
+        self._headers = None
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = _header_parser.parsebytes(self.literal)
+        return self._headers
+
+    def to_provider_message(self, uidvalidity: int) -> ProviderMessage:
+        message_ids = parse_message_ids(str(self.headers.get("Message-ID", "")))
+        in_reply_to = parse_message_ids(str(self.headers.get("In-Reply-To", "")))
+        return ProviderMessage(
+            id=f"{uidvalidity}:{self.uid}",
+            history_id=self.uid,
+            sender=parseaddr(str(self.headers.get("From", "")))[1],
+            subject=str(self.headers.get("Subject", "")),
+            body=_text_body(self.literal),
+            received_at=self.internal_date,
+            is_read="\\Seen" in self.flags,
+            is_important="\\Flagged" in self.flags,
+            message_id=message_ids[0] if message_ids else None,
+            in_reply_to=in_reply_to[-1] if in_reply_to else None,
+            references=tuple(parse_message_ids(str(self.headers.get("References", ""))))
+        )
+
+
+def _internal_date(value: Optional[bytes]) -> datetime:
+    if value:
+        try:
+            parsed = datetime.strptime(value.decode().strip(), "%d-%b-%Y %H:%M:%S %z")
+            return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        except ValueError:
+            pass
+    return datetime.utcnow()
+
+
+def parse_fetch(lines: Sequence) -> List[FetchedMessage]:
+    """FetchedMessages from aioimaplib response lines, where literals follow their line as bytearrays"""
+    messages = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not isinstance(line, bytearray) and FETCH_LINE_RE.match(line):
+            attributes = bytes(line)
+            literal = b""
+            if i + 1 < len(lines) and isinstance(lines[i + 1], bytearray):
+                literal = bytes(lines[i + 1])
+                i += 1
+                # Servers may put attributes after the literal too, e.g. b' FLAGS (\\Seen))'
+                following = lines[i + 1] if i + 1 < len(lines) else None
+                if isinstance(following, bytes) and following.endswith(b")") and not FETCH_LINE_RE.match(following):
+                    attributes += following
+                    i += 1
+            uid = UID_RE.search(attributes)
+            if uid:
+                flags = FLAGS_RE.search(attributes)
+                date = INTERNALDATE_RE.search(attributes)
+                size = SIZE_RE.search(attributes)
+                messages.append(FetchedMessage(
+                    uid=int(uid.group(1)),
+                    flags=flags.group(1).decode().split() if flags else [],
+                    internal_date=_internal_date(date.group(1) if date else None),
+                    size=int(size.group(1)) if size else len(literal),
+                    literal=literal
+                ))
+        i += 1
+    return messages
+
+
+def _text_body(raw: bytes) -> str:
+    # A truncated multipart message still parses; its trailing parts are just incomplete
+    message = _message_parser.parsebytes(raw)
+    part = message.get_body(preferencelist=("plain", "html"))
+    if part is None:
+        return ""
+    try:
+        return part.get_content()
+    except (LookupError, ValueError):
+        # Unknown charset or broken transfer encoding
+        payload = part.get_payload(decode=True)
+        return payload.decode("utf-8", "replace") if payload is not None else ""
+
+
+def _select_code(lines: Sequence, pattern: re.Pattern) -> Optional[int]:
+    for line in lines:
+        if isinstance(line, (bytes, bytearray)):
+            match = pattern.search(line)
+            if match:
+                return int(match.group(1))
+    return None
+
+
+def _has_exists(lines: Sequence) -> bool:
+    return any(isinstance(line, bytes) and EXISTS_RE.match(line) for line in lines)
+
+
+class IMAPIngestor:
+    def __init__(
+        self,
+        host: str,
+        port: int = IMAP_PORT,
+        use_ssl: bool = IMAP_USE_SSL,
+        username: Optional[str] = IMAP_USERNAME,
+        password: Optional[str] = IMAP_PASSWORD,
+        mailbox: str = IMAP_MAILBOX
+    ):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.username = username
+        self.password = password
+        self.mailbox = mailbox
+        self._watchers: Dict[str, asyncio.Task] = {}
+        # Accounts with an established IDLE session
+        self._live = set()
+        self._refresh = asyncio.Event()
+
+    @classmethod
+    def from_env(cls) -> Optional["IMAPIngestor"]:
+        return cls(IMAP_HOST) if IMAP_HOST else None
+
+    def watches(self, account: Dict) -> bool:
+        """Whether the ingestion worker keeps an IDLE session for the account"""
+        return account.get("provider") != "smtp"
+
+    def handles(self, account: Dict) -> bool:
+        """Whether the account's mail currently arrives over IDLE (on any worker) rather than polling"""
+        live_until = account.get("imap_live_until")
+        return self.watches(account) and live_until is not None and live_until > datetime.utcnow()
+
+    async def run(self):
+        """Ingest every account until cancelled; only one worker at a time should run this"""
+        try:
+            await self._supervise()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        tasks = list(self._watchers.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._watchers.clear()
+        self._live.clear()
+
+    def refresh(self):
+        """Reload the account list now instead of at the next IMAP_ACCOUNT_REFRESH"""
+        self._refresh.set()
+
+    def watch(self, account: Dict):
+        """Start ingesting an account (no-op if already watched)"""
+        task = self._watchers.get(account["id"])
+        if task is None or task.done():
+            self._watchers[account["id"]] = asyncio.create_task(self._watch(account))
+
+    async def _supervise(self):
+        # Picks up newly connected accounts and drops disconnected ones
+        while True:
+            self._refresh.clear()
+            try:
+                accounts = await email_accounts_collection.find(
+                    {"provider": {"$ne": "smtp"}}, {"_id": 0}
+                ).to_list()
+                current = {account["id"] for account in accounts}
+                for account in accounts:
+                    self.watch(account)
+                for account_id in list(self._watchers):
+                    if account_id not in current:
+                        self._watchers.pop(account_id).cancel()
+                        self._live.discard(account_id)
+                if self._live:
+                    await email_accounts_collection.update_many(
+                        {"id": {"$in": list(self._live)}},
+                        {"$set": {"imap_live_until": datetime.utcnow() + timedelta(seconds=IMAP_LIVE_SECONDS)}}
+                    )
+            except Exception:
+                logger.exception("Failed to refresh IMAP accounts")
+            try:
+                await asyncio.wait_for(self._refresh.wait(), IMAP_ACCOUNT_REFRESH)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _watch(self, account: Dict):
+        delay = 1.0
+        while True:
+            started = time.monotonic()
+            try:
+                await self._session(account)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("IMAP session for account %s ended: %s", account["id"], e)
+            finally:
+                await self._set_live(account["id"], False)
+            if time.monotonic() - started > IMAP_RECONNECT_MAX:
+                delay = 1.0
+            # Jitter keeps accounts on one server from reconnecting in lockstep
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, IMAP_RECONNECT_MAX)
+
+    def _connect(self) -> aioimaplib.IMAP4:
+        if self.use_ssl:
+            return aioimaplib.IMAP4_SSL(host=self.host, port=self.port, timeout=IMAP_TIMEOUT)
+        return aioimaplib.IMAP4(host=self.host, port=self.port, timeout=IMAP_TIMEOUT)
+
+    async def _command(self, name: str, call):
+        IMAP_COMMANDS.inc(name)
+        response = await call
+        if response.result != "OK":
+            raise IMAPIngestError(f"{name} failed: {response.result} {response.lines[-1:]}")
+        return response
+
+    async def _session(self, account: Dict):
+        client = self._connect()
+        try:
+            await client.wait_hello_from_server()
+            await self._command("login", client.login(
+                self.username or account["email"], self.password or account["access_token"]
+            ))
+            selected = await self._command("select", client.select(self.mailbox))
+            uidvalidity = _select_code(selected.lines, UIDVALIDITY_RE) or 0
+            uidnext = _select_code(selected.lines, UIDNEXT_RE) or 1
+
+            last_uid = account.get("imap_last_uid")
+            if account.get("imap_uidvalidity") != uidvalidity or last_uid is None:
+                # First session, or the mailbox was recreated and old UIDs mean nothing
+                last_uid = max(uidnext - 1 - IMAP_BACKFILL, 0)
+            last_uid = await self._fetch_new(client, account, uidvalidity, last_uid)
+            await self._set_live(account["id"], True)
+
+            while True:
+                IMAP_COMMANDS.inc("idle")
+                idle = await client.idle_start(timeout=IMAP_IDLE_SECONDS)
+                push = await client.wait_server_push(timeout=IMAP_IDLE_SECONDS + IMAP_TIMEOUT)
+                client.idle_done()
+                await asyncio.wait_for(idle, IMAP_TIMEOUT)
+                if push != aioimaplib.STOP_WAIT_SERVER_PUSH and _has_exists(push):
+                    last_uid = await self._fetch_new(client, account, uidvalidity, last_uid)
+        finally:
+            try:
+                await asyncio.wait_for(client.logout(), IMAP_TIMEOUT)
+            except Exception:
+                pass
+
+    async def _set_live(self, account_id: str, live: bool):
+        """Record in Mongo whether the account has an IDLE session, so every worker stops or resumes polling it"""
+        if live:
+            self._live.add(account_id)
+            update = {"$set": {"imap_live_until": datetime.utcnow() + timedelta(seconds=IMAP_LIVE_SECONDS)}}
+        elif account_id in self._live:
+            self._live.discard(account_id)
+            update = {"$unset": {"imap_live_until": ""}}
+        else:
+            return
+        try:
+            await email_accounts_collection.update_one({"id": account_id}, update)
+        except Exception:
+            # Left set, it lapses after IMAP_LIVE_SECONDS
+            logger.exception("Failed to record IMAP session state for account %s", account_id)
+
+    async def _fetch_new(self, client: aioimaplib.IMAP4, account: Dict, uidvalidity: int, last_uid: int) -> int:
+        """Ingest messages with UIDs above last_uid in batches; returns the new high-water UID"""
+        while True:
+            listing = await self._command("uid fetch", client.uid("fetch", f"{last_uid + 1}:*", "(UID)"))
+            # `n:*` always matches the highest UID, even when it is below n
+            uids = sorted(message.uid for message in parse_fetch(listing.lines) if message.uid > last_uid)
+            arrived = _has_exists(listing.lines)
+            for start in range(0, len(uids), IMAP_FETCH_BATCH):
+                first, last = uids[start], uids[min(start + IMAP_FETCH_BATCH, len(uids)) - 1]
+                response = await self._command("uid fetch", client.uid("fetch", f"{first}:{last}", FETCH_ITEMS))
+                arrived = arrived or _has_exists(response.lines)
+                # Messages expunged since the listing are simply missing here
+                batch = [message for message in parse_fetch(response.lines) if first <= message.uid <= last]
+                if batch:
+                    await store_messages(account, [message.to_provider_message(uidvalidity) for message in batch])
+                    IMAP_MESSAGES_INGESTED.inc(amount=len(batch))
+                last_uid = last
+                synced_at = datetime.utcnow()
+                await email_accounts_collection.update_one(
+                    {"id": account["id"]},
+                    {"$set": {"imap_uidvalidity": uidvalidity, "imap_last_uid": last_uid, "last_synced_at": synced_at}}
+                )
+                account["imap_uidvalidity"] = uidvalidity
+                account["imap_last_uid"] = last_uid
+                account["last_synced_at"] = synced_at
+            # Mail that arrived while we were fetching is announced in the fetch responses, not during IDLE
+            if not uids or not arrived:
+                return last_uid
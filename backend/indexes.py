@@ -0,0 +1,228 @@
+"""Index declarations for the StartupMail collections.
+
+`ensure_indexes` applies every declared index idempotently at startup and
+`verify_indexes` explains each hot query to make sure none of them falls
+back to a collection scan. Run `python indexes.py --check` to do both.
+"""
+import logging
+import sys
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import DuplicateKeyError
+
+from database import get_db
+
+logger = logging.getLogger(__name__)
+
+# Collection name -> indexes backing the queries in server.py
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "sessions": [
+        IndexModel([("session_token", ASCENDING)], name="session_token_unique", unique=True),
+        # Mongo's TTL monitor removes sessions once expires_at has passed
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "email_accounts": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("is_primary", DESCENDING)], name="user_primary"),
+    ],
+    "emails": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("folder", ASCENDING), ("received_at", DESCENDING), ("id", DESCENDING)],
+                   name="user_folder_received_page"),
+        IndexModel([("account_id", ASCENDING), ("folder", ASCENDING), ("received_at", DESCENDING), ("id", DESCENDING)],
+                   name="account_folder_received_page"),
+        # Inverted index for exact and prefix search terms
+        IndexModel([("user_id", ASCENDING), ("search_tokens", ASCENDING)], name="user_search_tokens"),
+        IndexModel(
+            [("user_id", ASCENDING), ("subject", TEXT), ("body", TEXT), ("from", TEXT),
+             ("from_email", TEXT), ("to", TEXT), ("labels", TEXT)],
+            name="search_text",
+            weights={"subject": 10, "from": 5, "from_email": 5, "to": 5, "labels": 5, "body": 1}
+        ),
+        # Synced messages are upserted by their provider id; sent mail has none
+        IndexModel([("account_id", ASCENDING), ("provider_message_id", ASCENDING)],
+                   name="account_provider_message_unique", unique=True,
+                   partialFilterExpression={"provider_message_id": {"$exists": True}}),
+        IndexModel([("user_id", ASCENDING), ("thread_id", ASCENDING)], name="user_thread"),
+        # Resolves In-Reply-To/References to the thread of the referenced message
+        IndexModel([("user_id", ASCENDING), ("message_id", ASCENDING)], name="user_message_id"),
+        # Sender reputation for priority and spam scoring
+        IndexModel([("user_id", ASCENDING), ("from", ASCENDING)], name="user_sender"),
+        IndexModel([("user_id", ASCENDING), ("to", ASCENDING)], name="user_recipient"),
+        # Recent mail across folders, the scoring models' training sample
+        IndexModel([("user_id", ASCENDING), ("received_at", DESCENDING)], name="user_received"),
+    ],
+    "threads": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("last_activity", DESCENDING), ("id", DESCENDING)],
+                   name="user_activity_page"),
+        IndexModel([("user_id", ASCENDING), ("folders", ASCENDING), ("last_activity", DESCENDING), ("id", DESCENDING)],
+                   name="user_folder_activity_page"),
+        IndexModel([("user_id", ASCENDING), ("subject_key", ASCENDING), ("last_activity", DESCENDING)],
+                   name="user_subject_recent"),
+    ],
+    "drafts": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("updated_at", DESCENDING), ("id", DESCENDING)],
+                   name="user_updated_page"),
+    ],
+    "templates": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+                   name="user_created_page"),
+    ],
+    "campaigns": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+                   name="user_created_page"),
+        IndexModel([("status", ASCENDING), ("schedule_at", ASCENDING)], name="status_schedule"),
+        IndexModel([("status", ASCENDING), ("lease_expires_at", ASCENDING)], name="status_lease"),
+    ],
+    "scheduled_emails": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("send_at", ASCENDING)], name="status_send_at"),
+        IndexModel([("status", ASCENDING), ("lease_expires_at", ASCENDING)], name="status_lease"),
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("send_at", DESCENDING), ("id", DESCENDING)],
+                   name="user_status_send_page"),
+    ],
+    "filters": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("created_at", ASCENDING)], name="user_created"),
+    ],
+    "attachments": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "attachment_blobs": [
+        IndexModel([("sha256", ASCENDING)], name="sha256_unique", unique=True),
+    ],
+    "analytics_totals": [
+        IndexModel([("user_id", ASCENDING)], name="user_unique", unique=True),
+    ],
+    "analytics_daily": [
+        IndexModel([("user_id", ASCENDING), ("date", DESCENDING)], name="user_date_unique", unique=True),
+    ],
+    "analytics_recipients": [
+        IndexModel([("user_id", ASCENDING), ("email", ASCENDING)], name="user_email_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("count", DESCENDING)], name="user_top_count"),
+    ],
+    "cluster_events": [
+        # Workers only read new events off the change stream; old ones just need to go away
+        IndexModel([("created_at", ASCENDING)], name="created_ttl", expireAfterSeconds=3600),
+    ],
+    "leases": [
+        IndexModel([("name", ASCENDING)], name="name_unique", unique=True),
+    ],
+}
+
+# (collection, filter, sort) for every query on a request path
+HOT_QUERIES: List[Tuple[str, Dict[str, Any], Optional[List[Tuple[str, int]]]]] = [
+    ("sessions", {"session_token": "x"}, None),
+    ("users", {"id": "x"}, None),
+    ("users", {"email": "x"}, None),
+    ("email_accounts", {"id": "x", "user_id": "x"}, None),
+    ("email_accounts", {"user_id": "x"}, None),
+    ("email_accounts", {"user_id": "x", "is_primary": True}, None),
+    ("emails", {"user_id": "x", "folder": "inbox"}, [("received_at", DESCENDING), ("id", DESCENDING)]),
+    ("emails", {"user_id": "x", "folder": "inbox", "account_id": "x"}, [("received_at", DESCENDING), ("id", DESCENDING)]),
+    ("emails", {"account_id": "x", "provider_message_id": "x"}, None),
+    ("emails", {"account_id": "x", "provider_message_id": {"$in": ["x"]}}, None),
+    ("emails", {"user_id": "x", "search_tokens": {"$all": ["x"]}}, None),
+    ("emails", {"user_id": "x", "search_tokens": {"$regex": "^x"}}, None),
+    ("emails", {"user_id": "x", "thread_id": {"$in": ["x"]}}, None),
+    ("emails", {"user_id": "x", "message_id": {"$in": ["x"]}, "thread_id": {"$exists": True}}, None),
+    ("emails", {"user_id": "x", "from": {"$in": ["x"]}, "folder": {"$ne": "sent"}}, None),
+    ("emails", {"user_id": "x", "folder": "sent", "to": {"$in": ["x"]}}, None),
+    ("emails", {"user_id": "x", "folder": {"$ne": "sent"}}, [("received_at", DESCENDING)]),
+    ("threads", {"id": "x", "user_id": "x"}, None),
+    ("threads", {"user_id": "x"}, [("last_activity", DESCENDING), ("id", DESCENDING)]),
+    ("threads", {"user_id": "x", "folders": "inbox"}, [("last_activity", DESCENDING), ("id", DESCENDING)]),
+    ("threads", {"user_id": "x", "subject_key": {"$in": ["x"]}, "last_activity": {"$gte": datetime.utcnow()}},
+     [("last_activity", DESCENDING)]),
+    ("drafts", {"id": "x", "user_id": "x"}, None),
+    ("drafts", {"user_id": "x"}, [("updated_at", DESCENDING), ("id", DESCENDING)]),
+    ("templates", {"id": "x", "user_id": "x"}, None),
+    ("templates", {"user_id": "x"}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("campaigns", {"id": "x", "user_id": "x"}, None),
+    ("campaigns", {"user_id": "x"}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("campaigns", {"status": "scheduled", "schedule_at": {"$lte": datetime.utcnow()}}, [("schedule_at", ASCENDING)]),
+    ("campaigns", {"status": "sending", "lease_expires_at": {"$lt": datetime.utcnow()}}, None),
+    ("scheduled_emails", {"id": "x", "user_id": "x", "status": "scheduled"}, None),
+    ("scheduled_emails", {"id": {"$in": ["x"]}, "status": "scheduled", "send_at": {"$lte": datetime.utcnow()}}, None),
+    ("scheduled_emails", {"status": "scheduled", "send_at": {"$lt": datetime.utcnow()}}, [("send_at", ASCENDING)]),
+    ("scheduled_emails", {"status": "sending", "lease_expires_at": {"$lt": datetime.utcnow()}}, None),
+    ("scheduled_emails", {"user_id": "x", "status": "scheduled"}, [("send_at", DESCENDING), ("id", DESCENDING)]),
+    ("filters", {"user_id": "x", "enabled": {"$ne": False}}, [("created_at", ASCENDING)]),
+    ("attachments", {"id": "x", "user_id": "x"}, None),
+    ("attachments", {"id": {"$in": ["x"]}, "user_id": "x"}, None),
+    ("attachment_blobs", {"sha256": "x"}, None),
+    ("analytics_totals", {"user_id": "x"}, None),
+    ("analytics_daily", {"user_id": "x", "date": {"$gte": "2000-01-01"}}, None),
+    ("analytics_recipients", {"user_id": "x"}, [("count", DESCENDING)]),
+    ("leases", {"name": "x", "$or": [{"holder": "x"}, {"expires_at": {"$lt": datetime.utcnow()}}]}, None),
+]
+
+
+def ensure_indexes(database=None) -> Dict[str, List[str]]:
+    """Create any missing indexes; create_indexes is a no-op for ones that already exist.
+
+    A unique index that existing duplicate documents keep from building is
+    logged and skipped rather than aborting startup; it is built on the
+    first start after the duplicates are removed.
+    """
+    database = get_db() if database is None else database
+    created = {}
+    for collection_name, indexes in INDEXES.items():
+        collection = database[collection_name]
+        created[collection_name] = []
+        # One index per call, so a failed unique build does not take the others down with it
+        for index in indexes:
+            try:
+                created[collection_name].extend(collection.create_indexes([index]))
+            except DuplicateKeyError as e:
+                logger.error(
+                    "Index %s.%s not built, existing documents have duplicate keys: %s",
+                    collection_name, index.document["name"], e
+                )
+    return created
+
+
+def _plan_stages(plan: Dict) -> List[str]:
+    stages = [plan.get("stage")]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages.extend(_plan_stages(child))
+    return stages
+
+
+def verify_indexes(database=None) -> None:
+    """Explain every hot query and raise RuntimeError if any winning plan is a COLLSCAN"""
+    database = get_db() if database is None else database
+    failures = []
+    for collection_name, query, sort in HOT_QUERIES:
+        cursor = database[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _plan_stages(winning_plan):
+            failures.append(f"{collection_name}.find({query}){' sorted by ' + str(sort) if sort else ''}")
+
+    if failures:
+        raise RuntimeError("Queries without index support:\n  " + "\n  ".join(failures))
+
+
+if __name__ == "__main__":
+    for collection_name, names in ensure_indexes().items():
+        print(f"{collection_name}: {', '.join(names)}")
+    if "--check" in sys.argv:
+        try:
+            verify_indexes()
+        except RuntimeError as e:
+            print(e)
+            sys.exit(1)
+        print("All hot queries are index-backed")
@@ -0,0 +1,201 @@
+"""Incremental inbox sync into the local mail store.
+
+Each connected account keeps a provider sync cursor (`sync_cursor`, e.g. a
+Gmail history id) and `last_synced_at` on its email_accounts document.
+A sync asks the provider only for changes since that cursor and upserts
+them into emails_collection, so inbox reads become indexed local queries
+instead of a full mailbox refetch per page view. The user's filters are
+applied to each message as it is written, after the batch is scored for
+priority and spam (scoring.py), new messages are threaded
+(conversations.py), and connected clients are notified of new mail. Accounts ingested over IMAP IDLE (imap_ingest.py)
+share store_messages but are never polled.
+
+Concurrent inbox requests (or workers) can all find the same account
+stale, so a sync first claims the account with a conditional update that
+sets `sync_claim_id`/`syncing_until` only while the account is still stale
+and unclaimed. Whoever loses the claim skips the sync and reads the local
+store; the winner syncs from the cursor on the claimed document and clears
+the claim. A claim left by a crashed worker lapses after SYNC_CLAIM_SECONDS.
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Sequence, Tuple
+
+from pymongo import UpdateOne
+
+from analytics import record_received
+from conversations import assign_threads, refresh_threads
+from database import email_accounts_collection, emails_collection
+from filters import RuleSet, get_rule_set
+from messages import ProviderMessage
+from notifications import mail_notifier
+from scoring import (
+    MODEL_REFRESH_SECONDS, PRIORITY_THRESHOLD, SPAM_THRESHOLD, invalidate_user_model, observe, score_messages
+)
+from search import search_tokens
+
+INBOX_SYNC_INTERVAL = float(os.environ.get('INBOX_SYNC_INTERVAL', '30'))
+# How long a sync may hold its claim on an account before another request may take over
+SYNC_CLAIM_SECONDS = float(os.environ.get('SYNC_CLAIM_SECONDS', '120'))
+
+# Provider fields copied onto the stored message on every sync
+SYNCED_FIELDS = ("from", "subject", "body", "received_at", "is_read", "is_important", "labels", "attachments")
+
+
+def needs_sync(account: Dict, force: bool = False) -> bool:
+    last_synced_at = account.get("last_synced_at")
+    if force or last_synced_at is None:
+        return True
+    return datetime.utcnow() - last_synced_at >= timedelta(seconds=INBOX_SYNC_INTERVAL)
+
+
+def _stored_fields(message: ProviderMessage, rule_set: RuleSet, priority: float, spam: float) -> Tuple[Dict, str]:
+    """The synced fields of a message and the folder it is filed in when new"""
+    fields = {field: message[field] for field in SYNCED_FIELDS}
+    fields["is_important"] = message.is_important or priority >= PRIORITY_THRESHOLD
+    fields["priority_score"] = round(priority, 4)
+    fields["spam_score"] = round(spam, 4)
+    # Filters win over the scores
+    changes = rule_set.apply(fields)
+    # Filters and spam scoring only file new messages, so later syncs never undo a manual move
+    folder = changes.pop("folder", "spam" if spam >= SPAM_THRESHOLD else "inbox")
+    fields.update(changes)
+    fields["search_tokens"] = search_tokens(fields)
+    return fields, folder
+
+
+def _upsert(account: Dict, message: ProviderMessage, fields: Dict, folder: str, thread_id: Optional[str]) -> UpdateOne:
+    if thread_id:
+        # Only set for messages not threaded yet; a message never changes thread on resync
+        fields = dict(fields, thread_id=thread_id)
+    return UpdateOne(
+        {"account_id": account["id"], "provider_message_id": message["id"]},
+        {
+            "$set": fields,
+            "$setOnInsert": {
+                "id": str(uuid.uuid4()),
+                "user_id": account["user_id"],
+                "account_id": account["id"],
+                "account_email": account["email"],
+                "provider": account["provider"],
+                "provider_message_id": message["id"],
+                "message_id": message.message_id,
+                "in_reply_to": message.in_reply_to,
+                "references": list(message.references),
+                "folder": folder
+            }
+        },
+        upsert=True
+    )
+
+
+async def store_messages(account: Dict, messages: Sequence[ProviderMessage]) -> int:
+    """Upsert provider messages into the local store; returns how many were new"""
+    if not messages:
+        return 0
+    user_id = account["user_id"]
+    existing = {
+        doc["provider_message_id"]: doc.get("thread_id")
+        for doc in await emails_collection.find(
+            {"account_id": account["id"], "provider_message_id": {"$in": [message.id for message in messages]}},
+            {"_id": 0, "provider_message_id": 1, "thread_id": 1}
+        ).to_list()
+    }
+    docs = [
+        {
+            "provider_message_id": message.id,
+            "from": message.sender,
+            "subject": message.subject,
+            "body": message.body,
+            "labels": message.labels,
+            "received_at": message.received_at,
+            "message_id": message.message_id,
+            "in_reply_to": message.in_reply_to,
+            "references": message.references
+        }
+        for message in messages
+    ]
+    unthreaded = [doc for doc in docs if not existing.get(doc["provider_message_id"])]
+    await assign_threads(user_id, unthreaded)
+    new_threads = {doc["provider_message_id"]: doc["thread_id"] for doc in unthreaded}
+
+    # One scoring pass for the whole batch
+    (priorities, spam_scores), rule_set = await asyncio.gather(score_messages(user_id, docs), get_rule_set(user_id))
+    stored = [
+        _stored_fields(message, rule_set, float(priority), float(spam))
+        for message, priority, spam in zip(messages, priorities, spam_scores)
+    ]
+    result = await emails_collection.bulk_write([
+        _upsert(account, message, fields, folder, new_threads.get(message.id))
+        for message, (fields, folder) in zip(messages, stored)
+    ], ordered=False)
+    observe(user_id, (
+        dict(fields, folder=folder) for message, (fields, folder) in zip(messages, stored) if message.id not in existing
+    ))
+    # Resynced messages can change read state, so their threads are refreshed too
+    await refresh_threads(user_id, list(new_threads.values()) + list(existing.values()))
+    await record_received(user_id, [messages[index].received_at for index in result.upserted_ids])
+    if result.upserted_count or result.modified_count:
+        # New mail and changed read state are training data; retrain at most once per refresh interval
+        await invalidate_user_model(user_id, MODEL_REFRESH_SECONDS)
+    if result.upserted_count:
+        await mail_notifier.notify(user_id, {
+            "type": "new_mail",
+            "account_id": account["id"],
+            "count": result.upserted_count
+        })
+    return result.upserted_count
+
+
+async def claim_sync(account_id: str, claim_id: str, force: bool = False) -> Optional[Dict]:
+    """Claim the account's next sync; the account document as claimed, None while it is fresh or claimed"""
+    now = datetime.utcnow()
+    query = {
+        "id": account_id,
+        "$or": [{"syncing_until": {"$exists": False}}, {"syncing_until": {"$lt": now}}]
+    }
+    if not force:
+        stale_before = now - timedelta(seconds=INBOX_SYNC_INTERVAL)
+        query = {"$and": [
+            query,
+            {"$or": [{"last_synced_at": None}, {"last_synced_at": {"$lte": stale_before}}]}
+        ]}
+    return await email_accounts_collection.find_one_and_update(
+        query,
+        {"$set": {"sync_claim_id": claim_id, "syncing_until": now + timedelta(seconds=SYNC_CLAIM_SECONDS)}},
+        projection={"sync_cursor": 1}
+    )
+
+
+async def sync_account(account: Dict, provider, force: bool = False) -> int:
+    """Pull changes since the account's cursor into the local store; returns messages written.
+
+    Returns 0 without calling the provider when another request holds the
+    sync or has just finished one.
+    """
+    claim_id = uuid.uuid4().hex
+    claimed = await claim_sync(account["id"], claim_id, force)
+    if claimed is None:
+        return 0
+    claim = {"id": account["id"], "sync_claim_id": claim_id}
+    release = {"$unset": {"sync_claim_id": "", "syncing_until": ""}}
+    try:
+        # The claimed document's cursor, not the caller's copy, which a concurrent sync may have advanced
+        changes = await provider.get_changes(account["access_token"], claimed.get("sync_cursor"))
+        messages = changes["messages"]
+        await store_messages(account, messages)
+    except BaseException:
+        await email_accounts_collection.update_one(claim, release)
+        raise
+
+    synced_at = datetime.utcnow()
+    # Conditional on the claim, so a sync whose claim lapsed cannot move the cursor back
+    await email_accounts_collection.update_one(
+        claim,
+        {"$set": {"sync_cursor": changes["cursor"], "last_synced_at": synced_at}, **release}
+    )
+    account["sync_cursor"] = changes["cursor"]
+    account["last_synced_at"] = synced_at
+    return len(messages)
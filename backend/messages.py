@@ -0,0 +1,74 @@
+"""Provider message records and per-request account views.
+
+Provider messages are immutable and shared: the same record is handed to
+every request (and every account on a mock provider). Account metadata is
+attached through AccountMessageView, which references the record instead
+of copying or mutating it, so concurrent requests cannot see each other's
+attribution and message bodies are never duplicated.
+"""
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+
+@dataclass(frozen=True, slots=True)
+class ProviderMessage:
+    id: str
+    history_id: int
+    sender: str
+    subject: str
+    body: str
+    received_at: datetime
+    is_read: bool = False
+    is_important: bool = False
+    labels: Tuple[str, ...] = ()
+    attachments: Tuple[Dict[str, Any], ...] = field(default=())
+    # RFC 5322 threading headers, when the provider exposes them
+    message_id: Optional[str] = None
+    in_reply_to: Optional[str] = None
+    references: Tuple[str, ...] = ()
+
+    def __getitem__(self, key: str) -> Any:
+        return getattr(self, "sender" if key == "from" else key)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "from": self.sender,
+            "subject": self.subject,
+            "body": self.body,
+            "received_at": self.received_at,
+            "is_read": self.is_read,
+            "is_important": self.is_important,
+            "labels": list(self.labels),
+            "attachments": list(self.attachments)
+        }
+
+
+class AccountMessageView:
+    """A provider message as seen through one connected account"""
+
+    __slots__ = ("message", "account_id", "account_email", "provider")
+
+    def __init__(self, message: ProviderMessage, account: Dict[str, Any]):
+        self.message = message
+        self.account_id = account["id"]
+        self.account_email = account["email"]
+        self.provider = account["provider"]
+
+    @property
+    def received_at(self) -> datetime:
+        return self.message.received_at
+
+    def __getitem__(self, key: str) -> Any:
+        if key in ("account_id", "account_email", "provider"):
+            return getattr(self, key)
+        return self.message[key]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Response dict; strings such as the body are shared with the record, not copied"""
+        data = self.message.to_dict()
+        data["account_id"] = self.account_id
+        data["account_email"] = self.account_email
+        data["provider"] = self.provider
+        return data
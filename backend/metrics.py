@@ -0,0 +1,307 @@
+"""Request-level performance instrumentation.
+
+MetricsMiddleware times every HTTP request and keeps a per-request
+RequestStats in a context variable. The pymongo CommandListener and the
+provider call decorator add their timings both to process-wide histograms
+and to the current request's stats, so a slow request log line shows
+where its time went (e.g. 40 `find emails` commands reveal an N+1 loop).
+Everything is rendered in the Prometheus text format by render_metrics().
+"""
+import functools
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '500'))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels, rendered in the Prometheus text format"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], buckets: Sequence[float]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def sum(self, *labels: str) -> float:
+        series = self._series.get(labels)
+        return series[1] if series else 0.0
+
+    def _labels(self, values: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        for labels, counts, total, count in sorted(series):
+            for bound, bucket_count in zip(self.buckets, counts):
+                bucket_labels = self._labels(labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {bucket_count}")
+            bucket_labels = self._labels(labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {count}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            pairs = ",".join(f'{name}="{_escape(label)}"' for name, label in zip(self.labelnames, labels))
+            lines.append(f"{self.name}{{{pairs}}} {value}" if pairs else f"{self.name} {value}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route", "status"), LATENCY_BUCKETS
+)
+HTTP_REQUEST_MONGO_COMMANDS = Histogram(
+    "http_request_mongo_commands", "MongoDB commands issued per HTTP request", ("route",), COUNT_BUCKETS
+)
+HTTP_REQUEST_MONGO_SECONDS = Histogram(
+    "http_request_mongo_seconds", "Total MongoDB command time per HTTP request", ("route",), LATENCY_BUCKETS
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency", ("command", "collection", "outcome"),
+    LATENCY_BUCKETS
+)
+PROVIDER_CALL_SECONDS = Histogram(
+    "provider_call_duration_seconds", "Email provider call latency", ("provider", "method", "outcome"),
+    LATENCY_BUCKETS
+)
+DRAFT_AUTOSAVES = Counter(
+    "draft_autosave_total", "Draft saves by outcome; unchanged and coalesced saves avoided a write", ("outcome",)
+)
+IMAP_COMMANDS = Counter(
+    "imap_commands_total", "Commands sent by the IMAP ingestion worker", ("command",)
+)
+IMAP_MESSAGES_INGESTED = Counter(
+    "imap_messages_ingested_total", "Messages fetched by the IMAP ingestion worker", ()
+)
+SCHEDULED_DISPATCH_LAG = Histogram(
+    "scheduled_send_dispatch_lag_seconds", "Delay between a scheduled email's send_at and its claim", (),
+    LATENCY_BUCKETS
+)
+SCHEDULED_SENDS = Counter(
+    "scheduled_send_total", "Scheduled emails handled by the send queue, by outcome", ("outcome",)
+)
+CLUSTER_EVENTS = Counter(
+    "cluster_events_total", "Cluster bus messages delivered to this worker, by channel and origin", ("channel", "origin")
+)
+REGISTRY = [
+    HTTP_REQUEST_SECONDS, HTTP_REQUEST_MONGO_COMMANDS, HTTP_REQUEST_MONGO_SECONDS,
+    MONGO_COMMAND_SECONDS, PROVIDER_CALL_SECONDS, DRAFT_AUTOSAVES, IMAP_COMMANDS, IMAP_MESSAGES_INGESTED,
+    SCHEDULED_DISPATCH_LAG, SCHEDULED_SENDS, CLUSTER_EVENTS
+]
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    """Time spent in Mongo and provider calls during one request"""
+
+    __slots__ = ("mongo_commands", "mongo_seconds", "mongo_breakdown", "provider_seconds",
+                 "provider_breakdown", "_lock")
+
+    def __init__(self):
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        # "find emails" -> [count, seconds]
+        self.mongo_breakdown: Dict[str, list] = {}
+        self.provider_seconds = 0.0
+        self.provider_breakdown: Dict[str, list] = {}
+        # Mongo events arrive from database pool threads, possibly several at once
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _add(breakdown: Dict[str, list], key: str, seconds: float):
+        entry = breakdown.get(key)
+        if entry is None:
+            breakdown[key] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def record_mongo(self, key: str, seconds: float):
+        with self._lock:
+            self.mongo_commands += 1
+            self.mongo_seconds += seconds
+            self._add(self.mongo_breakdown, key, seconds)
+
+    def record_provider(self, key: str, seconds: float):
+        with self._lock:
+            self.provider_seconds += seconds
+            self._add(self.provider_breakdown, key, seconds)
+
+    def summary(self) -> str:
+        def describe(breakdown):
+            ordered = sorted(breakdown.items(), key=lambda item: item[1][1], reverse=True)
+            return ", ".join(f"{key} x{count} {seconds * 1000:.1f}ms" for key, (count, seconds) in ordered)
+        return (
+            f"mongo {self.mongo_commands} cmds {self.mongo_seconds * 1000:.1f}ms [{describe(self.mongo_breakdown)}]; "
+            f"provider {self.provider_seconds * 1000:.1f}ms [{describe(self.provider_breakdown)}]"
+        )
+
+
+_current_request: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def current_request_stats() -> Optional[RequestStats]:
+    return _current_request.get()
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every Mongo command and charges it to the request that issued it"""
+
+    def __init__(self):
+        # (connection, request id) -> (command key, request stats)
+        self._pending: Dict[tuple, Tuple[str, Optional[RequestStats]]] = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        key = f"{event.command_name} {target}" if isinstance(target, str) else event.command_name
+        self._pending[(event.connection_id, event.request_id)] = (key, _current_request.get())
+
+    def _finish(self, event, outcome: str):
+        key, stats = self._pending.pop((event.connection_id, event.request_id), (event.command_name, None))
+        seconds = event.duration_micros / 1e6
+        command, _, collection = key.partition(" ")
+        MONGO_COMMAND_SECONDS.observe(seconds, command, collection, outcome)
+        if stats is not None:
+            stats.record_mongo(key, seconds)
+
+    def succeeded(self, event):
+        self._finish(event, "ok")
+
+    def failed(self, event):
+        self._finish(event, "error")
+
+
+mongo_command_metrics = MongoCommandMetrics()
+
+
+def timed_provider_call(method):
+    """Decorate an async provider method to record its latency"""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await method(self, *args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            seconds = time.perf_counter() - start
+            provider = self.provider_type.lower()
+            PROVIDER_CALL_SECONDS.observe(seconds, provider, method.__name__, outcome)
+            stats = _current_request.get()
+            if stats is not None:
+                stats.record_provider(f"{provider}.{method.__name__}", seconds)
+    return wrapper
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route latency and logging slow requests with their breakdown"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current_request.set(stats)
+        status_code = 500
+        event_stream = False
+
+        async def send_with_status(message):
+            nonlocal status_code, event_stream
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                content_type = dict(message.get("headers", ())).get(b"content-type", b"")
+                event_stream = content_type.startswith(b"text/event-stream")
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Measured to the end of the body, so streamed responses count in full
+            seconds = time.perf_counter() - start
+            _current_request.reset(token)
+            # FastAPI leaves the matched route in the scope; its template keeps label cardinality bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_SECONDS.observe(seconds, scope["method"], route, str(status_code))
+            HTTP_REQUEST_MONGO_COMMANDS.observe(stats.mongo_commands, route)
+            HTTP_REQUEST_MONGO_SECONDS.observe(stats.mongo_seconds, route)
+            # Event streams stay open by design; their duration is not latency
+            if seconds * 1000 >= SLOW_REQUEST_MS and not event_stream:
+                logger.warning(
+                    "Slow request %s %s -> %s in %.1fms: %s",
+                    scope["method"], route, status_code, seconds * 1000, stats.summary()
+                )
@@ -0,0 +1,78 @@
+"""New-mail notifications pushed to connected clients.
+
+Whenever messages land in the local store (IMAP IDLE ingestion or a
+provider sync) an event is published for the owning user. Each open
+`/api/emails/events` Server-Sent Events stream holds a bounded queue; a
+client that stops reading loses its oldest events rather than growing the
+queue, and can always recover by reloading the inbox. Subscribers live in
+the worker holding their stream, so events are announced on the cluster
+bus and every worker fans them out to its own subscribers.
+"""
+import asyncio
+import os
+from typing import Any, Dict, Set
+
+import orjson
+
+from cluster import cluster_bus
+
+NOTIFY_QUEUE_SIZE = int(os.environ.get('NOTIFY_QUEUE_SIZE', '100'))
+# Comment frames keep proxies from closing idle streams
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', '15'))
+SSE_MEDIA_TYPE = "text/event-stream"
+
+
+class MailNotifier:
+    def __init__(self, queue_size: int = NOTIFY_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+    async def notify(self, user_id: str, event: Dict[str, Any]):
+        """Deliver an event to the user's streams on every worker"""
+        await cluster_bus.publish("mail", {"user_id": user_id, "event": event})
+
+    def publish(self, user_id: str, event: Dict[str, Any]):
+        """Deliver an event to the user's streams on this worker"""
+        for queue in self._subscribers.get(user_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def subscriber_count(self) -> int:
+        return sum(len(queues) for queues in self._subscribers.values())
+
+
+def _frame(event: Dict[str, Any]) -> bytes:
+    return b"event: " + event["type"].encode() + b"\ndata: " + orjson.dumps(event, default=str) + b"\n\n"
+
+
+async def event_stream(notifier: MailNotifier, user_id: str, heartbeat: float = SSE_HEARTBEAT_SECONDS):
+    """SSE frames for one client until it disconnects"""
+    queue = notifier.subscribe(user_id)
+    try:
+        yield b"retry: 5000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+                continue
+            yield _frame(event)
+    finally:
+        notifier.unsubscribe(user_id, queue)
+
+
+mail_notifier = MailNotifier()
+cluster_bus.subscribe("mail", lambda message: mail_notifier.publish(message["user_id"], message["event"]))
@@ -0,0 +1,110 @@
+"""Keyset pagination with opaque cursors.
+
+Lists are ordered newest first on (sort_field, id). A cursor encodes the
+sort value and id of the last item returned, so the next page is a range
+query on a compound index rather than an ever-growing skip.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from database import MONGO_BATCH_SIZE
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# List views leave out the heavy fields; fetch a single document for those
+DRAFT_LIST_PROJECTION = {"_id": 0, "body": 0, "content_hash": 0}
+TEMPLATE_LIST_PROJECTION = {"_id": 0, "body": 0}
+CAMPAIGN_LIST_PROJECTION = {"_id": 0, "recipients": 0}
+# The inbox view still filters on body client-side, so it stays in the list
+EMAIL_LIST_PROJECTION = {"_id": 0, "search_tokens": 0}
+
+
+def encode_cursor(sort_value: datetime, item_id: str) -> str:
+    payload = json.dumps({"t": sort_value.isoformat(), "id": item_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[datetime, str]]:
+    """Decode a cursor, raising a 400 if the client sent something we did not issue"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(payload["t"]), str(payload["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_query(query: Dict, sort_field: str, position: Optional[Tuple[datetime, str]]) -> Dict:
+    """Restrict a query to items strictly after `position` in (sort_field desc, id desc) order"""
+    if position is None:
+        return query
+    sort_value, item_id = position
+    return {
+        **query,
+        "$or": [
+            {sort_field: {"$lt": sort_value}},
+            {sort_field: sort_value, "id": {"$lt": item_id}}
+        ]
+    }
+
+
+def _page(items: List[Dict], sort_field: str, limit: int) -> Dict[str, Any]:
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor(last[sort_field], last["id"])
+    return {"items": items, "next_cursor": next_cursor}
+
+
+async def paginate(
+    collection,
+    query: Dict,
+    sort_field: str,
+    position: Optional[Tuple[datetime, str]],
+    limit: int,
+    projection: Optional[Dict] = None
+) -> Dict[str, Any]:
+    """Fetch one page from a collection, returning {"items", "next_cursor"}"""
+    items = await collection.find(
+        keyset_query(query, sort_field, position),
+        projection
+    ).sort([(sort_field, -1), ("id", -1)]).limit(limit + 1).to_list()
+    return _page(items, sort_field, limit)
+
+
+def stream_query(
+    collection,
+    query: Dict,
+    sort_field: str,
+    position: Optional[Tuple[datetime, str]],
+    projection: Optional[Dict] = None
+):
+    """Cursor over every item after `position`, fetched from Mongo in batches"""
+    return collection.find(
+        keyset_query(query, sort_field, position),
+        projection
+    ).sort([(sort_field, -1), ("id", -1)]).batch_size(MONGO_BATCH_SIZE)
+
+
+def paginate_list(
+    items: List[Dict],
+    sort_field: str,
+    position: Optional[Tuple[datetime, str]],
+    limit: int
+) -> Dict[str, Any]:
+    """Page through an in-memory list already sorted newest first"""
+    if position is not None:
+        sort_value, item_id = position
+        items = [
+            item for item in items
+            if item[sort_field] < sort_value or (item[sort_field] == sort_value and item["id"] < item_id)
+        ]
+    return _page(items[:limit + 1], sort_field, limit)
@@ -0,0 +1,398 @@
+"""Scheduled sending of individual emails.
+
+Scheduled emails are stored in scheduled_emails with their `send_at`
+(indexed together with `status`). Instead of polling Mongo for due items,
+each worker loads the ones due within the next SCHEDULE_WINDOW seconds
+into an in-memory hierarchical timer wheel and reloads that window every
+SCHEDULE_REFILL_INTERVAL, so the database is read once per window no
+matter how many messages are scheduled further out.
+
+When a wheel slot expires the worker claims its items with one
+update_many that only matches items still scheduled and due, and stamps
+them with a claim id and a lease. A claim takes at most as many items as
+the worker has free send slots, and only one claim is in flight at a time;
+items that expire meanwhile wait for the next one. Every worker loads the
+same window, and the conditional claim makes sure each firing is taken by
+only one of them. The lease is renewed while the claim's sends are in
+flight and each item is marked sent as soon as its own send returns. A
+claim whose lease expires (worker crashed mid-send) returns to the queue
+and fires again, which makes delivery at-least-once. Cancelling or
+rescheduling changes the stored item, so a stale wheel entry on another
+worker fails its claim and is dropped.
+"""
+import asyncio
+import logging
+import math
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence, Set, Tuple
+
+from database import scheduled_emails_collection
+from metrics import SCHEDULED_DISPATCH_LAG, SCHEDULED_SENDS
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_TICK = float(os.environ.get('SCHEDULE_TICK', '0.01'))
+SCHEDULE_WINDOW = float(os.environ.get('SCHEDULE_WINDOW', '300'))
+SCHEDULE_REFILL_INTERVAL = float(os.environ.get('SCHEDULE_REFILL_INTERVAL', '60'))
+SCHEDULE_LEASE_SECONDS = float(os.environ.get('SCHEDULE_LEASE_SECONDS', '60'))
+SCHEDULE_SEND_TIMEOUT = float(os.environ.get('SCHEDULE_SEND_TIMEOUT', '30'))
+SCHEDULE_CONCURRENCY = int(os.environ.get('SCHEDULE_CONCURRENCY', '50'))
+SCHEDULE_MAX_ATTEMPTS = int(os.environ.get('SCHEDULE_MAX_ATTEMPTS', '3'))
+SCHEDULE_RETRY_DELAY = float(os.environ.get('SCHEDULE_RETRY_DELAY', '30'))
+# Upper bound on items loaded per refill; the window shrinks to fit
+SCHEDULE_LOAD_LIMIT = 500000
+
+# Slots per wheel level; with 10ms ticks the levels span 2.56s, 164s, 2.9h and 7.8 days
+WHEEL_SLOTS = (256, 64, 64, 64)
+
+SCHEDULED_LIST_PROJECTION = {"_id": 0, "claim_id": 0, "worker_id": 0}
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def as_utc(value: datetime) -> datetime:
+    """Naive UTC datetime, as stored everywhere else, for a possibly timezone-aware one"""
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _timestamp(value: datetime) -> float:
+    return (value - EPOCH).total_seconds()
+
+
+class TimerWheel:
+    """Hierarchical timing wheel: O(1) add and remove, expiry in tick-sized slots.
+
+    Level 0 holds one slot per tick; each higher level holds slots as long
+    as a full turn of the level below. Items far out sit in a coarse slot
+    and cascade down a level whenever that slot comes up, so advancing
+    only ever looks at the current slot of each level.
+    """
+
+    def __init__(self, tick: float = SCHEDULE_TICK, slots: Sequence[int] = WHEEL_SLOTS,
+                 now: Optional[float] = None):
+        self.tick = tick
+        self.sizes = tuple(slots)
+        # Ticks covered by one slot on each level
+        self.spans = [1]
+        for size in self.sizes[:-1]:
+            self.spans.append(self.spans[-1] * size)
+        self.horizon = self.spans[-1] * self.sizes[-1] * tick
+        self.current = int((time.time() if now is None else now) / tick)
+        self.levels: List[List[Dict[Hashable, float]]] = [[{} for _ in range(size)] for size in self.sizes]
+        self._where: Dict[Hashable, Tuple[int, int]] = {}
+        self._expired: List[Tuple[Hashable, float]] = []
+
+    def __len__(self) -> int:
+        return len(self._where) + len(self._expired)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._where
+
+    def _place(self, key: Hashable, deadline: float, due: List[Tuple[Hashable, float]]):
+        expires = math.ceil(deadline / self.tick - 1e-9)
+        if expires <= self.current:
+            due.append((key, deadline))
+            return
+        for level, (span, size) in enumerate(zip(self.spans, self.sizes)):
+            # Slots on this level are distinct from the current one only within one turn
+            if expires // span - self.current // span < size:
+                slot = (expires // span) % size
+                self.levels[level][slot][key] = deadline
+                self._where[key] = (level, slot)
+                return
+        raise ValueError(f"deadline is beyond the wheel's {self.horizon:.0f}s horizon")
+
+    def add(self, key: Hashable, deadline: float):
+        """Schedule `key` at `deadline` (epoch seconds), replacing any earlier entry"""
+        self.remove(key)
+        self._place(key, deadline, self._expired)
+
+    def remove(self, key: Hashable) -> bool:
+        location = self._where.pop(key, None)
+        if location is None:
+            return False
+        level, slot = location
+        del self.levels[level][slot][key]
+        return True
+
+    def next_tick(self) -> float:
+        return (self.current + 1) * self.tick
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Keys whose deadline has passed by `now`, earliest first"""
+        target = int(now / self.tick)
+        due, self._expired = self._expired, []
+        while self.current < target:
+            if not self._where:
+                self.current = target
+                break
+            self.current += 1
+            # Cascade coarse slots first; their items may land in this tick's level-0 slot
+            for level in range(len(self.sizes) - 1, 0, -1):
+                if self.current % self.spans[level] == 0:
+                    slot = self.levels[level][(self.current // self.spans[level]) % self.sizes[level]]
+                    if slot:
+                        items = list(slot.items())
+                        slot.clear()
+                        for key, deadline in items:
+                            del self._where[key]
+                            self._place(key, deadline, due)
+            slot = self.levels[0][self.current % self.sizes[0]]
+            if slot:
+                for key in slot:
+                    del self._where[key]
+                due.extend(slot.items())
+                slot.clear()
+        due.sort(key=lambda entry: entry[1])
+        return [key for key, _ in due]
+
+
+class ScheduledSendQueue:
+    """Fires scheduled emails from a timer wheel loaded with the next window of due items"""
+
+    def __init__(
+        self,
+        send: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+        concurrency: int = SCHEDULE_CONCURRENCY,
+        window: float = SCHEDULE_WINDOW,
+        refill_interval: float = SCHEDULE_REFILL_INTERVAL,
+        tick: float = SCHEDULE_TICK,
+        lease_seconds: float = SCHEDULE_LEASE_SECONDS,
+        max_attempts: int = SCHEDULE_MAX_ATTEMPTS
+    ):
+        self.send = send
+        self.concurrency = concurrency
+        self.window = window
+        self.refill_interval = refill_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.wheel = TimerWheel(tick)
+        # Sends in flight; claims only take as many items as there are free slots
+        self._sending = 0
+        self._capacity = asyncio.Event()
+        # Items due before this were loaded into the wheel by the last refill
+        self._loaded_until = datetime.min
+        self._wake = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._inflight: Set[asyncio.Task] = set()
+        # Fired ids waiting for a claim; one claim runs at a time, so a slow
+        # database gets fewer, larger claims instead of one per tick
+        self._due: List[str] = []
+        self._claiming = False
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._refill_loop()), asyncio.create_task(self._timer_loop())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Claims and sends in flight finish; anything unclaimed stays scheduled for the next worker
+        while self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    def track(self, scheduled_id: str, send_at: datetime):
+        """Put a new or rescheduled item on the wheel if it falls in the loaded window"""
+        if send_at < self._loaded_until:
+            self.wheel.add(scheduled_id, _timestamp(send_at))
+            self._wake.set()
+        else:
+            self.wheel.remove(scheduled_id)
+
+    async def cancel(self, user_id: str, scheduled_id: str) -> bool:
+        """Cancel an item that has not been claimed yet"""
+        result = await scheduled_emails_collection.update_one(
+            {"id": scheduled_id, "user_id": user_id, "status": "scheduled"},
+            {"$set": {"status": "cancelled", "cancelled_at": datetime.utcnow()}}
+        )
+        self.wheel.remove(scheduled_id)
+        return result.modified_count == 1
+
+    async def reschedule(self, user_id: str, scheduled_id: str, send_at: datetime) -> bool:
+        """Move an item that has not been claimed yet to a new send time"""
+        send_at = as_utc(send_at)
+        result = await scheduled_emails_collection.update_one(
+            {"id": scheduled_id, "user_id": user_id, "status": "scheduled"},
+            {"$set": {"send_at": send_at, "updated_at": datetime.utcnow()}}
+        )
+        if result.modified_count == 1:
+            self.track(scheduled_id, send_at)
+            return True
+        return False
+
+    async def refill(self):
+        """Requeue abandoned claims and load everything due within the window into the wheel"""
+        now = datetime.utcnow()
+        await scheduled_emails_collection.update_many(
+            {"status": "sending", "lease_expires_at": {"$lt": now}},
+            {"$set": {"status": "scheduled"}, "$unset": {"claim_id": "", "worker_id": "", "lease_expires_at": ""}}
+        )
+        horizon = now + timedelta(seconds=min(self.window, self.wheel.horizon))
+        due = await scheduled_emails_collection.find(
+            {"status": "scheduled", "send_at": {"$lt": horizon}}, {"_id": 0, "id": 1, "send_at": 1}
+        ).sort("send_at", 1).limit(SCHEDULE_LOAD_LIMIT).to_list()
+        for item in due:
+            self.wheel.add(item["id"], _timestamp(item["send_at"]))
+        self._loaded_until = due[-1]["send_at"] if len(due) == SCHEDULE_LOAD_LIMIT else horizon
+        self._wake.set()
+
+    async def _refill_loop(self):
+        while True:
+            try:
+                await self.refill()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Scheduled send refill failed")
+            await asyncio.sleep(self.refill_interval)
+
+    async def _timer_loop(self):
+        while True:
+            if not len(self.wheel):
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.refill_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await asyncio.sleep(max(0.0, self.wheel.next_tick() - time.time()))
+            self.enqueue(self.wheel.advance(time.time()))
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    def enqueue(self, scheduled_ids: List[str]):
+        """Queue fired ids for claiming"""
+        if not scheduled_ids:
+            return
+        self._due.extend(scheduled_ids)
+        if not self._claiming:
+            self._claiming = True
+            self._spawn(self._claim_loop())
+
+    async def _claim_loop(self):
+        try:
+            while self._due:
+                free = self.concurrency - self._sending
+                if free <= 0:
+                    self._capacity.clear()
+                    await self._capacity.wait()
+                    continue
+                batch, self._due = self._due[:free], self._due[free:]
+                await self._dispatch(batch)
+        finally:
+            self._claiming = False
+
+    async def claim(self, scheduled_ids: List[str]) -> List[Dict[str, Any]]:
+        """Take the items that are still scheduled and due; other workers' claims do not match"""
+        now = datetime.utcnow()
+        claim_id = uuid.uuid4().hex
+        result = await scheduled_emails_collection.update_many(
+            {"id": {"$in": scheduled_ids}, "status": "scheduled", "send_at": {"$lte": now}},
+            {
+                "$set": {
+                    "status": "sending",
+                    "claim_id": claim_id,
+                    "worker_id": self.worker_id,
+                    "lease_expires_at": now + timedelta(seconds=self.lease_seconds)
+                },
+                "$inc": {"attempts": 1}
+            }
+        )
+        if not result.modified_count:
+            return []
+        return await scheduled_emails_collection.find(
+            {"id": {"$in": scheduled_ids}, "claim_id": claim_id}, {"_id": 0}
+        ).to_list()
+
+    async def _dispatch(self, scheduled_ids: List[str]):
+        try:
+            claimed = await self.claim(scheduled_ids)
+        except Exception:
+            # Unclaimed items stay scheduled and are reloaded by the next refill
+            logger.exception("Failed to claim %d scheduled emails", len(scheduled_ids))
+            return
+        now = datetime.utcnow()
+        for item in claimed:
+            SCHEDULED_DISPATCH_LAG.observe(max(0.0, (now - item["send_at"]).total_seconds()))
+        if claimed:
+            self._sending += len(claimed)
+            self._spawn(self._deliver_claim(claimed))
+
+    async def _deliver_claim(self, claimed: List[Dict[str, Any]]):
+        """Send one claim's items, keeping its lease alive until the last one is done"""
+        renewal = asyncio.create_task(self._renew_lease(claimed))
+        try:
+            await asyncio.gather(*(self._deliver(item) for item in claimed))
+        finally:
+            renewal.cancel()
+            await asyncio.gather(renewal, return_exceptions=True)
+
+    async def _renew_lease(self, claimed: List[Dict[str, Any]]):
+        claim_id = claimed[0]["claim_id"]
+        scheduled_ids = [item["id"] for item in claimed]
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await scheduled_emails_collection.update_many(
+                    {"id": {"$in": scheduled_ids}, "claim_id": claim_id, "status": "sending"},
+                    {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=self.lease_seconds)}}
+                )
+            except Exception:
+                logger.exception("Failed to renew the lease on claim %s", claim_id)
+
+    async def _deliver(self, item: Dict[str, Any]):
+        try:
+            try:
+                result = await asyncio.wait_for(self.send(item), timeout=SCHEDULE_SEND_TIMEOUT)
+            except Exception as e:
+                await self._failed(item, e)
+                return
+            await self._sent(item, result)
+        except Exception:
+            # The lease runs out and the item is sent again
+            logger.exception("Failed to record the outcome of scheduled email %s", item["id"])
+        finally:
+            self._sending -= 1
+            self._capacity.set()
+
+    async def _sent(self, item: Dict[str, Any], result: Dict[str, Any]):
+        result = await scheduled_emails_collection.update_one(
+            {"id": item["id"], "claim_id": item["claim_id"]},
+            {
+                "$set": {"status": "sent", "sent_at": datetime.utcnow(), "email_id": result.get("id")},
+                "$unset": {"lease_expires_at": ""}
+            }
+        )
+        if result.modified_count:
+            SCHEDULED_SENDS.inc("sent")
+        else:
+            logger.warning("Scheduled email %s was sent after its claim had lapsed", item["id"])
+
+    async def _failed(self, item: Dict[str, Any], error: Exception):
+        reason = "timeout" if isinstance(error, asyncio.TimeoutError) else str(error)
+        if item.get("attempts", 1) >= self.max_attempts:
+            logger.info("Giving up on scheduled email %s after %d attempts: %s", item["id"], item["attempts"], reason)
+            update = {"$set": {"status": "failed", "error": reason}, "$unset": {"lease_expires_at": ""}}
+            SCHEDULED_SENDS.inc("failed")
+        else:
+            retry_at = datetime.utcnow() + timedelta(seconds=SCHEDULE_RETRY_DELAY * 2 ** (item.get("attempts", 1) - 1))
+            update = {
+                "$set": {"status": "scheduled", "send_at": retry_at, "error": reason},
+                "$unset": {"claim_id": "", "worker_id": "", "lease_expires_at": ""}
+            }
+            SCHEDULED_SENDS.inc("retried")
+        result = await scheduled_emails_collection.update_one({"id": item["id"], "claim_id": item["claim_id"]}, update)
+        if result.modified_count and update["$set"]["status"] == "scheduled":
+            self.track(item["id"], update["$set"]["send_at"])
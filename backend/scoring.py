@@ -0,0 +1,396 @@
+"""Priority inbox and spam scoring for incoming mail.
+
+Every batch of messages written by store_messages (provider sync or IMAP
+ingest) is scored in one vectorized pass by two per-user logistic models:
+
+- priority: the chance the user reads the message; above
+  PRIORITY_THRESHOLD it is marked important
+- spam: above SPAM_THRESHOLD a new message is filed in the spam folder.
+  Only mail the user reported (`spam_reported`, set by POST
+  /api/emails/{id}/spam) counts as spam for training and reputation, so
+  the model never learns from its own filing
+
+Features are a few dense sender and message signals plus hashed subject
+tokens and labels:
+
+- sender reputation: how much mail the user has received from the sender,
+  how much of it was read, marked important or reported as spam, and how
+  often the user wrote to them
+- message: reply headers, the Important label, links and shouting in the
+  subject, no-reply style addresses
+
+Sender reputation comes from two aggregations over the user's stored mail
+and is kept in a bounded LRU/TTL cache keyed by (user, sender); a batch
+only queries the senders missing from it, and stored messages update
+cached entries in place. Token features use the hashing trick, so a batch
+is a dense matrix plus (row, bucket) index arrays and scoring is a matrix
+product and one np.bincount.
+
+Models are trained from the user's recent mail, labelled by `is_read` and
+by spam reports, with batch gradient descent in a worker thread and
+cached for MODEL_CACHE_TTL; concurrent requests for a cold user share one
+training run. A spam report retrains the user's models on next use; a sync
+that adds or changes messages does so once the models are older than
+MODEL_REFRESH_SECONDS. Until a user has enough examples of both classes the
+hand-set DEFAULT_WEIGHTS apply.
+"""
+import asyncio
+import os
+import re
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Sequence, Tuple
+
+import numpy as np
+
+from cache import TTLCache
+from cluster import cluster_bus
+from database import emails_collection
+from search import tokenize
+
+PRIORITY_THRESHOLD = float(os.environ.get('PRIORITY_THRESHOLD', '0.6'))
+SPAM_THRESHOLD = float(os.environ.get('SPAM_THRESHOLD', '0.9'))
+SENDER_CACHE_SIZE = int(os.environ.get('SENDER_CACHE_SIZE', '50000'))
+SENDER_CACHE_TTL = float(os.environ.get('SENDER_CACHE_TTL', '3600'))
+MODEL_CACHE_SIZE = int(os.environ.get('MODEL_CACHE_SIZE', '10000'))
+MODEL_CACHE_TTL = float(os.environ.get('MODEL_CACHE_TTL', '21600'))
+MODEL_REFRESH_SECONDS = float(os.environ.get('MODEL_REFRESH_SECONDS', '900'))
+
+# Messages a model is trained on, newest first
+TRAINING_SAMPLE = 5000
+MIN_CLASS_EXAMPLES = 20
+TRAINING_EPOCHS = 100
+LEARNING_RATE = 0.1
+L2_PENALTY = 1e-3
+# Batches at least this large are scored off the event loop
+THREAD_SCORING_MIN = 500
+
+HASH_BUCKETS = 1 << 12
+MAX_SUBJECT_TOKENS = 20
+
+NO_REPLY_RE = re.compile(r"^(?:no-?reply|do-?not-?reply|newsletter|notifications?|marketing|mailer-daemon)\b",
+                         re.IGNORECASE)
+
+# Dense features, in column order
+FEATURES = (
+    "bias", "sender_volume", "sender_read_rate", "sender_important_rate", "sender_spam_rate",
+    "sender_contact", "sender_unknown", "is_reply", "important_label", "no_reply_sender",
+    "subject_shouting", "body_links"
+)
+DENSE = len(FEATURES)
+
+# Cold-start weights for the dense features; token buckets start at zero
+DEFAULT_WEIGHTS = {
+    "priority": {
+        "bias": -0.4, "sender_read_rate": 1.5, "sender_important_rate": 1.5, "sender_contact": 1.2,
+        "sender_unknown": -0.3, "is_reply": 1.5, "important_label": 2.0, "no_reply_sender": -1.5,
+        "subject_shouting": -0.5, "body_links": -0.3
+    },
+    "spam": {
+        "bias": -4.0, "sender_spam_rate": 6.0, "sender_contact": -3.0, "sender_read_rate": -1.0,
+        "sender_unknown": 1.0, "is_reply": -2.0, "important_label": -2.0, "no_reply_sender": 0.5,
+        "subject_shouting": 1.5, "body_links": 0.8
+    }
+}
+
+
+@dataclass
+class SenderStats:
+    """What a user's stored mail says about one sender"""
+    received: int = 0
+    read: int = 0
+    important: int = 0
+    spam: int = 0
+    sent_to: int = 0
+
+    def as_row(self) -> Tuple[int, int, int, int, int]:
+        return self.received, self.read, self.important, self.spam, self.sent_to
+
+
+_reputations = TTLCache(maxsize=SENDER_CACHE_SIZE, ttl=SENDER_CACHE_TTL)
+_models = TTLCache(maxsize=MODEL_CACHE_SIZE, ttl=MODEL_CACHE_TTL)
+_token_buckets: Dict[str, int] = {}
+# user_id -> training in progress, shared by every request for that user
+_training: Dict[str, asyncio.Task] = {}
+
+
+def _bucket(token: str) -> int:
+    # crc32 rather than hash(): buckets must not change with PYTHONHASHSEED between workers
+    bucket = _token_buckets.get(token)
+    if bucket is None:
+        if len(_token_buckets) >= 100000:
+            _token_buckets.clear()
+        bucket = _token_buckets[token] = zlib.crc32(token.encode()) % HASH_BUCKETS
+    return bucket
+
+
+async def sender_reputations(user_id: str, senders: Iterable[str]) -> Dict[str, SenderStats]:
+    """Reputation of each sender for a user, querying only the senders not cached"""
+    reputations, missing = {}, []
+    for sender in set(senders):
+        stats = _reputations.get((user_id, sender))
+        if stats is None:
+            missing.append(sender)
+        else:
+            reputations[sender] = stats
+    if not missing:
+        return reputations
+
+    fetched = {sender: SenderStats() for sender in missing}
+    received, sent = await asyncio.gather(
+        emails_collection.aggregate([
+            {"$match": {"user_id": user_id, "from": {"$in": missing}, "folder": {"$ne": "sent"}}},
+            {"$group": {
+                "_id": "$from",
+                "received": {"$sum": 1},
+                "read": {"$sum": {"$cond": [{"$eq": ["$is_read", True]}, 1, 0]}},
+                "important": {"$sum": {"$cond": [{"$eq": ["$is_important", True]}, 1, 0]}},
+                "spam": {"$sum": {"$cond": [{"$eq": ["$spam_reported", True]}, 1, 0]}}
+            }}
+        ]).to_list(),
+        emails_collection.aggregate([
+            {"$match": {"user_id": user_id, "folder": "sent", "to": {"$in": missing}}},
+            {"$unwind": "$to"},
+            {"$match": {"to": {"$in": missing}}},
+            {"$group": {"_id": "$to", "sent_to": {"$sum": 1}}}
+        ]).to_list()
+    )
+    for row in received:
+        stats = fetched[row["_id"]]
+        stats.received, stats.read, stats.important, stats.spam = \
+            row["received"], row["read"], row["important"], row["spam"]
+    for row in sent:
+        fetched[row["_id"]].sent_to = row["sent_to"]
+    for sender, stats in fetched.items():
+        _reputations.set((user_id, sender), stats)
+    reputations.update(fetched)
+    return reputations
+
+
+def observe(user_id: str, docs: Iterable[Dict[str, Any]]):
+    """Fold newly stored messages into the cached reputations of their senders"""
+    for doc in docs:
+        if doc.get("folder") == "sent":
+            for recipient in doc.get("to") or ():
+                stats = _reputations.get((user_id, recipient))
+                if stats is not None:
+                    stats.sent_to += 1
+            continue
+        stats = _reputations.get((user_id, doc.get("from")))
+        if stats is not None:
+            stats.received += 1
+            stats.read += bool(doc.get("is_read"))
+            stats.important += bool(doc.get("is_important"))
+            stats.spam += doc.get("spam_reported") is True
+
+
+async def forget_sender(user_id: str, sender: str):
+    """Drop a sender's cached reputation on every worker, e.g. after a spam report"""
+    await cluster_bus.publish("scoring", {"user_id": user_id, "sender": sender})
+
+
+def _on_scoring_message(message: Dict[str, Any]):
+    if "sender" in message:
+        _reputations.invalidate((message["user_id"], message["sender"]))
+        return
+    model = _models.get(message["user_id"])
+    if model is not None and time.monotonic() - model.trained_at >= message["min_age"]:
+        _models.invalidate(message["user_id"])
+
+
+cluster_bus.subscribe("scoring", _on_scoring_message)
+
+
+class FeatureBatch:
+    """Features of n messages: an (n, DENSE) matrix plus (row, bucket) pairs for hashed tokens"""
+
+    __slots__ = ("dense", "rows", "buckets")
+
+    def __init__(self, dense: np.ndarray, rows: np.ndarray, buckets: np.ndarray):
+        self.dense = dense
+        self.rows = rows
+        self.buckets = buckets
+
+    def __len__(self) -> int:
+        return self.dense.shape[0]
+
+    def dot(self, weights: np.ndarray) -> np.ndarray:
+        return self.dense @ weights[:DENSE] + \
+            np.bincount(self.rows, weights=weights[DENSE:][self.buckets], minlength=len(self))
+
+    def dot_transposed(self, values: np.ndarray) -> np.ndarray:
+        return np.concatenate((
+            self.dense.T @ values,
+            np.bincount(self.buckets, weights=values[self.rows], minlength=HASH_BUCKETS)
+        ))
+
+
+def extract_features(docs: Sequence[Dict[str, Any]], reputations: Dict[str, SenderStats],
+                     exclude_self: bool = False) -> FeatureBatch:
+    """Feature batch for message documents; `exclude_self` removes each message from its sender's stats"""
+    n = len(docs)
+    senders = [doc.get("from") or "" for doc in docs]
+    unique_senders, sender_index = np.unique(np.array(senders, dtype=object), return_inverse=True)
+    known = np.array([
+        reputations[sender].as_row() if sender in reputations else (0, 0, 0, 0, 0) for sender in unique_senders
+    ], dtype=np.float64).reshape(-1, 5)
+    received, read, important, spam, sent_to = known[sender_index].T
+
+    subjects = [doc.get("subject") or "" for doc in docs]
+    if exclude_self:
+        received = received - 1
+        read = read - np.fromiter((bool(doc.get("is_read")) for doc in docs), np.float64, n)
+        important = important - np.fromiter((bool(doc.get("is_important")) for doc in docs), np.float64, n)
+        spam = spam - np.fromiter((doc.get("spam_reported") is True for doc in docs), np.float64, n)
+        received = np.maximum(received, 0)
+
+    dense = np.empty((n, DENSE))
+    dense[:, 0] = 1.0
+    dense[:, 1] = np.log1p(received) / 5
+    # Smoothed toward the prior for little-known senders
+    dense[:, 2] = (read + 1) / (received + 2)
+    dense[:, 3] = important / (received + 2)
+    dense[:, 4] = spam / (received + 2)
+    dense[:, 5] = np.minimum(np.log1p(sent_to), 3) / 3
+    dense[:, 6] = (received == 0) & (sent_to == 0)
+    dense[:, 7] = np.fromiter((bool(doc.get("in_reply_to")) for doc in docs), np.float64, n)
+    dense[:, 8] = np.fromiter(
+        (any(label.lower() == "important" for label in doc.get("labels") or ()) for doc in docs), np.float64, n
+    )
+    dense[:, 9] = np.fromiter((NO_REPLY_RE.match(sender) is not None for sender in senders), np.float64, n)
+    dense[:, 10] = np.fromiter(
+        (subject.count("!") > 1 or (len(subject) > 8 and subject.isupper()) for subject in subjects), np.float64, n
+    )
+    dense[:, 11] = np.minimum(np.fromiter(
+        ((doc.get("body") or "").count("http") for doc in docs), np.float64, n
+    ), 10) / 10
+
+    rows, tokens = [], []
+    for row, doc in enumerate(docs):
+        words = tokenize(subjects[row])[:MAX_SUBJECT_TOKENS]
+        words.extend(f"label:{label.lower()}" for label in doc.get("labels") or ())
+        words.append(f"domain:{senders[row].rpartition('@')[2].lower()}")
+        rows.extend([row] * len(words))
+        tokens.extend(words)
+    return FeatureBatch(
+        dense,
+        np.array(rows, dtype=np.intp),
+        np.fromiter((_bucket(token) for token in tokens), np.intp, len(tokens))
+    )
+
+
+def _sigmoid(z: np.ndarray) -> np.ndarray:
+    return 1 / (1 + np.exp(-np.clip(z, -30, 30)))
+
+
+def default_weights(kind: str) -> np.ndarray:
+    weights = np.zeros(DENSE + HASH_BUCKETS)
+    for name, value in DEFAULT_WEIGHTS[kind].items():
+        weights[FEATURES.index(name)] = value
+    return weights
+
+
+def train(features: FeatureBatch, labels: np.ndarray, initial: np.ndarray) -> np.ndarray:
+    """L2-regularized logistic regression by full-batch gradient descent, starting from `initial`"""
+    weights = initial.copy()
+    n = len(features)
+    # Token buckets are sparse, so they get per-bucket step sizes from their frequency
+    counts = np.concatenate((np.full(DENSE, float(n)), np.bincount(features.buckets, minlength=HASH_BUCKETS)))
+    step = LEARNING_RATE * n / np.maximum(counts, 1.0)
+    for _ in range(TRAINING_EPOCHS):
+        error = _sigmoid(features.dot(weights)) - labels
+        gradient = features.dot_transposed(error) / n + L2_PENALTY * weights
+        weights -= step * gradient
+    return weights
+
+
+class UserModel:
+    """A user's priority and spam weight vectors"""
+
+    __slots__ = ("priority", "spam", "trained_on", "trained_at")
+
+    def __init__(self, priority: np.ndarray, spam: np.ndarray, trained_on: int = 0):
+        self.priority = priority
+        self.spam = spam
+        self.trained_on = trained_on
+        self.trained_at = time.monotonic()
+
+    def predict(self, features: FeatureBatch) -> Tuple[np.ndarray, np.ndarray]:
+        return _sigmoid(features.dot(self.priority)), _sigmoid(features.dot(self.spam))
+
+
+DEFAULT_MODEL = UserModel(default_weights("priority"), default_weights("spam"))
+
+TRAINING_PROJECTION = {
+    "_id": 0, "from": 1, "subject": 1, "body": 1, "labels": 1, "in_reply_to": 1,
+    "is_read": 1, "is_important": 1, "spam_reported": 1
+}
+
+
+def fit_user_model(docs: Sequence[Dict[str, Any]], reputations: Dict[str, SenderStats]) -> UserModel:
+    """Train both models on stored messages; a model without enough examples of each class keeps its defaults"""
+    if not docs:
+        return DEFAULT_MODEL
+    features = extract_features(docs, reputations, exclude_self=True)
+    models = {}
+    for kind, labels in (
+        ("priority", np.fromiter((bool(doc.get("is_read")) for doc in docs), np.float64, len(docs))),
+        ("spam", np.fromiter((doc.get("spam_reported") is True for doc in docs), np.float64, len(docs)))
+    ):
+        positives = int(labels.sum())
+        if min(positives, len(docs) - positives) < MIN_CLASS_EXAMPLES:
+            models[kind] = getattr(DEFAULT_MODEL, kind)
+        else:
+            models[kind] = train(features, labels, getattr(DEFAULT_MODEL, kind))
+    return UserModel(models["priority"], models["spam"], trained_on=len(docs))
+
+
+async def _load_user_model(user_id: str) -> UserModel:
+    docs = await emails_collection.find(
+        {"user_id": user_id, "folder": {"$ne": "sent"}}, TRAINING_PROJECTION
+    ).sort("received_at", -1).limit(TRAINING_SAMPLE).to_list()
+    reputations = await sender_reputations(user_id, (doc.get("from") or "" for doc in docs))
+    model = await asyncio.to_thread(fit_user_model, docs, reputations) if docs else DEFAULT_MODEL
+    _models.set(user_id, model)
+    return model
+
+
+async def get_user_model(user_id: str) -> UserModel:
+    """The user's trained models, from cache when possible"""
+    model = _models.get(user_id)
+    if model is not None:
+        return model
+    task = _training.get(user_id)
+    if task is None:
+        task = _training[user_id] = asyncio.create_task(_load_user_model(user_id))
+        task.add_done_callback(lambda _: _training.pop(user_id, None))
+    # A cancelled request must not cancel the training the others wait for
+    return await asyncio.shield(task)
+
+
+async def invalidate_user_model(user_id: str, min_age: float = 0):
+    """Retrain the user's models on next use, on every worker holding ones older than min_age seconds"""
+    await cluster_bus.publish("scoring", {"user_id": user_id, "min_age": min_age})
+
+
+def _predict(model: UserModel, docs: Sequence[Dict[str, Any]],
+             reputations: Dict[str, SenderStats]) -> Tuple[np.ndarray, np.ndarray]:
+    return model.predict(extract_features(docs, reputations))
+
+
+async def score_messages(user_id: str, docs: Sequence[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Priority and spam probabilities for message documents, in one batch"""
+    if not docs:
+        return np.empty(0), np.empty(0)
+    model, reputations = await asyncio.gather(
+        get_user_model(user_id),
+        sender_reputations(user_id, (doc.get("from") or "" for doc in docs))
+    )
+    if len(docs) >= THREAD_SCORING_MIN:
+        return await asyncio.to_thread(_predict, model, docs, reputations)
+    return _predict(model, docs, reputations)
+
+
+def scoring_cache_stats() -> Dict[str, Any]:
+    return {"senders": _reputations.stats(), "models": _models.stats()}
@@ -0,0 +1,188 @@
+"""Full-text email search.
+
+Every message written to emails_collection (sent mail and synced provider
+mail) carries a `search_tokens` array built from its subject, body,
+addresses and labels. Together with a (user_id, search_tokens) multikey
+index this acts as an inverted index that is maintained on insert and
+answers exact-term and anchored prefix (`invest*`) lookups. Relevance
+ranking and quoted phrases use the collection's text index, which drops
+English stop words; a query whose terms are all stop words ("about") is
+answered from the tokens alone, newest first. Run
+`python search.py --backfill` once to tokenize mail stored before
+search_tokens existed; until then such messages only match term-free
+(label, folder or date) searches.
+"""
+import asyncio
+import re
+import sys
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+
+from database import emails_collection
+
+MAX_TOKENS_PER_MESSAGE = 1000
+BACKFILL_BATCH_SIZE = 500
+# Fields search_tokens reads, plus _id to page the backfill by
+TOKEN_SOURCE_PROJECTION = {"_id": 1, "id": 1, "from": 1, "from_email": 1, "to": 1, "labels": 1, "subject": 1, "body": 1}
+
+# The text index's English stop words, as produced by tokenize(); $text ignores them, so a
+# $text search made only of stop words matches nothing
+TEXT_STOPWORDS = frozenset("""
+    a about above after again against all am an and any are aren as at be because been before being below
+    between both but by can cannot could couldn d did didn do does doesn doing don down during each few for
+    from further had hadn has hasn have haven having he her here hers herself him himself his how i if in
+    into is isn it its itself let ll m me more most mustn my myself no nor not of off on once only or other
+    ought our ours ourselves out over own re s same shan she should shouldn so some such t than that the
+    their theirs them themselves then there these they this those through to too under until up ve very was
+    wasn we were weren what when where which while who whom why with won would wouldn you your yours
+    yourself yourselves
+""".split())
+SEARCH_RESULT_PROJECTION = {"_id": 0, "search_tokens": 0}
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+TAG_RE = re.compile(r"<[^>]+>")
+QUERY_PART_RE = re.compile(r'"([^"]+)"|(\S+)')
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+def search_tokens(message: Dict[str, Any]) -> List[str]:
+    """Distinct lowercase tokens for a message document, headers first so they survive the cap"""
+    tokens = {}
+    addresses = []
+    for field in ("from", "from_email"):
+        if message.get(field):
+            addresses.append(message[field])
+    addresses.extend(message.get("to") or [])
+
+    for address in addresses:
+        tokens[address.lower()] = None
+        for token in tokenize(address):
+            tokens[token] = None
+    for label in message.get("labels") or []:
+        tokens[label.lower()] = None
+    for token in tokenize(message.get("subject") or ""):
+        tokens[token] = None
+    for token in tokenize(TAG_RE.sub(" ", message.get("body") or "")):
+        if len(tokens) >= MAX_TOKENS_PER_MESSAGE:
+            break
+        tokens[token] = None
+    return list(tokens)
+
+
+def parse_query(q: str) -> Dict[str, List[str]]:
+    """Split a query into exact terms, `prefix*` terms and "quoted phrases" """
+    terms, prefixes, phrases = [], [], []
+    for phrase, word in QUERY_PART_RE.findall(q):
+        if phrase:
+            phrases.append(phrase)
+            terms.extend(tokenize(phrase))
+        elif word.endswith("*"):
+            prefixes.extend(tokenize(word[:-1])[:1])
+        else:
+            terms.extend(tokenize(word))
+    return {"terms": terms, "prefixes": prefixes, "phrases": phrases}
+
+
+def build_search_query(
+    user_id: str,
+    q: str,
+    labels: Optional[Iterable[str]] = None,
+    folder: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None
+) -> Dict[str, Any]:
+    parsed = parse_query(q)
+    clauses: List[Dict[str, Any]] = [{"user_id": user_id}]
+
+    if parsed["terms"]:
+        # $all gives AND semantics; $text supplies phrase matching and the relevance score
+        clauses.append({"search_tokens": {"$all": parsed["terms"]}})
+        ranked_terms = [term for term in parsed["terms"] if term not in TEXT_STOPWORDS]
+        if ranked_terms:
+            text_search = " ".join(ranked_terms + [f'"{phrase}"' for phrase in parsed["phrases"]])
+            clauses.append({"$text": {"$search": text_search}})
+    for prefix in parsed["prefixes"]:
+        clauses.append({"search_tokens": {"$regex": f"^{re.escape(prefix)}"}})
+    if labels:
+        clauses.append({"labels": {"$all": list(labels)}})
+    if folder:
+        clauses.append({"folder": folder})
+
+    date_range = {}
+    if date_from:
+        date_range["$gte"] = date_from
+    if date_to:
+        date_range["$lte"] = date_to
+    if date_range:
+        clauses.append({"$or": [{"received_at": date_range}, {"sent_at": date_range}]})
+
+    return {"$and": clauses}
+
+
+async def search_emails(
+    user_id: str,
+    q: str,
+    labels: Optional[Iterable[str]] = None,
+    folder: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    page: int = 1,
+    limit: int = 20
+) -> Dict[str, Any]:
+    """Ranked, paginated search; relevance order for term queries, newest first otherwise"""
+    query = build_search_query(user_id, q, labels, folder, date_from, date_to)
+    ranked = any("$text" in clause for clause in query["$and"])
+
+    if ranked:
+        projection = dict(SEARCH_RESULT_PROJECTION)
+        projection["score"] = {"$meta": "textScore"}
+        sort = [("score", {"$meta": "textScore"}), ("received_at", -1)]
+        results = await emails_collection.find(query, projection).sort(sort).skip(
+            (page - 1) * limit
+        ).limit(limit + 1).to_list()
+    else:
+        # Sent mail has no received_at; order received and sent mail together by whichever date it has
+        results = await emails_collection.aggregate([
+            {"$match": query},
+            {"$addFields": {"at": {"$ifNull": ["$received_at", "$sent_at"]}}},
+            {"$sort": {"at": -1, "id": -1}},
+            {"$skip": (page - 1) * limit},
+            {"$limit": limit + 1},
+            {"$project": {**SEARCH_RESULT_PROJECTION, "at": 0}}
+        ]).to_list()
+
+    return {
+        "results": results[:limit],
+        "page": page,
+        "has_more": len(results) > limit
+    }
+
+
+async def backfill_search_tokens(batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """Tokenize every stored message that has no search_tokens yet; returns messages tokenized"""
+    tokenized = 0
+    last_id = None
+    while True:
+        # Walk the _id index from where the last batch ended instead of rescanning from the start
+        query = {"search_tokens": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        docs = await emails_collection.find(query, TOKEN_SOURCE_PROJECTION).sort("_id", 1).limit(batch_size).to_list()
+        if not docs:
+            return tokenized
+        await emails_collection.bulk_write(
+            [UpdateOne({"_id": doc["_id"]}, {"$set": {"search_tokens": search_tokens(doc)}}) for doc in docs],
+            ordered=False
+        )
+        last_id = docs[-1]["_id"]
+        tokenized += len(docs)
+
+
+if __name__ == "__main__":
+    if "--backfill" in sys.argv:
+        print(f"Tokenized {asyncio.run(backfill_search_tokens())} messages")
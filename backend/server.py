@@ -1,7 +1,7 @@
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Form, Request
+from fastapi import FastAPI, HTTPException, Depends, Query, status, UploadFile, File, Form, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from datetime import datetime, timedelta
 import os
 from dotenv import load_dotenv
@@ -11,17 +11,85 @@ import json
 import base64
 import httpx
 import asyncio
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field, model_validator
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
 import random
 import time
+import heapq
+from urllib.parse import quote
+import weakref
+from contextlib import asynccontextmanager
+from database import (
+    users_collection, emails_collection, drafts_collection, contacts_collection,
+    templates_collection, campaigns_collection, sessions_collection, email_accounts_collection,
+    filters_collection, threads_collection, scheduled_emails_collection, close_client, run_in_db_thread
+)
+from cache import SessionCache
+from cluster import Lease, cluster_bus
+from indexes import ensure_indexes, verify_indexes
+from templates import STARTUP_TEMPLATES, load_template, compile_template, template_cache_stats
+from campaign_delivery import CampaignDeliveryEngine
+from scheduled_send import SCHEDULED_LIST_PROJECTION, ScheduledSendQueue, as_utc
+from http_clients import http_clients
+from mail_sync import needs_sync, sync_account
+from messages import AccountMessageView, ProviderMessage
+from analytics import get_dashboard, record_sent, run_reconciliation
+from search import search_emails, search_tokens
+from filters import filter_cache_stats, invalidate_rule_set, validate_filter
+from pagination import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, DRAFT_LIST_PROJECTION, TEMPLATE_LIST_PROJECTION,
+    CAMPAIGN_LIST_PROJECTION, EMAIL_LIST_PROJECTION, decode_cursor, paginate, paginate_list, stream_query
+)
+from streaming import stream_format, streaming_list_response
+from metrics import MetricsMiddleware, render_metrics, timed_provider_call
+from drafts import draft_autosaver
+from smtp_provider import SMTPEmailProvider
+from imap_ingest import IMAPIngestor
+from notifications import SSE_MEDIA_TYPE, event_stream, mail_notifier
+from conversations import THREAD_LIST_PROJECTION, assign_threads, refresh_threads
+from scoring import forget_sender, invalidate_user_model, observe, scoring_cache_stats
+from attachments import (
+    AttachmentTooLarge, RangeNotSatisfiable, get_attachment, get_blob, parse_range, resolve_attachments,
+    save_upload, shutdown_thumbnail_pool, stream_blob
+)
 
 load_dotenv()
 
-app = FastAPI(title="StartupMail API", description="Email service for startups")
+INDEX_SELF_CHECK = os.environ.get('INDEX_SELF_CHECK', 'false').lower() == 'true'
+CAMPAIGN_WORKER_ENABLED = os.environ.get('CAMPAIGN_WORKER_ENABLED', 'true').lower() == 'true'
+SCHEDULED_SEND_ENABLED = os.environ.get('SCHEDULED_SEND_ENABLED', 'true').lower() == 'true'
+# Worker processes for `python server.py`; gunicorn.conf.py reads the same variable
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', '1'))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_db_thread(ensure_indexes)
+    if INDEX_SELF_CHECK:
+        # Refuse to start if any hot query would run as a collection scan
+        await run_in_db_thread(verify_indexes)
+    cluster_bus.start()
+    if CAMPAIGN_WORKER_ENABLED:
+        campaign_engine.start()
+    if SCHEDULED_SEND_ENABLED:
+        scheduled_sender.start()
+    singletons = asyncio.create_task(singleton_lease.run(run_singletons))
+    yield
+    singletons.cancel()
+    await asyncio.gather(singletons, return_exceptions=True)
+    await draft_autosaver.flush_all()
+    await campaign_engine.stop()
+    await scheduled_sender.stop()
+    shutdown_thumbnail_pool()
+    if smtp_provider:
+        await smtp_provider.aclose()
+    await http_clients.aclose()
+    await cluster_bus.stop()
+    close_client()
+
+app = FastAPI(title="StartupMail API", description="Email service for startups", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -31,18 +99,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
-# Database connection
-mongo_client = MongoClient(os.environ.get('MONGO_URL'))
-db = mongo_client.startupmail
-users_collection = db.users
-emails_collection = db.emails
-drafts_collection = db.drafts
-contacts_collection = db.contacts
-templates_collection = db.templates
-campaigns_collection = db.campaigns
-sessions_collection = db.sessions
-email_accounts_collection = db.email_accounts
 
 # Security
 security = HTTPBearer()
@@ -51,9 +109,15 @@ security = HTTPBearer()
 class MockEmailProvider:
     def __init__(self, provider_type: str):
         self.provider_type = provider_type
+        self.history_id = 0
         self.mock_emails = self._generate_mock_emails()
     
-    def _generate_mock_emails(self) -> List[Dict]:
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """Pooled keep-alive client for this provider's API"""
+        return http_clients.get(self.provider_type.lower())
+    
+    def _generate_mock_emails(self) -> List[ProviderMessage]:
         """Generate mock emails for demonstration"""
         mock_emails = []
         senders = [
@@ -67,21 +131,22 @@ class MockEmailProvider:
         ]
         
         for i in range(20):
-            email = {
-                "id": str(uuid.uuid4()),
-                "from": random.choice(senders),
-                "subject": random.choice(subjects),
-                "body": f"This is a mock email body for email {i+1}. Lorem ipsum dolor sit amet, consectetur adipiscing elit.",
-                "received_at": datetime.utcnow() - timedelta(hours=random.randint(1, 48)),
-                "is_read": random.choice([True, False]),
-                "is_important": random.choice([True, False, False, False]),
-                "labels": random.sample(["Work", "Personal", "Important", "Follow-up"], k=random.randint(0, 2)),
-                "attachments": []
-            }
+            self.history_id += 1
+            email = ProviderMessage(
+                id=str(uuid.uuid4()),
+                history_id=self.history_id,
+                sender=random.choice(senders),
+                subject=random.choice(subjects),
+                body=f"This is a mock email body for email {i+1}. Lorem ipsum dolor sit amet, consectetur adipiscing elit.",
+                received_at=datetime.utcnow() - timedelta(hours=random.randint(1, 48)),
+                is_read=random.choice([True, False]),
+                labels=tuple(random.sample(["Work", "Personal", "Important", "Follow-up"], k=random.randint(0, 2)))
+            )
             mock_emails.append(email)
         
-        return sorted(mock_emails, key=lambda x: x['received_at'], reverse=True)
+        return sorted(mock_emails, key=lambda x: x.received_at, reverse=True)
     
+    @timed_provider_call
     async def authenticate_oauth(self, auth_code: str) -> Dict[str, Any]:
         """Mock OAuth authentication"""
         await asyncio.sleep(0.5)  # Simulate API call
@@ -92,11 +157,38 @@ class MockEmailProvider:
             "email": f"user@{self.provider_type.lower()}.com"
         }
     
-    async def get_emails(self, access_token: str, folder: str = "inbox") -> List[Dict]:
-        """Mock get emails"""
+    @timed_provider_call
+    async def get_emails(self, access_token: str, folder: str = "inbox") -> List[ProviderMessage]:
+        """Mock get emails; the shared records are immutable, so no copy is made"""
         await asyncio.sleep(0.3)  # Simulate API call
         return self.mock_emails
     
+    @timed_provider_call
+    async def get_changes(self, access_token: str, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """Mock delta sync: messages changed after the history id in `cursor`"""
+        await asyncio.sleep(0.1)  # Simulate API call
+        since = int(cursor) if cursor else 0
+        return {
+            "messages": [email for email in self.mock_emails if email.history_id > since],
+            "cursor": str(self.history_id)
+        }
+    
+    def add_mock_email(self, **fields) -> ProviderMessage:
+        """Simulate a new message arriving in the mailbox"""
+        self.history_id += 1
+        email = ProviderMessage(**{
+            "id": str(uuid.uuid4()),
+            "history_id": self.history_id,
+            "sender": "new.sender@example.com",
+            "subject": "New message",
+            "body": "This is a newly arrived mock email.",
+            "received_at": datetime.utcnow(),
+            **fields
+        })
+        self.mock_emails.insert(0, email)
+        return email
+    
+    @timed_provider_call
     async def send_email(self, access_token: str, email_data: Dict) -> Dict:
         """Mock send email"""
         await asyncio.sleep(0.5)  # Simulate API call
@@ -106,6 +198,7 @@ class MockEmailProvider:
             "sent_at": datetime.utcnow().isoformat()
         }
     
+    @timed_provider_call
     async def get_profile(self, access_token: str) -> Dict:
         """Mock get user profile"""
         await asyncio.sleep(0.2)  # Simulate API call
@@ -119,6 +212,37 @@ class MockEmailProvider:
 gmail_provider = MockEmailProvider("Gmail")
 outlook_provider = MockEmailProvider("Outlook")
 
+# SMTP relay, enabled by setting SMTP_HOST
+smtp_provider = SMTPEmailProvider.from_env()
+# IMAP IDLE ingestion, enabled by setting IMAP_HOST; replaces polling for the accounts it handles
+imap_ingestor = IMAPIngestor.from_env()
+if imap_ingestor:
+    cluster_bus.subscribe("imap_accounts", lambda message: imap_ingestor.refresh())
+
+async def run_singletons():
+    """Background loops that run in one worker on behalf of all of them"""
+    jobs = [run_reconciliation()]
+    if imap_ingestor:
+        jobs.append(imap_ingestor.run())
+    await asyncio.gather(*jobs)
+
+singleton_lease = Lease("singletons")
+
+def get_provider_instance(provider: str):
+    if provider == "smtp" and smtp_provider:
+        return smtp_provider
+    return gmail_provider if provider == "gmail" else outlook_provider
+
+# Campaign delivery
+campaign_engine = CampaignDeliveryEngine(get_provider_instance)
+
+# Scheduled sends; deliver_scheduled is defined with the send routes
+scheduled_sender = ScheduledSendQueue(lambda item: deliver_scheduled(item))
+
+# Bulk send
+BULK_SEND_MAX_MESSAGES = int(os.environ.get('BULK_SEND_MAX_MESSAGES', '1000'))
+BULK_SEND_CONCURRENCY = int(os.environ.get('BULK_SEND_CONCURRENCY', '16'))
+
 # Pydantic models
 class UserProfile(BaseModel):
     email: EmailStr
@@ -139,6 +263,16 @@ class EmailSend(BaseModel):
     body: str
     is_html: bool = False
     template_id: Optional[str] = None
+    template_variables: Optional[Dict[str, str]] = {}
+    attachment_ids: Optional[List[str]] = []
+    # Id of the stored email this message replies to
+    in_reply_to_id: Optional[str] = None
+
+class ScheduledEmailCreate(EmailSend):
+    send_at: datetime
+
+class ScheduledEmailUpdate(BaseModel):
+    send_at: datetime
 
 class EmailDraft(BaseModel):
     to: Optional[List[EmailStr]] = []
@@ -160,18 +294,142 @@ class BulkCampaign(BaseModel):
     template_id: str
     recipients: List[EmailStr]
     schedule_at: Optional[datetime] = None
+    variables: Optional[Dict[str, str]] = {}
+    recipient_variables: Optional[Dict[str, Dict[str, str]]] = {}
+    attachment_ids: Optional[List[str]] = []
+
+class BulkEmailSend(BaseModel):
+    messages: List[EmailSend] = Field(..., min_length=1, max_length=BULK_SEND_MAX_MESSAGES)
+
+class SpamReport(BaseModel):
+    is_spam: bool = True
 
 class EmailFilter(BaseModel):
     name: str
     conditions: Dict[str, Any]
     actions: Dict[str, Any]
+    enabled: bool = True
+    
+    @model_validator(mode="after")
+    def check_rule(self):
+        validate_filter(self.conditions, self.actions)
+        return self
+
+# Session cache
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '300'))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_LOOKUP_AGGREGATION = os.environ.get('SESSION_LOOKUP_AGGREGATION', 'false').lower() == 'true'
+session_cache = SessionCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+
+def drop_cached_sessions(message: Dict):
+    if "user_id" in message:
+        session_cache.invalidate_user(message["user_id"])
+    else:
+        session_cache.invalidate(message["session_token"])
+
+# Every worker caches sessions, so revocations are broadcast
+cluster_bus.subscribe("sessions", drop_cached_sessions)
+
+# Inbox fan-out
+INBOX_FANOUT_CONCURRENCY = int(os.environ.get('INBOX_FANOUT_CONCURRENCY', '8'))
+PROVIDER_TIMEOUT = float(os.environ.get('PROVIDER_TIMEOUT', '10'))
+# Serve the inbox from the synced local store; false fetches live from providers
+INBOX_LOCAL_STORE = os.environ.get('INBOX_LOCAL_STORE', 'true').lower() == 'true'
+_inbox_fanout_semaphores: "weakref.WeakValueDictionary[str, asyncio.Semaphore]" = weakref.WeakValueDictionary()
 
 # Helper functions
+async def resolve_session(session_token: str):
+    """Load a session and its user, returning (session, user)"""
+    if SESSION_LOOKUP_AGGREGATION:
+        # Single round-trip: join the user onto the session server-side
+        results = await sessions_collection.aggregate([
+            {"$match": {"session_token": session_token}},
+            {"$limit": 1},
+            {"$lookup": {
+                "from": users_collection.name,
+                "localField": "user_id",
+                "foreignField": "id",
+                "as": "user"
+            }}
+        ]).to_list()
+        if not results:
+            return None, None
+        session = results[0]
+        users = session.pop("user")
+        return session, users[0] if users else None
+
+    session = await sessions_collection.find_one({"session_token": session_token})
+    if not session:
+        return None, None
+    user = await users_collection.find_one({"id": session["user_id"]})
+    return session, user
+
+async def fan_out_accounts(user_id: str, accounts: List[Dict], call):
+    """Run `call(account)` for every account concurrently, returning ([(account, result)], failed_accounts)"""
+    semaphore = _inbox_fanout_semaphores.get(user_id)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(INBOX_FANOUT_CONCURRENCY)
+        _inbox_fanout_semaphores[user_id] = semaphore
+    
+    async def run(account):
+        async with semaphore:
+            return await asyncio.wait_for(call(account), timeout=PROVIDER_TIMEOUT)
+    
+    results = await asyncio.gather(*(run(account) for account in accounts), return_exceptions=True)
+    
+    succeeded = []
+    failed_accounts = []
+    for account, result in zip(accounts, results):
+        if isinstance(result, BaseException):
+            failed_accounts.append({
+                "account_id": account["id"],
+                "error": "timeout" if isinstance(result, asyncio.TimeoutError) else str(result)
+            })
+        else:
+            succeeded.append((account, result))
+    
+    return succeeded, failed_accounts
+
+async def fetch_inbox_for_accounts(user_id: str, accounts: List[Dict]):
+    """Fetch all accounts live from their providers and merge newest-first, returning (views, failed_accounts)"""
+    async def fetch(account):
+        provider_instance = get_provider_instance(account["provider"])
+        emails = await provider_instance.get_emails(account["access_token"])
+        # Attribute through per-request views; the provider's records stay untouched
+        return [AccountMessageView(email, account) for email in emails]
+    
+    succeeded, failed_accounts = await fan_out_accounts(user_id, accounts, fetch)
+    
+    # Providers return newest first, so a k-way merge avoids re-sorting everything
+    per_account = [emails for _, emails in succeeded]
+    emails = list(heapq.merge(*per_account, key=lambda x: x.received_at, reverse=True))
+    return emails, failed_accounts
+
+async def sync_inbox_accounts(user_id: str, accounts: List[Dict], force: bool = False):
+    """Pull provider deltas for accounts whose local copy is stale, returning failed_accounts"""
+    stale = [
+        account for account in accounts
+        if needs_sync(account, force) and not (imap_ingestor and imap_ingestor.handles(account))
+    ]
+    if not stale:
+        return []
+    
+    _, failed_accounts = await fan_out_accounts(
+        user_id,
+        stale,
+        lambda account: sync_account(account, get_provider_instance(account["provider"]), force)
+    )
+    return failed_accounts
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get current user from session token"""
     try:
         session_token = credentials.credentials
-        session = sessions_collection.find_one({"session_token": session_token})
+        user = session_cache.get(session_token)
+        if user:
+            return user
+        
+        session, user = await resolve_session(session_token)
         
         if not session:
             raise HTTPException(status_code=401, detail="Invalid session")
@@ -180,10 +438,10 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         if datetime.utcnow() > session["expires_at"]:
             raise HTTPException(status_code=401, detail="Session expired")
         
-        user = users_collection.find_one({"id": session["user_id"]})
         if not user:
             raise HTTPException(status_code=401, detail="User not found")
         
+        session_cache.set_session(session_token, user, session["expires_at"])
         return user
     except Exception as e:
         raise HTTPException(status_code=401, detail="Authentication failed")
@@ -204,11 +462,10 @@ async def authenticate_session(request: Request):
             raise HTTPException(status_code=400, detail="Session ID required")
         
         # Call Emergent auth API
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-                headers={"X-Session-ID": session_id}
-            )
+        response = await http_clients.get("emergent").get(
+            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
+            headers={"X-Session-ID": session_id}
+        )
         
         if response.status_code != 200:
             raise HTTPException(status_code=401, detail="Invalid session")
@@ -225,24 +482,27 @@ async def authenticate_session(request: Request):
             "updated_at": datetime.utcnow()
         }
         
-        existing_user = users_collection.find_one({"email": auth_data["email"]})
+        existing_user = await users_collection.find_one({"email": auth_data["email"]})
         if not existing_user:
-            users_collection.insert_one(user_data)
+            # A copy, so the _id insert_one adds does not end up in the response
+            await users_collection.insert_one(dict(user_data))
         else:
-            users_collection.update_one(
+            await users_collection.update_one(
                 {"email": auth_data["email"]},
                 {"$set": {"updated_at": datetime.utcnow()}}
             )
+            await cluster_bus.publish("sessions", {"user_id": existing_user["id"]})
         
-        # Create session
-        session_data = {
-            "session_token": auth_data["session_token"],
-            "user_id": auth_data["id"],
-            "created_at": datetime.utcnow(),
-            "expires_at": datetime.utcnow() + timedelta(days=7)
-        }
-        
-        sessions_collection.insert_one(session_data)
+        # Create the session, or renew it when the same token authenticates again
+        now = datetime.utcnow()
+        await sessions_collection.update_one(
+            {"session_token": auth_data["session_token"]},
+            {
+                "$set": {"user_id": auth_data["id"], "expires_at": now + timedelta(days=7)},
+                "$setOnInsert": {"created_at": now}
+            },
+            upsert=True
+        )
         
         return {
             "session_token": auth_data["session_token"],
@@ -252,6 +512,30 @@ async def authenticate_session(request: Request):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Authentication failed: {str(e)}")
 
+@app.post("/api/auth/logout")
+async def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Revoke the current session"""
+    session_token = credentials.credentials
+    await sessions_collection.delete_one({"session_token": session_token})
+    await cluster_bus.publish("sessions", {"session_token": session_token})
+    
+    return {"message": "Logged out successfully"}
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Request, Mongo and provider latency histograms in the Prometheus text format"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/metrics/cache")
+async def get_cache_metrics():
+    """Hit/miss counters for in-process caches"""
+    return {
+        "session_cache": session_cache.stats(),
+        "template_cache": template_cache_stats(),
+        "filter_cache": filter_cache_stats(),
+        "scoring_cache": scoring_cache_stats()
+    }
+
 @app.get("/api/user/profile")
 async def get_profile(current_user: dict = Depends(get_current_user)):
     return {
@@ -268,13 +552,13 @@ async def connect_email_account(
     auth_code: str,
     current_user: dict = Depends(get_current_user)
 ):
-    """Connect Gmail or Outlook account"""
+    """Connect Gmail or Outlook account, or the SMTP relay when configured"""
     try:
-        if provider not in ["gmail", "outlook"]:
+        if provider not in ["gmail", "outlook"] and not (provider == "smtp" and smtp_provider):
             raise HTTPException(status_code=400, detail="Invalid provider")
         
         # Mock OAuth flow
-        provider_instance = gmail_provider if provider == "gmail" else outlook_provider
+        provider_instance = get_provider_instance(provider)
         auth_result = await provider_instance.authenticate_oauth(auth_code)
         profile = await provider_instance.get_profile(auth_result["access_token"])
         
@@ -288,11 +572,14 @@ async def connect_email_account(
             "access_token": auth_result["access_token"],
             "refresh_token": auth_result["refresh_token"],
             "token_expires_at": datetime.utcnow() + timedelta(seconds=auth_result["expires_in"]),
-            "is_primary": email_accounts_collection.count_documents({"user_id": current_user["id"]}) == 0,
+            "is_primary": await email_accounts_collection.count_documents({"user_id": current_user["id"]}) == 0,
             "created_at": datetime.utcnow()
         }
         
-        email_accounts_collection.insert_one(account_data)
+        await email_accounts_collection.insert_one(account_data)
+        if imap_ingestor and imap_ingestor.watches(account_data):
+            # The worker running ingestion may not be this one
+            await cluster_bus.publish("imap_accounts", {"account_id": account_data["id"]})
         
         return {
             "message": f"{provider.capitalize()} account connected successfully",
@@ -311,58 +598,252 @@ async def connect_email_account(
 @app.get("/api/email-accounts")
 async def get_email_accounts(current_user: dict = Depends(get_current_user)):
     """Get connected email accounts"""
-    accounts = list(email_accounts_collection.find(
+    accounts = await email_accounts_collection.find(
         {"user_id": current_user["id"]},
         {"_id": 0, "access_token": 0, "refresh_token": 0}
-    ))
+    ).to_list()
     
     return {"accounts": accounts}
 
 @app.get("/api/emails/inbox")
 async def get_inbox(
+    request: Request,
     account_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    stream: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
     """Get emails from inbox"""
+    position = decode_cursor(cursor)
+    fmt = stream_format(request, stream)
     try:
         if account_id:
-            account = email_accounts_collection.find_one({"id": account_id, "user_id": current_user["id"]})
+            account = await email_accounts_collection.find_one({"id": account_id, "user_id": current_user["id"]})
             if not account:
                 raise HTTPException(status_code=404, detail="Email account not found")
-            
-            # Get emails from specific provider
-            provider_instance = gmail_provider if account["provider"] == "gmail" else outlook_provider
-            emails = await provider_instance.get_emails(account["access_token"])
-            
-            # Add account info to each email
-            for email in emails:
-                email["account_id"] = account_id
-                email["account_email"] = account["email"]
-                email["provider"] = account["provider"]
+            accounts = [account]
         else:
             # Get emails from all accounts
-            accounts = list(email_accounts_collection.find({"user_id": current_user["id"]}))
-            all_emails = []
-            
-            for account in accounts:
-                provider_instance = gmail_provider if account["provider"] == "gmail" else outlook_provider
-                emails = await provider_instance.get_emails(account["access_token"])
-                
-                for email in emails:
-                    email["account_id"] = account["id"]
-                    email["account_email"] = account["email"]
-                    email["provider"] = account["provider"]
-                
-                all_emails.extend(emails)
-            
-            # Sort by received date
-            emails = sorted(all_emails, key=lambda x: x['received_at'], reverse=True)
+            accounts = await email_accounts_collection.find({"user_id": current_user["id"]}).to_list()
         
-        return {"emails": emails}
+        if INBOX_LOCAL_STORE:
+            # Bring stale accounts up to date, then read from the local store
+            failed_accounts = await sync_inbox_accounts(current_user["id"], accounts)
+            query = {"user_id": current_user["id"], "folder": "inbox"}
+            if account_id:
+                query["account_id"] = account_id
+            if fmt:
+                return streaming_list_response(
+                    "emails", stream_query(emails_collection, query, "received_at", position, EMAIL_LIST_PROJECTION), fmt
+                )
+            page = await paginate(emails_collection, query, "received_at", position, limit, EMAIL_LIST_PROJECTION)
+        else:
+            emails, failed_accounts = await fetch_inbox_for_accounts(current_user["id"], accounts)
+            page = paginate_list(emails, "received_at", position, limit)
+            page["items"] = [email.to_dict() for email in page["items"]]
+        
+        return {"emails": page["items"], "next_cursor": page["next_cursor"], "failed_accounts": failed_accounts}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch emails: {str(e)}")
 
+@app.get("/api/emails/threads")
+async def get_threads(
+    folder: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
+    """Conversations by last activity, read from the thread summaries"""
+    position = decode_cursor(cursor)
+    try:
+        query = {"user_id": current_user["id"]}
+        if folder:
+            query["folders"] = folder
+        page = await paginate(threads_collection, query, "last_activity", position, limit, THREAD_LIST_PROJECTION)
+        return {"threads": page["items"], "next_cursor": page["next_cursor"]}
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch threads: {str(e)}")
+
+@app.get("/api/emails/threads/{thread_id}")
+async def get_thread(thread_id: str, current_user: dict = Depends(get_current_user)):
+    """A conversation's summary and its messages, oldest first"""
+    thread = await threads_collection.find_one({"id": thread_id, "user_id": current_user["id"]}, THREAD_LIST_PROJECTION)
+    if not thread:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    
+    messages = await emails_collection.find(
+        {"user_id": current_user["id"], "thread_id": thread_id}, EMAIL_LIST_PROJECTION
+    ).to_list()
+    messages.sort(key=lambda message: message.get("received_at") or message.get("sent_at"))
+    return {"thread": thread, "messages": messages}
+
+@app.get("/api/emails/events")
+async def email_events(current_user: dict = Depends(get_current_user)):
+    """Server-Sent Events stream of new-mail notifications"""
+    return StreamingResponse(
+        event_stream(mail_notifier, current_user["id"]),
+        media_type=SSE_MEDIA_TYPE,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/emails/search")
+async def search(
+    q: str,
+    label: Optional[List[str]] = Query(None),
+    folder: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    page: int = Query(1, ge=1),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
+    """Search synced and sent mail; supports terms, prefix* terms, "phrases" and label/date filters"""
+    try:
+        return await search_emails(current_user["id"], q, label, folder, date_from, date_to, page, limit)
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+
+@app.post("/api/emails/{email_id}/spam")
+async def report_spam(email_id: str, report: SpamReport, current_user: dict = Depends(get_current_user)):
+    """Report a message as spam (moved to spam) or not spam (moved to the inbox); only reports train the spam model"""
+    email = await emails_collection.find_one_and_update(
+        {"id": email_id, "user_id": current_user["id"], "folder": {"$ne": "sent"}},
+        {"$set": {"spam_reported": report.is_spam, "folder": "spam" if report.is_spam else "inbox"}},
+        projection={"_id": 0, "from": 1, "thread_id": 1}
+    )
+    if not email:
+        raise HTTPException(status_code=404, detail="Email not found")
+    
+    await forget_sender(current_user["id"], email.get("from"))
+    await invalidate_user_model(current_user["id"])
+    if email.get("thread_id"):
+        await refresh_threads(current_user["id"], [email["thread_id"]])
+    
+    return {"message": "Reported as spam" if report.is_spam else "Reported as not spam"}
+
+@app.post("/api/emails/sync")
+async def sync_inbox(
+    account_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Force an incremental sync of one or all connected accounts"""
+    query = {"user_id": current_user["id"]}
+    if account_id:
+        query["id"] = account_id
+    accounts = await email_accounts_collection.find(query).to_list()
+    if account_id and not accounts:
+        raise HTTPException(status_code=404, detail="Email account not found")
+    
+    failed_accounts = await sync_inbox_accounts(current_user["id"], accounts, force=True)
+    
+    return {
+        "synced_accounts": len(accounts) - len(failed_accounts),
+        "failed_accounts": failed_accounts
+    }
+
+async def find_send_account(user_id: str, account_id: Optional[str]):
+    """The account to send from: the given one, or the user's primary account"""
+    if account_id:
+        return await email_accounts_collection.find_one({"id": account_id, "user_id": user_id})
+    return await email_accounts_collection.find_one({"user_id": user_id, "is_primary": True})
+
+def render_outgoing(email_data: EmailSend, template: Optional[Dict]):
+    """Subject and body to send, rendered through the template when one was found"""
+    if template:
+        return compile_template(template).render(email_data.template_variables or {})
+    return email_data.subject, email_data.body
+
+async def find_reply_parents(user_id: str, email_ids: List[str]) -> Dict[str, Dict]:
+    """Stored emails being replied to, by id; raises ValueError for ids the user does not own"""
+    if not email_ids:
+        return {}
+    found = await emails_collection.find(
+        {"id": {"$in": email_ids}, "user_id": user_id},
+        {"_id": 0, "id": 1, "message_id": 1, "references": 1, "thread_id": 1}
+    ).to_list()
+    parents = {parent["id"]: parent for parent in found}
+    missing = [email_id for email_id in email_ids if email_id not in parents]
+    if missing:
+        raise ValueError(f"Emails not found: {', '.join(missing)}")
+    return parents
+
+async def send_via_provider(
+    account: Dict, email_data: EmailSend, subject: str, body: str, attachments: List[Dict] = [],
+    parent: Optional[Dict] = None
+) -> Dict:
+    """Send one message through the account's provider and build its sent-folder document"""
+    in_reply_to = parent.get("message_id") if parent else None
+    references = (list(parent.get("references") or []) + [in_reply_to]) if in_reply_to else []
+    provider_instance = get_provider_instance(account["provider"])
+    send_result = await provider_instance.send_email(account["access_token"], {
+        "to": email_data.to,
+        "cc": email_data.cc,
+        "bcc": email_data.bcc,
+        "subject": subject,
+        "body": body,
+        "is_html": email_data.is_html,
+        "attachments": attachments,
+        "in_reply_to": in_reply_to,
+        "references": references
+    })
+    
+    email_doc = {
+        "id": str(uuid.uuid4()),
+        "user_id": account["user_id"],
+        "account_id": account["id"],
+        "message_id": send_result["message_id"],
+        "from_email": account["email"],
+        "to": email_data.to,
+        "cc": email_data.cc,
+        "bcc": email_data.bcc,
+        "subject": subject,
+        "body": body,
+        "is_html": email_data.is_html,
+        "attachments": attachments,
+        "sent_at": datetime.utcnow(),
+        "folder": "sent",
+        "is_read": True,
+        "provider": account["provider"],
+        "in_reply_to": in_reply_to,
+        "references": references
+    }
+    if parent and parent.get("thread_id"):
+        email_doc["thread_id"] = parent["thread_id"]
+    email_doc["search_tokens"] = search_tokens(email_doc)
+    return email_doc
+
+async def deliver_email(user_id: str, account: Dict, email_data: EmailSend) -> Dict:
+    """Render, send and store one outgoing email; returns the sent-folder document"""
+    # Get template if specified
+    template = None
+    if email_data.template_id:
+        template = await load_template(email_data.template_id, user_id)
+    subject, body = render_outgoing(email_data, template)
+    attachments = await resolve_attachments(user_id, email_data.attachment_ids or [])
+    parents = await find_reply_parents(user_id, [email_data.in_reply_to_id] if email_data.in_reply_to_id else [])
+    
+    # Send via provider and save to sent emails
+    email_doc = await send_via_provider(
+        account, email_data, subject, body, attachments, parents.get(email_data.in_reply_to_id)
+    )
+    await assign_threads(user_id, [email_doc])
+    await emails_collection.insert_one(email_doc)
+    await refresh_threads(user_id, [email_doc["thread_id"]])
+    observe(user_id, [email_doc])
+    await record_sent(user_id, 1, email_data.to, when=email_doc["sent_at"])
+    return email_doc
+
+async def deliver_scheduled(item: Dict) -> Dict:
+    """Send a claimed scheduled email from the account it was scheduled on"""
+    account = await find_send_account(item["user_id"], item["account_id"])
+    if not account:
+        raise ValueError("Email account not found")
+    return await deliver_email(item["user_id"], account, EmailSend(**item["email"]))
+
 @app.post("/api/emails/send")
 async def send_email(
     email_data: EmailSend,
@@ -372,64 +853,175 @@ async def send_email(
     """Send email"""
     try:
         # Get account to send from
-        if account_id:
-            account = email_accounts_collection.find_one({"id": account_id, "user_id": current_user["id"]})
-        else:
-            account = email_accounts_collection.find_one({"user_id": current_user["id"], "is_primary": True})
+        account = await find_send_account(current_user["id"], account_id)
+        if not account:
+            raise HTTPException(status_code=404, detail="Email account not found")
+        
+        email_doc = await deliver_email(current_user["id"], account, email_data)
+        
+        return {
+            "message": "Email sent successfully",
+            "email_id": email_doc["id"],
+            "sent_at": email_doc["sent_at"]
+        }
         
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
+
+@app.post("/api/emails/send/bulk")
+async def send_email_bulk(
+    batch: BulkEmailSend,
+    account_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Send a batch of messages from one account with bounded concurrency; results are per item"""
+    try:
+        # Account and templates are resolved once for the whole batch
+        account = await find_send_account(current_user["id"], account_id)
         if not account:
             raise HTTPException(status_code=404, detail="Email account not found")
         
-        # Get template if specified
-        body = email_data.body
-        subject = email_data.subject
-        
-        if email_data.template_id:
-            template = templates_collection.find_one({"id": email_data.template_id, "user_id": current_user["id"]})
-            if template:
-                body = template["body"]
-                subject = template["subject"]
-        
-        # Send via provider
-        provider_instance = gmail_provider if account["provider"] == "gmail" else outlook_provider
-        send_result = await provider_instance.send_email(account["access_token"], {
-            "to": email_data.to,
-            "cc": email_data.cc,
-            "bcc": email_data.bcc,
-            "subject": subject,
-            "body": body,
-            "is_html": email_data.is_html
-        })
+        template_ids = list({message.template_id for message in batch.messages if message.template_id})
+        loaded = await asyncio.gather(*(load_template(template_id, current_user["id"]) for template_id in template_ids))
+        templates = dict(zip(template_ids, loaded))
+        
+        attachment_ids = list({attachment_id for message in batch.messages for attachment_id in message.attachment_ids or []})
+        attachments = {
+            attachment["id"]: attachment
+            for attachment in await resolve_attachments(current_user["id"], attachment_ids)
+        }
+        parents = await find_reply_parents(
+            current_user["id"], list({message.in_reply_to_id for message in batch.messages if message.in_reply_to_id})
+        )
+        
+        semaphore = asyncio.Semaphore(BULK_SEND_CONCURRENCY)
+        
+        async def send(email_data: EmailSend):
+            subject, body = render_outgoing(email_data, templates.get(email_data.template_id))
+            message_attachments = [attachments[attachment_id] for attachment_id in email_data.attachment_ids or []]
+            async with semaphore:
+                return await asyncio.wait_for(
+                    send_via_provider(
+                        account, email_data, subject, body, message_attachments, parents.get(email_data.in_reply_to_id)
+                    ),
+                    timeout=PROVIDER_TIMEOUT
+                )
+        
+        outcomes = await asyncio.gather(*(send(message) for message in batch.messages), return_exceptions=True)
+        
+        results = []
+        email_docs = []
+        for index, outcome in enumerate(outcomes):
+            if isinstance(outcome, BaseException):
+                results.append({
+                    "index": index,
+                    "status": "failed",
+                    "error": "timeout" if isinstance(outcome, asyncio.TimeoutError) else str(outcome)
+                })
+            else:
+                email_docs.append(outcome)
+                results.append({"index": index, "status": "sent", "email_id": outcome["id"], "sent_at": outcome["sent_at"]})
+        
+        # One unordered write for every message that went out
+        if email_docs:
+            await assign_threads(current_user["id"], email_docs)
+            await emails_collection.insert_many(email_docs, ordered=False)
+            await refresh_threads(current_user["id"], [email_doc["thread_id"] for email_doc in email_docs])
+            observe(current_user["id"], email_docs)
+        failed = len(results) - len(email_docs)
+        await record_sent(
+            current_user["id"], len(email_docs),
+            [recipient for email_doc in email_docs for recipient in email_doc["to"]],
+            failed=failed
+        )
+        
+        return {"sent": len(email_docs), "failed": failed, "results": results}
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to send emails: {str(e)}")
+
+@app.post("/api/emails/scheduled")
+async def schedule_email(
+    email_data: ScheduledEmailCreate,
+    account_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Schedule an email to be sent at `send_at`"""
+    account = await find_send_account(current_user["id"], account_id)
+    if not account:
+        raise HTTPException(status_code=404, detail="Email account not found")
+    
+    try:
+        # Fail now rather than at send time for attachments the user does not own
+        await resolve_attachments(current_user["id"], email_data.attachment_ids or [])
         
-        # Save to sent emails
-        email_doc = {
+        now = datetime.utcnow()
+        scheduled_doc = {
             "id": str(uuid.uuid4()),
             "user_id": current_user["id"],
             "account_id": account["id"],
-            "message_id": send_result["message_id"],
-            "from_email": account["email"],
-            "to": email_data.to,
-            "cc": email_data.cc,
-            "bcc": email_data.bcc,
-            "subject": subject,
-            "body": body,
-            "is_html": email_data.is_html,
-            "sent_at": datetime.utcnow(),
-            "folder": "sent",
-            "is_read": True,
-            "provider": account["provider"]
+            "email": email_data.model_dump(exclude={"send_at"}),
+            "send_at": as_utc(email_data.send_at),
+            "status": "scheduled",
+            "attempts": 0,
+            "created_at": now,
+            "updated_at": now
         }
-        
-        emails_collection.insert_one(email_doc)
+        await scheduled_emails_collection.insert_one(scheduled_doc)
+        scheduled_sender.track(scheduled_doc["id"], scheduled_doc["send_at"])
         
         return {
-            "message": "Email sent successfully",
-            "email_id": email_doc["id"],
-            "sent_at": email_doc["sent_at"]
+            "message": "Email scheduled successfully",
+            "scheduled_id": scheduled_doc["id"],
+            "send_at": scheduled_doc["send_at"]
         }
         
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to schedule email: {str(e)}")
+
+@app.get("/api/emails/scheduled")
+async def get_scheduled_emails(
+    status_filter: str = Query("scheduled", alias="status"),
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
+    """User's scheduled emails in one status, latest send time first"""
+    position = decode_cursor(cursor)
+    try:
+        page = await paginate(
+            scheduled_emails_collection, {"user_id": current_user["id"], "status": status_filter},
+            "send_at", position, limit, SCHEDULED_LIST_PROJECTION
+        )
+        return {"scheduled": page["items"], "next_cursor": page["next_cursor"]}
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch scheduled emails: {str(e)}")
+
+async def scheduled_conflict(scheduled_id: str, user_id: str) -> HTTPException:
+    """404 for an unknown scheduled email, 409 for one that is no longer waiting to be sent"""
+    existing = await scheduled_emails_collection.find_one({"id": scheduled_id, "user_id": user_id}, {"status": 1})
+    if not existing:
+        return HTTPException(status_code=404, detail="Scheduled email not found")
+    return HTTPException(status_code=409, detail=f"Scheduled email is already {existing['status']}")
+
+@app.patch("/api/emails/scheduled/{scheduled_id}")
+async def reschedule_email(
+    scheduled_id: str,
+    update: ScheduledEmailUpdate,
+    current_user: dict = Depends(get_current_user)
+):
+    """Move a scheduled email to a new send time"""
+    if not await scheduled_sender.reschedule(current_user["id"], scheduled_id, update.send_at):
+        raise await scheduled_conflict(scheduled_id, current_user["id"])
+    return {"message": "Email rescheduled successfully", "send_at": as_utc(update.send_at)}
+
+@app.delete("/api/emails/scheduled/{scheduled_id}")
+async def cancel_scheduled_email(scheduled_id: str, current_user: dict = Depends(get_current_user)):
+    """Cancel a scheduled email that has not been sent"""
+    if not await scheduled_sender.cancel(current_user["id"], scheduled_id):
+        raise await scheduled_conflict(scheduled_id, current_user["id"])
+    return {"message": "Scheduled email cancelled successfully"}
 
 @app.post("/api/emails/drafts")
 async def save_draft(
@@ -439,67 +1031,85 @@ async def save_draft(
 ):
     """Save or update draft"""
     try:
+        fields = {
+            "to": draft.to,
+            "cc": draft.cc,
+            "bcc": draft.bcc,
+            "subject": draft.subject,
+            "body": draft.body,
+            "is_html": draft.is_html
+        }
+        
         if draft_id:
-            # Update existing draft
-            existing_draft = drafts_collection.find_one({"id": draft_id, "user_id": current_user["id"]})
-            if not existing_draft:
+            # Update existing draft; unchanged saves are skipped and only changed fields written
+            if not await draft_autosaver.save(current_user["id"], draft_id, fields):
                 raise HTTPException(status_code=404, detail="Draft not found")
             
-            drafts_collection.update_one(
-                {"id": draft_id},
-                {"$set": {
-                    "to": draft.to,
-                    "cc": draft.cc,
-                    "bcc": draft.bcc,
-                    "subject": draft.subject,
-                    "body": draft.body,
-                    "is_html": draft.is_html,
-                    "updated_at": datetime.utcnow()
-                }}
-            )
-            
             return {"message": "Draft updated successfully", "draft_id": draft_id}
         else:
             # Create new draft
-            draft_doc = {
-                "id": str(uuid.uuid4()),
-                "user_id": current_user["id"],
-                "to": draft.to,
-                "cc": draft.cc,
-                "bcc": draft.bcc,
-                "subject": draft.subject,
-                "body": draft.body,
-                "is_html": draft.is_html,
-                "created_at": datetime.utcnow(),
-                "updated_at": datetime.utcnow()
-            }
+            new_draft_id = await draft_autosaver.create(current_user["id"], fields)
             
-            drafts_collection.insert_one(draft_doc)
-            
-            return {"message": "Draft saved successfully", "draft_id": draft_doc["id"]}
+            return {"message": "Draft saved successfully", "draft_id": new_draft_id}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to save draft: {str(e)}")
 
 @app.get("/api/emails/drafts")
-async def get_drafts(current_user: dict = Depends(get_current_user)):
+async def get_drafts(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    stream: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
     """Get user's drafts"""
+    position = decode_cursor(cursor)
+    fmt = stream_format(request, stream)
     try:
-        drafts = list(drafts_collection.find(
+        if fmt:
+            return streaming_list_response(
+                "drafts",
+                stream_query(drafts_collection, {"user_id": current_user["id"]}, "updated_at", position, DRAFT_LIST_PROJECTION),
+                fmt
+            )
+        
+        page = await paginate(
+            drafts_collection,
             {"user_id": current_user["id"]},
-            {"_id": 0}
-        ).sort("updated_at", -1))
+            "updated_at",
+            position,
+            limit,
+            DRAFT_LIST_PROJECTION
+        )
         
-        return {"drafts": drafts}
+        return {"drafts": page["items"], "next_cursor": page["next_cursor"]}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch drafts: {str(e)}")
 
+@app.get("/api/emails/drafts/{draft_id}")
+async def get_draft(draft_id: str, current_user: dict = Depends(get_current_user)):
+    """Get a single draft including its body"""
+    draft = await drafts_collection.find_one(
+        {"id": draft_id, "user_id": current_user["id"]}, {"_id": 0, "content_hash": 0}
+    )
+    if not draft:
+        raise HTTPException(status_code=404, detail="Draft not found")
+    
+    # Include an autosave still waiting in the coalescing window
+    pending = draft_autosaver.pending(current_user["id"], draft_id)
+    if pending:
+        draft.update(pending)
+    
+    return {"draft": draft}
+
 @app.delete("/api/emails/drafts/{draft_id}")
 async def delete_draft(draft_id: str, current_user: dict = Depends(get_current_user)):
     """Delete draft"""
     try:
-        result = drafts_collection.delete_one({"id": draft_id, "user_id": current_user["id"]})
+        result = await drafts_collection.delete_one({"id": draft_id, "user_id": current_user["id"]})
+        draft_autosaver.forget(current_user["id"], draft_id)
         
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Draft not found")
@@ -509,6 +1119,68 @@ async def delete_draft(draft_id: str, current_user: dict = Depends(get_current_u
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete draft: {str(e)}")
 
+@app.post("/api/attachments")
+async def upload_attachment(
+    file: UploadFile = File(...),
+    current_user: dict = Depends(get_current_user)
+):
+    """Upload an attachment; identical content is stored once"""
+    try:
+        attachment = await save_upload(current_user["id"], file)
+        
+        return {"message": "Attachment uploaded successfully", "attachment": attachment}
+        
+    except AttachmentTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to upload attachment: {str(e)}")
+
+def blob_response(blob: Dict, content_type: str, filename: str, range_header: Optional[str]) -> StreamingResponse:
+    """Stream a stored blob, honouring a single-range Range header"""
+    size = blob["size"]
+    try:
+        byte_range = parse_range(range_header, size)
+    except RangeNotSatisfiable:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    
+    start, end = byte_range or (0, size - 1)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(end - start + 1),
+        "ETag": f'"{blob["sha256"]}"',
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    
+    return StreamingResponse(
+        stream_blob(blob, start, end),
+        status_code=206 if byte_range else 200,
+        media_type=content_type,
+        headers=headers
+    )
+
+@app.get("/api/attachments/{attachment_id}")
+async def download_attachment(attachment_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    """Download an attachment; supports Range requests"""
+    attachment = await get_attachment(current_user["id"], attachment_id)
+    blob = await get_blob(attachment["sha256"]) if attachment else None
+    if not blob:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    
+    return blob_response(blob, attachment["content_type"], attachment["filename"], request.headers.get("range"))
+
+@app.get("/api/attachments/{attachment_id}/thumbnail")
+async def get_attachment_thumbnail(attachment_id: str, current_user: dict = Depends(get_current_user)):
+    """PNG thumbnail of an image attachment, once it has been generated"""
+    attachment = await get_attachment(current_user["id"], attachment_id)
+    blob = await get_blob(attachment["sha256"]) if attachment else None
+    thumbnail = await get_blob(blob["thumbnail_sha256"]) if blob and blob.get("thumbnail_sha256") else None
+    if not thumbnail:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    
+    return blob_response(thumbnail, "image/png", f"thumbnail-{attachment['filename']}.png", None)
+
 @app.post("/api/templates")
 async def create_template(
     template: EmailTemplate,
@@ -528,7 +1200,7 @@ async def create_template(
             "updated_at": datetime.utcnow()
         }
         
-        templates_collection.insert_one(template_doc)
+        await templates_collection.insert_one(template_doc)
         
         return {"message": "Template created successfully", "template_id": template_doc["id"]}
         
@@ -536,15 +1208,24 @@ async def create_template(
         raise HTTPException(status_code=500, detail=f"Failed to create template: {str(e)}")
 
 @app.get("/api/templates")
-async def get_templates(current_user: dict = Depends(get_current_user)):
+async def get_templates(
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user: dict = Depends(get_current_user)
+):
     """Get user's email templates"""
+    position = decode_cursor(cursor)
     try:
-        templates = list(templates_collection.find(
+        page = await paginate(
+            templates_collection,
             {"user_id": current_user["id"]},
-            {"_id": 0}
-        ).sort("created_at", -1))
+            "created_at",
+            position,
+            limit,
+            TEMPLATE_LIST_PROJECTION
+        )
         
-        return {"templates": templates}
+        return {"templates": page["items"], "next_cursor": page["next_cursor"]}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch templates: {str(e)}")
@@ -552,34 +1233,16 @@ async def get_templates(current_user: dict = Depends(get_current_user)):
 @app.get("/api/templates/startup")
 async def get_startup_templates():
     """Get predefined startup email templates"""
-    startup_templates = [
-        {
-            "id": "welcome_investor",
-            "name": "Investor Welcome Email",
-            "category": "Investor Relations",
-            "subject": "Welcome to {company_name} - Investment Opportunity",
-            "body": "<p>Dear {investor_name},</p><p>Thank you for your interest in {company_name}. We're excited to share our vision with you...</p>",
-            "is_html": True
-        },
-        {
-            "id": "product_launch",
-            "name": "Product Launch Announcement",
-            "category": "Marketing",
-            "subject": "🚀 Introducing {product_name} - Now Live!",
-            "body": "<p>Hi {customer_name},</p><p>We're thrilled to announce the launch of {product_name}! After months of development...</p>",
-            "is_html": True
-        },
-        {
-            "id": "partnership_proposal",
-            "name": "Partnership Proposal",
-            "category": "Business Development",
-            "subject": "Partnership Opportunity - {company_name}",
-            "body": "<p>Hello {partner_name},</p><p>I hope this email finds you well. I'm reaching out to explore a potential partnership...</p>",
-            "is_html": True
-        }
-    ]
+    return {"templates": STARTUP_TEMPLATES}
+
+@app.get("/api/templates/{template_id}")
+async def get_template(template_id: str, current_user: dict = Depends(get_current_user)):
+    """Get a single template including its body"""
+    template = await templates_collection.find_one({"id": template_id, "user_id": current_user["id"]}, {"_id": 0})
+    if not template:
+        raise HTTPException(status_code=404, detail="Template not found")
     
-    return {"templates": startup_templates}
+    return {"template": template}
 
 @app.post("/api/campaigns")
 async def create_campaign(
@@ -594,6 +1257,9 @@ async def create_campaign(
             "name": campaign.name,
             "template_id": campaign.template_id,
             "recipients": campaign.recipients,
+            "variables": campaign.variables or {},
+            "recipient_variables": campaign.recipient_variables or {},
+            "attachments": await resolve_attachments(current_user["id"], campaign.attachment_ids or []),
             "schedule_at": campaign.schedule_at or datetime.utcnow(),
             "status": "scheduled",
             "created_at": datetime.utcnow(),
@@ -601,7 +1267,7 @@ async def create_campaign(
             "failed_count": 0
         }
         
-        campaigns_collection.insert_one(campaign_doc)
+        await campaigns_collection.insert_one(campaign_doc)
         
         return {"message": "Campaign created successfully", "campaign_id": campaign_doc["id"]}
         
@@ -609,45 +1275,134 @@ async def create_campaign(
         raise HTTPException(status_code=500, detail=f"Failed to create campaign: {str(e)}")
 
 @app.get("/api/campaigns")
-async def get_campaigns(current_user: dict = Depends(get_current_user)):
+async def get_campaigns(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    stream: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
     """Get user's campaigns"""
+    position = decode_cursor(cursor)
+    fmt = stream_format(request, stream)
     try:
-        campaigns = list(campaigns_collection.find(
+        if fmt:
+            return streaming_list_response(
+                "campaigns",
+                stream_query(campaigns_collection, {"user_id": current_user["id"]}, "created_at", position, CAMPAIGN_LIST_PROJECTION),
+                fmt
+            )
+        
+        page = await paginate(
+            campaigns_collection,
             {"user_id": current_user["id"]},
-            {"_id": 0}
-        ).sort("created_at", -1))
+            "created_at",
+            position,
+            limit,
+            CAMPAIGN_LIST_PROJECTION
+        )
         
-        return {"campaigns": campaigns}
+        return {"campaigns": page["items"], "next_cursor": page["next_cursor"]}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch campaigns: {str(e)}")
 
+@app.get("/api/campaigns/{campaign_id}")
+async def get_campaign(campaign_id: str, current_user: dict = Depends(get_current_user)):
+    """Get a single campaign including its recipients"""
+    campaign = await campaigns_collection.find_one({"id": campaign_id, "user_id": current_user["id"]}, {"_id": 0})
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    
+    return {"campaign": campaign}
+
+@app.post("/api/filters")
+async def create_filter(
+    email_filter: EmailFilter,
+    current_user: dict = Depends(get_current_user)
+):
+    """Create a filter applied to incoming mail during inbox sync"""
+    try:
+        filter_doc = {
+            "id": str(uuid.uuid4()),
+            "user_id": current_user["id"],
+            "name": email_filter.name,
+            "conditions": email_filter.conditions,
+            "actions": email_filter.actions,
+            "enabled": email_filter.enabled,
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        }
+        
+        await filters_collection.insert_one(filter_doc)
+        await invalidate_rule_set(current_user["id"])
+        
+        return {"message": "Filter created successfully", "filter_id": filter_doc["id"]}
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to create filter: {str(e)}")
+
+@app.get("/api/filters")
+async def get_filters(current_user: dict = Depends(get_current_user)):
+    """Get user filters in the order they are applied"""
+    try:
+        filters = await filters_collection.find(
+            {"user_id": current_user["id"]}, {"_id": 0}
+        ).sort("created_at", 1).to_list()
+        
+        return {"filters": filters}
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get filters: {str(e)}")
+
+@app.put("/api/filters/{filter_id}")
+async def update_filter(
+    filter_id: str,
+    email_filter: EmailFilter,
+    current_user: dict = Depends(get_current_user)
+):
+    """Replace a filter's conditions and actions"""
+    try:
+        result = await filters_collection.update_one(
+            {"id": filter_id, "user_id": current_user["id"]},
+            {"$set": {
+                "name": email_filter.name,
+                "conditions": email_filter.conditions,
+                "actions": email_filter.actions,
+                "enabled": email_filter.enabled,
+                "updated_at": datetime.utcnow()
+            }}
+        )
+        
+        if result.matched_count == 0:
+            raise HTTPException(status_code=404, detail="Filter not found")
+        await invalidate_rule_set(current_user["id"])
+        
+        return {"message": "Filter updated successfully"}
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to update filter: {str(e)}")
+
+@app.delete("/api/filters/{filter_id}")
+async def delete_filter(filter_id: str, current_user: dict = Depends(get_current_user)):
+    """Delete filter"""
+    try:
+        result = await filters_collection.delete_one({"id": filter_id, "user_id": current_user["id"]})
+        
+        if result.deleted_count == 0:
+            raise HTTPException(status_code=404, detail="Filter not found")
+        await invalidate_rule_set(current_user["id"])
+        
+        return {"message": "Filter deleted successfully"}
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete filter: {str(e)}")
+
 @app.get("/api/analytics/dashboard")
 async def get_dashboard_analytics(current_user: dict = Depends(get_current_user)):
     """Get dashboard analytics"""
     try:
-        # Mock analytics data
-        analytics = {
-            "total_emails_sent": random.randint(50, 500),
-            "total_emails_received": random.randint(100, 1000),
-            "open_rate": round(random.uniform(0.15, 0.45), 2),
-            "click_rate": round(random.uniform(0.02, 0.08), 2),
-            "bounce_rate": round(random.uniform(0.01, 0.05), 2),
-            "unsubscribe_rate": round(random.uniform(0.001, 0.01), 2),
-            "recent_activity": [
-                {
-                    "type": "email_sent",
-                    "count": random.randint(1, 10),
-                    "date": (datetime.utcnow() - timedelta(days=i)).strftime("%Y-%m-%d")
-                }
-                for i in range(7)
-            ],
-            "top_recipients": [
-                {"email": "john@example.com", "count": random.randint(1, 15)},
-                {"email": "jane@startup.com", "count": random.randint(1, 12)},
-                {"email": "info@client.com", "count": random.randint(1, 8)}
-            ]
-        }
+        analytics = await get_dashboard(current_user["id"])
         
         return {"analytics": analytics}
         
@@ -656,4 +1411,5 @@ async def get_dashboard_analytics(current_user: dict = Depends(get_current_user)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    # Extra workers import the app themselves, so they need it by name
+    uvicorn.run(app if WEB_CONCURRENCY == 1 else "server:app", host="0.0.0.0", port=8001, workers=WEB_CONCURRENCY)
\ No newline at end of file
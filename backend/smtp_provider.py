@@ -0,0 +1,412 @@
+"""SMTP delivery backend.
+
+SMTPEmailProvider implements the MockEmailProvider interface on top of
+aiosmtplib:
+
+- SMTPConnectionPool keeps up to SMTP_POOL_SIZE authenticated connections
+  open and hands them out exclusively, so TLS and AUTH happen once per
+  connection instead of once per message. Connections are recycled after
+  SMTP_MAX_MESSAGES_PER_CONNECTION messages and probed with NOOP after
+  sitting idle.
+- When the server advertises PIPELINING (RFC 2920) the MAIL, RCPT and DATA
+  commands of a message are written in one batch and their replies read
+  afterwards, one round trip instead of 2 + recipients. Pipelining stops
+  at the message boundary: the next message's envelope waits for the
+  previous message's final reply, and concurrent sends scale with the
+  pool size rather than batching on one connection.
+- MimeBuilder caches the encoded MIME parts shared by every message built
+  from the same template (the base64 attachment section), so only headers
+  and the rendered text part are encoded per recipient. Sections are keyed
+  by the attachments' content digests, not the template id, so any sends
+  carrying the same files share one entry. Attachments are base64-encoded
+  chunk by chunk as they stream from the blob store, and the cache holds
+  at most SMTP_MIME_CACHE_BYTES of encoded sections.
+
+Reading mail is not part of SMTP, so get_emails/get_changes return nothing.
+"""
+import asyncio
+import base64
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+from email import policy
+from email.message import EmailMessage
+from email.mime.base import MIMEBase
+from email.mime.text import MIMEText
+from email.utils import formataddr, formatdate, make_msgid
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import aiosmtplib
+from aiosmtplib.protocol import LINE_ENDINGS_REGEX, PERIOD_REGEX, SMTPProtocol
+from aiosmtplib.response import SMTPResponse
+
+from attachments import get_blob, stream_blob
+from cache import WeightedTTLCache
+from metrics import timed_provider_call
+
+# .env ships these keys blank until configured, so empty values fall back to defaults
+SMTP_HOST = os.environ.get('SMTP_HOST') or None
+SMTP_USERNAME = os.environ.get('SMTP_USERNAME') or None
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD') or None
+# Implicit TLS (port 465) when true, otherwise STARTTLS on the submission port
+SMTP_USE_TLS = (os.environ.get('SMTP_USE_TLS') or 'false').lower() == 'true'
+SMTP_START_TLS = not SMTP_USE_TLS and (os.environ.get('SMTP_START_TLS') or 'true').lower() == 'true'
+SMTP_PORT = int(os.environ.get('SMTP_PORT') or ('465' if SMTP_USE_TLS else '587'))
+SMTP_FROM = os.environ.get('SMTP_FROM') or SMTP_USERNAME or ''
+SMTP_FROM_NAME = os.environ.get('SMTP_FROM_NAME', 'StartupMail')
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', '4'))
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.environ.get('SMTP_MAX_MESSAGES_PER_CONNECTION', '500'))
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', '30'))
+# Connections idle longer than this are checked with NOOP before reuse
+SMTP_IDLE_CHECK_SECONDS = 30
+SMTP_MIME_CACHE_BYTES = int(os.environ.get('SMTP_MIME_CACHE_BYTES', str(64 * 1024 * 1024)))
+# Raw bytes per base64 line (76 characters)
+BASE64_LINE_BYTES = 57
+
+SMTP_POLICY = policy.SMTP
+
+
+class _PipeliningProtocol(SMTPProtocol):
+    """SMTPProtocol that keeps replies arriving back to back.
+
+    The stock protocol parses one reply per data_received and drops bytes
+    that arrive before the previous reply was consumed, which loses replies
+    to pipelined commands. Here everything is buffered and read_response
+    returns an already buffered reply before waiting. Relies on the
+    internals of the pinned aiosmtplib release (PROTOCOL_INTERNALS).
+    """
+
+    def data_received(self, data: bytes) -> None:
+        self._buffer.extend(data)
+        if self._response_waiter is None or self._response_waiter.done():
+            return
+        try:
+            response = self._read_response_from_buffer()
+        except Exception as exc:
+            self._response_waiter.set_exception(exc)
+        else:
+            if response is not None:
+                self._response_waiter.set_result(response)
+
+    async def read_response(self, timeout: Optional[float] = None) -> SMTPResponse:
+        buffered = self._read_response_from_buffer()
+        if buffered is not None:
+            return buffered
+        return await super().read_response(timeout=timeout)
+
+
+# Private SMTPProtocol attributes _PipeliningProtocol uses (aiosmtplib 2.0.x, pinned in requirements.txt);
+# a release without them gets lock-step commands instead of a broken protocol
+PROTOCOL_INTERNALS = ("_buffer", "_response_waiter", "_read_response_from_buffer")
+
+
+class _Connection:
+    __slots__ = ("client", "sent", "last_used")
+
+    def __init__(self, client: aiosmtplib.SMTP):
+        self.client = client
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def pipelining(self) -> bool:
+        return isinstance(self.client.protocol, _PipeliningProtocol)
+
+
+class SMTPConnectionPool:
+    def __init__(
+        self,
+        hostname: str,
+        port: int = SMTP_PORT,
+        username: Optional[str] = SMTP_USERNAME,
+        password: Optional[str] = SMTP_PASSWORD,
+        use_tls: bool = SMTP_USE_TLS,
+        start_tls: bool = SMTP_START_TLS,
+        size: int = SMTP_POOL_SIZE,
+        max_messages: int = SMTP_MAX_MESSAGES_PER_CONNECTION,
+        timeout: float = SMTP_TIMEOUT
+    ):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.start_tls = start_tls
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.connects = 0
+        self._idle: List[_Connection] = []
+        self._slots = asyncio.Semaphore(size)
+
+    async def _connect(self) -> _Connection:
+        client = aiosmtplib.SMTP(
+            hostname=self.hostname, port=self.port, use_tls=self.use_tls,
+            start_tls=self.start_tls, timeout=self.timeout
+        )
+        await client.connect()
+        if self.username:
+            await client.login(self.username, self.password or "")
+        if client.is_ehlo_or_helo_needed:
+            await client.ehlo()
+        if client.supports_extension("pipelining") and all(
+            hasattr(client.protocol, name) for name in PROTOCOL_INTERNALS
+        ):
+            # aiosmtplib creates its protocol inside connect() with no way to pass a subclass, so the
+            # connected instance is switched over; same state, different reply handling, and the
+            # object survives STARTTLS
+            client.protocol.__class__ = _PipeliningProtocol
+        self.connects += 1
+        return _Connection(client)
+
+    async def _checkout(self) -> _Connection:
+        while self._idle:
+            connection = self._idle.pop()
+            if not connection.client.is_connected:
+                continue
+            if time.monotonic() - connection.last_used < SMTP_IDLE_CHECK_SECONDS:
+                return connection
+            try:
+                await connection.client.noop()
+                return connection
+            except (aiosmtplib.SMTPException, OSError):
+                await self._discard(connection)
+        return await self._connect()
+
+    async def _discard(self, connection: _Connection):
+        try:
+            await connection.client.quit()
+        except Exception:
+            connection.client.close()
+
+    @asynccontextmanager
+    async def connection(self):
+        """Exclusive use of one authenticated connection"""
+        async with self._slots:
+            connection = await self._checkout()
+            try:
+                yield connection
+            except (aiosmtplib.SMTPResponseException, aiosmtplib.SMTPRecipientsRefused):
+                # The server rejected a message but the session is still usable
+                self._release(connection)
+                raise
+            except BaseException:
+                await self._discard(connection)
+                raise
+            else:
+                if connection.sent >= self.max_messages:
+                    await self._discard(connection)
+                else:
+                    self._release(connection)
+
+    def _release(self, connection: _Connection):
+        connection.last_used = time.monotonic()
+        self._idle.append(connection)
+
+    async def aclose(self):
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(self._discard(connection) for connection in idle), return_exceptions=True)
+
+
+def _quote(address: str) -> bytes:
+    return f"<{address}>".encode("utf-8")
+
+
+async def _send_pipelined(client: aiosmtplib.SMTP, sender: str, recipients: Sequence[str], message: bytes,
+                          timeout: float) -> Dict[str, Tuple[int, str]]:
+    """MAIL, RCPT... and DATA in one write (RFC 2920); returns refused recipients"""
+    protocol = client.protocol
+    if protocol is None:
+        raise aiosmtplib.SMTPServerDisconnected("Connection lost")
+
+    commands = [b"MAIL FROM:" + _quote(sender)]
+    commands.extend(b"RCPT TO:" + _quote(recipient) for recipient in recipients)
+    commands.append(b"DATA")
+    protocol.write(b"\r\n".join(commands) + b"\r\n")
+
+    mail_reply = await protocol.read_response(timeout=timeout)
+    refused = {}
+    for recipient in recipients:
+        reply = await protocol.read_response(timeout=timeout)
+        if reply.code not in (250, 251):
+            refused[recipient] = (reply.code, reply.message)
+    data_reply = await protocol.read_response(timeout=timeout)
+
+    if data_reply.code == 354:
+        if mail_reply.code != 250 or len(refused) == len(recipients):
+            # Nothing can be delivered; end the data phase empty and reset the envelope
+            protocol.write(b".\r\n")
+            await protocol.read_response(timeout=timeout)
+        else:
+            body = PERIOD_REGEX.sub(b"..", LINE_ENDINGS_REGEX.sub(b"\r\n", message))
+            if not body.endswith(b"\r\n"):
+                body += b"\r\n"
+            protocol.write(body + b".\r\n")
+            final_reply = await protocol.read_response(timeout=timeout)
+            if final_reply.code != 250:
+                raise aiosmtplib.SMTPDataError(final_reply.code, final_reply.message)
+            return refused
+
+    await client.rset(timeout=timeout)
+    if mail_reply.code != 250:
+        raise aiosmtplib.SMTPSenderRefused(mail_reply.code, mail_reply.message, sender)
+    if len(refused) == len(recipients):
+        raise aiosmtplib.SMTPRecipientsRefused([
+            aiosmtplib.SMTPRecipientRefused(code, message, recipient)
+            for recipient, (code, message) in refused.items()
+        ])
+    raise aiosmtplib.SMTPDataError(data_reply.code, data_reply.message)
+
+
+def _header_lines(headers: Sequence[Tuple[str, str]]) -> bytes:
+    """Folded header lines, non-ASCII values as RFC 2047 encoded words; empty values are left out"""
+    message = EmailMessage(policy=SMTP_POLICY)
+    for name, value in headers:
+        if value:
+            message[name] = value
+    return b"".join(SMTP_POLICY.fold(name, value).encode("ascii") for name, value in message.items())
+
+
+def _base64_lines(data: bytes) -> bytes:
+    return base64.encodebytes(data).replace(b"\n", b"\r\n")
+
+
+class MimeBuilder:
+    """Builds RFC 5322 messages, caching the encoded attachment sections a template's messages share"""
+
+    def __init__(self, cache_size: int = 64, cache_bytes: int = SMTP_MIME_CACHE_BYTES):
+        # attachment digests -> (boundary, encoded attachment section), bounded by the sections' total size
+        self._sections = WeightedTTLCache(
+            maxsize=cache_size, ttl=3600, maxweight=cache_bytes, weigh=lambda cached: len(cached[1])
+        )
+
+    async def _attachment_section(self, attachments: Sequence[Dict[str, Any]]) -> Tuple[str, bytes]:
+        key = tuple(attachment["sha256"] for attachment in attachments)
+        cached = self._sections.get(key)
+        if cached is not None:
+            return cached
+
+        boundary = f"=_startupmail_{uuid.uuid4().hex}"
+        section = bytearray()
+        for attachment in attachments:
+            blob = await get_blob(attachment["sha256"])
+            if blob is None:
+                raise ValueError(f"Attachment content missing: {attachment['filename']}")
+            maintype, _, subtype = attachment["content_type"].partition("/")
+            part = MIMEBase(maintype or "application", subtype or "octet-stream")
+            part["Content-Transfer-Encoding"] = "base64"
+            part.add_header("Content-Disposition", "attachment", filename=attachment["filename"])
+            del part["MIME-Version"]
+            part.set_payload("")
+            # Headers and the blank line; the body is encoded as the blob streams in
+            section += f"--{boundary}\r\n".encode() + part.as_bytes(policy=SMTP_POLICY)
+            pending = b""
+            async for chunk in stream_blob(blob, 0, blob["size"] - 1):
+                pending += chunk
+                whole = len(pending) - len(pending) % BASE64_LINE_BYTES
+                section += _base64_lines(pending[:whole])
+                pending = pending[whole:]
+            section += _base64_lines(pending) + b"\r\n"
+        section += f"--{boundary}--\r\n".encode()
+
+        cached = (boundary, bytes(section))
+        self._sections.set(key, cached)
+        return cached
+
+    async def build(self, sender: str, sender_name: str, email_data: Dict[str, Any]) -> Tuple[bytes, str]:
+        """(message bytes, Message-ID) for a send payload"""
+        message_id = make_msgid(domain=sender.rpartition("@")[2] or None)
+        text = MIMEText(email_data["body"], "html" if email_data.get("is_html") else "plain", "utf-8")
+        headers = [
+            ("From", formataddr((sender_name, sender))),
+            ("To", ", ".join(email_data["to"])),
+            ("Cc", ", ".join(email_data.get("cc") or [])),
+            ("Subject", email_data["subject"]),
+            ("Date", formatdate(usegmt=True)),
+            ("Message-ID", message_id),
+            ("In-Reply-To", email_data.get("in_reply_to") or ""),
+            ("References", " ".join(email_data.get("references") or []))
+        ]
+
+        head = _header_lines(headers)
+
+        attachments = email_data.get("attachments") or []
+        if not attachments:
+            return head + text.as_bytes(policy=SMTP_POLICY), message_id
+
+        boundary, section = await self._attachment_section(attachments)
+        del text["MIME-Version"]
+        head += b"MIME-Version: 1.0\r\n"
+        head += f'Content-Type: multipart/mixed; boundary="{boundary}"\r\n\r\n'.encode()
+        return (
+            head + f"--{boundary}\r\n".encode() + text.as_bytes(policy=SMTP_POLICY) + b"\r\n" + section,
+            message_id
+        )
+
+
+class SMTPEmailProvider:
+    """Sends through an SMTP relay with the same interface as MockEmailProvider"""
+
+    provider_type = "SMTP"
+
+    def __init__(self, pool: SMTPConnectionPool, sender: str = SMTP_FROM, sender_name: str = SMTP_FROM_NAME):
+        self.pool = pool
+        self.sender = sender
+        self.sender_name = sender_name
+        self.mime = MimeBuilder()
+
+    @classmethod
+    def from_env(cls) -> Optional["SMTPEmailProvider"]:
+        return cls(SMTPConnectionPool(SMTP_HOST)) if SMTP_HOST else None
+
+    @timed_provider_call
+    async def authenticate_oauth(self, auth_code: str) -> Dict[str, Any]:
+        """SMTP credentials come from configuration; there is no OAuth exchange"""
+        return {
+            "access_token": "smtp",
+            "refresh_token": None,
+            "expires_in": 10 * 365 * 24 * 3600,
+            "email": self.sender
+        }
+
+    @timed_provider_call
+    async def get_emails(self, access_token: str, folder: str = "inbox") -> List:
+        return []
+
+    @timed_provider_call
+    async def get_changes(self, access_token: str, cursor: Optional[str] = None) -> Dict[str, Any]:
+        return {"messages": [], "cursor": cursor}
+
+    async def _prepare(self, email_data: Dict[str, Any]) -> Tuple[bytes, str, List[str]]:
+        message, message_id = await self.mime.build(self.sender, self.sender_name, email_data)
+        recipients = list(email_data["to"]) + list(email_data.get("cc") or []) + list(email_data.get("bcc") or [])
+        return message, message_id, recipients
+
+    async def _deliver(self, connection: _Connection, message: bytes, message_id: str,
+                       recipients: List[str]) -> Dict[str, Any]:
+        if connection.pipelining:
+            refused = await _send_pipelined(connection.client, self.sender, recipients, message, self.pool.timeout)
+        else:
+            refused, _ = await connection.client.sendmail(self.sender, recipients, message)
+        connection.sent += 1
+        return {
+            "message_id": message_id,
+            "status": "sent",
+            "sent_at": datetime.utcnow().isoformat(),
+            "refused_recipients": sorted(refused)
+        }
+
+    @timed_provider_call
+    async def send_email(self, access_token: str, email_data: Dict) -> Dict:
+        # Build before checking out a connection so it is only held while talking to the server
+        prepared = await self._prepare(email_data)
+        async with self.pool.connection() as connection:
+            return await self._deliver(connection, *prepared)
+
+    @timed_provider_call
+    async def get_profile(self, access_token: str) -> Dict:
+        return {"email": self.sender, "name": self.sender_name, "picture": None}
+
+    async def aclose(self):
+        await self.pool.aclose()
@@ -0,0 +1,69 @@
+"""Streaming list responses.
+
+Large list endpoints can stream instead of materialising every document
+and running it through jsonable_encoder. Documents are read from the Mongo
+cursor in batches and encoded with orjson, which handles datetime natively,
+as either NDJSON (`Accept: application/x-ndjson`) or a chunked JSON object
+with the same shape as the buffered response (`?stream=true`).
+"""
+from typing import AsyncIterable, Dict, Optional
+
+import orjson
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Documents per chunk written to the socket
+STREAM_CHUNK_SIZE = 200
+
+
+def stream_format(request: Request, stream: bool) -> Optional[str]:
+    """Pick 'ndjson', 'json' or None (buffered) from the Accept header and ?stream flag"""
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        return "ndjson"
+    return "json" if stream else None
+
+
+def _default(value):
+    return str(value)
+
+
+async def _ndjson_chunks(documents: AsyncIterable[Dict]):
+    chunk = bytearray()
+    count = 0
+    async for document in documents:
+        chunk += orjson.dumps(document, default=_default, option=orjson.OPT_APPEND_NEWLINE)
+        count += 1
+        if count == STREAM_CHUNK_SIZE:
+            yield bytes(chunk)
+            chunk.clear()
+            count = 0
+    if chunk:
+        yield bytes(chunk)
+
+
+async def _json_chunks(key: str, documents: AsyncIterable[Dict]):
+    chunk = bytearray(orjson.dumps(key))
+    chunk[:0] = b"{"
+    chunk += b":["
+    count = 0
+    first = True
+    async for document in documents:
+        if not first:
+            chunk += b","
+        first = False
+        chunk += orjson.dumps(document, default=_default)
+        count += 1
+        if count == STREAM_CHUNK_SIZE:
+            yield bytes(chunk)
+            chunk.clear()
+            count = 0
+    chunk += b'],"next_cursor":null}'
+    yield bytes(chunk)
+
+
+def streaming_list_response(key: str, documents: AsyncIterable[Dict], fmt: str) -> StreamingResponse:
+    """Stream documents as NDJSON or as {key: [...], "next_cursor": null}"""
+    if fmt == "ndjson":
+        return StreamingResponse(_ndjson_chunks(documents), media_type=NDJSON_MEDIA_TYPE)
+    return StreamingResponse(_json_chunks(key, documents), media_type="application/json")
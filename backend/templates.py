@@ -0,0 +1,130 @@
+"""Email templates: predefined startup templates, lookup and rendering.
+
+Templates use `{name}` placeholders. Each template is parsed once into a
+CompiledTemplate (alternating literal text and variable names) and cached
+by (template_id, updated_at), so rendering a recipient is a single join
+over precomputed pieces. Braces that do not wrap an identifier, such as
+inline CSS, are kept as literal text.
+"""
+import re
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from cache import TTLCache
+from database import templates_collection
+
+PLACEHOLDER_RE = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+# Predefined templates available to every user
+STARTUP_TEMPLATES = [
+    {
+        "id": "welcome_investor",
+        "name": "Investor Welcome Email",
+        "category": "Investor Relations",
+        "subject": "Welcome to {company_name} - Investment Opportunity",
+        "body": "<p>Dear {investor_name},</p><p>Thank you for your interest in {company_name}. We're excited to share our vision with you...</p>",
+        "is_html": True
+    },
+    {
+        "id": "product_launch",
+        "name": "Product Launch Announcement",
+        "category": "Marketing",
+        "subject": "🚀 Introducing {product_name} - Now Live!",
+        "body": "<p>Hi {customer_name},</p><p>We're thrilled to announce the launch of {product_name}! After months of development...</p>",
+        "is_html": True
+    },
+    {
+        "id": "partnership_proposal",
+        "name": "Partnership Proposal",
+        "category": "Business Development",
+        "subject": "Partnership Opportunity - {company_name}",
+        "body": "<p>Hello {partner_name},</p><p>I hope this email finds you well. I'm reaching out to explore a potential partnership...</p>",
+        "is_html": True
+    }
+]
+
+STARTUP_TEMPLATES_BY_ID = {template["id"]: template for template in STARTUP_TEMPLATES}
+
+
+async def load_template(template_id: str, user_id: str) -> Optional[Dict]:
+    """Find a user's template, falling back to the predefined startup templates"""
+    template = await templates_collection.find_one({"id": template_id, "user_id": user_id})
+    return template or STARTUP_TEMPLATES_BY_ID.get(template_id)
+
+
+class CompiledTemplate:
+    """A template string split into literal text and placeholder names"""
+
+    __slots__ = ("source", "_pieces", "_slots")
+
+    def __init__(self, source: str):
+        self.source = source
+        self._pieces: List[str] = []
+        self._slots: List[Tuple[int, str]] = []
+        position = 0
+        for match in PLACEHOLDER_RE.finditer(source):
+            self._pieces.append(source[position:match.start()])
+            # Unresolved placeholders render as their original text
+            self._pieces.append(match.group(0))
+            self._slots.append((len(self._pieces) - 1, match.group(1)))
+            position = match.end()
+        self._pieces.append(source[position:])
+
+    @property
+    def variables(self) -> List[str]:
+        return [name for _, name in self._slots]
+
+    def render(self, variables: Mapping[str, str], defaults: Optional[Mapping[str, str]] = None) -> str:
+        """Substitute placeholders, looking in `variables` first and then `defaults`"""
+        if not self._slots:
+            return self.source
+        pieces = self._pieces.copy()
+        for index, name in self._slots:
+            value = variables.get(name)
+            if value is None and defaults is not None:
+                value = defaults.get(name)
+            if value is not None:
+                pieces[index] = str(value)
+        return "".join(pieces)
+
+
+class CompiledEmailTemplate:
+    """Compiled subject and body of one template"""
+
+    __slots__ = ("subject", "body", "is_html")
+
+    def __init__(self, template: Dict):
+        self.subject = CompiledTemplate(template["subject"])
+        self.body = CompiledTemplate(template["body"])
+        self.is_html = template.get("is_html", True)
+
+    def render(self, variables: Mapping[str, str], defaults: Optional[Mapping[str, str]] = None) -> Tuple[str, str]:
+        return self.subject.render(variables, defaults), self.body.render(variables, defaults)
+
+    def render_batch(
+        self,
+        recipient_variables: Iterable[Mapping[str, str]],
+        defaults: Optional[Mapping[str, str]] = None
+    ) -> Iterator[Tuple[str, str]]:
+        """Lazily render (subject, body) for each recipient's variables"""
+        subject, body = self.subject, self.body
+        for variables in recipient_variables:
+            yield subject.render(variables, defaults), body.render(variables, defaults)
+
+
+_compiled_templates = TTLCache(maxsize=1024, ttl=3600)
+
+
+def compile_template(template: Dict) -> CompiledEmailTemplate:
+    """Return the compiled form of a template, parsing it only on first use or after an update"""
+    if template.get("id") is None:
+        return CompiledEmailTemplate(template)
+    key = (template["id"], template.get("updated_at"))
+    compiled = _compiled_templates.get(key)
+    if compiled is None:
+        compiled = CompiledEmailTemplate(template)
+        _compiled_templates.set(key, compiled)
+    return compiled
+
+
+def template_cache_stats() -> Dict:
+    return _compiled_templates.stats()
@@ -0,0 +1,429 @@
+"""API load-test suite for regression comparison.
+
+Boots the app in-process (lifespan included) against MONGO_URL or, with
+--mongomock, an in-memory mongomock stand-in. It seeds --users synthetic
+users, each with a session, two mail accounts, --emails messages (a fifth
+of them sent), --drafts drafts, --templates templates and --campaigns
+campaigns, plus analytics rollups reconciled from that mail. Then it
+drives each scenario with --requests requests at --concurrency, spread
+round-robin over the users, after --warmup unrecorded requests.
+
+Every scenario reports throughput, latency (mean, p50, p95, p99, max) and
+Mongo commands per request. The command count comes from the route's
+http_request_mongo_commands histogram. Against MongoDB that histogram is
+fed by the command listener; under --mongomock each top-level collection
+call is charged instead, so the two modes are not comparable with each
+other. The results are written as JSON. With --baseline the run is
+compared against an earlier JSON file and exits with status 1 if any
+scenario lost throughput, or gained p95 latency or Mongo commands, by more
+than --tolerance.
+
+Background workers are off and INBOX_SYNC_INTERVAL defaults to an hour,
+so the inbox scenario measures the local-store read. The send scenario
+includes the mock provider's simulated 0.5 s API call.
+
+Usage: python scripts/bench_api.py [--mongomock] [--users 10] [--emails 2000] [--drafts 2000] [--templates 20]
+                                   [--campaigns 200] [--requests 500] [--concurrency 16] [--scenarios inbox,...]
+                                   [--output results.json] [--baseline previous.json] [--tolerance 0.1]
+Requires MONGO_URL to point at a disposable MongoDB instance, unless --mongomock is given.
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+BODY_WORDS = (
+    "quarterly roadmap investor update hiring plan pricing launch customer feedback onboarding "
+    "integration contract renewal security audit deadline budget forecast pipeline demo metrics"
+).split()
+
+# mongomock collection methods charged as one Mongo command each
+MONGOMOCK_COMMANDS = (
+    "find", "find_one", "find_one_and_update", "insert_one", "insert_many", "update_one", "update_many",
+    "replace_one", "delete_one", "delete_many", "count_documents", "aggregate", "distinct", "bulk_write"
+)
+
+
+def use_mongomock():
+    """Swap pymongo's client for mongomock and charge its calls to the current request"""
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("--mongomock needs the mongomock package (pip install -r backend/requirements-dev.txt)")
+    import pymongo
+
+    # mongomock is not thread-safe; one database thread serialises its calls
+    os.environ['MONGO_POOL_SIZE'] = '1'
+    os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+    pymongo.MongoClient = mongomock.MongoClient
+
+    from metrics import MONGO_COMMAND_SECONDS, current_request_stats
+
+    # mongomock methods call each other (find_one -> find); only the outermost call is a command
+    depth = threading.local()
+
+    def counted(command, method):
+        @functools.wraps(method)
+        def call(self, *args, **kwargs):
+            if getattr(depth, "value", 0):
+                return method(self, *args, **kwargs)
+            depth.value = 1
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                depth.value = 0
+                seconds = time.perf_counter() - start
+                MONGO_COMMAND_SECONDS.observe(seconds, command, self.name, "ok")
+                stats = current_request_stats()
+                if stats is not None:
+                    stats.record_mongo(f"{command} {self.name}", seconds)
+        return call
+
+    for command in MONGOMOCK_COMMANDS:
+        setattr(mongomock.Collection, command, counted(command, getattr(mongomock.Collection, command)))
+
+    # mongomock ignores partialFilterExpression, so a partial unique index would reject
+    # documents MongoDB leaves out of it (sent mail has no provider_message_id)
+    create_indexes = mongomock.Collection.create_indexes
+
+    def create_indexes_without_partial_unique(self, indexes, *args, **kwargs):
+        models = []
+        for model in indexes:
+            document = dict(model.document)
+            if "partialFilterExpression" in document:
+                keys = list(document.pop("key").items())
+                document.pop("unique", None)
+                document.pop("partialFilterExpression")
+                model = pymongo.IndexModel(keys, **document)
+            models.append(model)
+        return create_indexes(self, models, *args, **kwargs)
+
+    mongomock.Collection.create_indexes = create_indexes_without_partial_unique
+
+
+def words(rng: random.Random, count: int) -> str:
+    return " ".join(rng.choices(BODY_WORDS, k=count))
+
+
+def new_id(rng: random.Random) -> str:
+    """A uuid4-shaped id drawn from the seeded generator, so reruns build the same data set"""
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def seed(args, rng: random.Random) -> list:
+    """Insert the synthetic data set and return one dict per user with what the scenarios need"""
+    import database
+    from analytics import reconcile_user
+    from drafts import content_hashes
+    from search import search_tokens
+
+    db = database.db
+    now = datetime.utcnow()
+    users = []
+    for i in range(args.users):
+        user_id = f"bench-api-{i}"
+        token = f"bench-api-token-{i}"
+        accounts = [f"{user_id}-gmail", f"{user_id}-outlook"]
+        contacts = [f"contact{j}@customer{j % 50}.com" for j in range(200)]
+        db.users.insert_one({"id": user_id, "email": f"{user_id}@bench.local", "name": f"Bench {i}", "created_at": now})
+        db.sessions.insert_one({
+            "session_token": token, "user_id": user_id, "created_at": now, "expires_at": now + timedelta(days=1)
+        })
+        db.email_accounts.insert_many([
+            {
+                "id": account_id, "user_id": user_id, "provider": provider, "email": f"{user_id}@{provider}.com",
+                "name": f"Bench {i}", "access_token": "bench", "refresh_token": "bench",
+                "token_expires_at": now + timedelta(days=1), "is_primary": provider == "gmail",
+                "created_at": now, "last_synced_at": now
+            }
+            for account_id, provider in zip(accounts, ("gmail", "outlook"))
+        ])
+
+        emails = []
+        for j in range(args.emails):
+            sent = j % 5 == 0
+            when = now - timedelta(minutes=j * 7)
+            email = {
+                "id": new_id(rng), "user_id": user_id, "account_id": accounts[j % 2],
+                "provider_message_id": f"bench-{new_id(rng)}", "thread_id": new_id(rng),
+                "from": f"{user_id}@gmail.com" if sent else rng.choice(contacts),
+                "to": [rng.choice(contacts)] if sent else [f"{user_id}@gmail.com"],
+                "cc": [], "subject": words(rng, 5).capitalize(), "body": words(rng, 80),
+                "folder": "sent" if sent else "inbox", "labels": [], "is_read": rng.random() < 0.6,
+                "is_important": rng.random() < 0.1, "received_at": when
+            }
+            if sent:
+                email["sent_at"] = when
+            email["search_tokens"] = search_tokens(email)
+            emails.append(email)
+        if emails:
+            db.emails.insert_many(emails, ordered=False)
+
+        draft_ids = []
+        drafts = []
+        for j in range(args.drafts):
+            fields = {
+                "to": [rng.choice(contacts)], "cc": [], "bcc": [], "subject": words(rng, 4),
+                "body": words(rng, 120), "is_html": False
+            }
+            draft_id = new_id(rng)
+            draft_ids.append(draft_id)
+            drafts.append(dict(
+                fields, id=draft_id, user_id=user_id, content_hash=content_hashes(fields)[0],
+                created_at=now - timedelta(minutes=j), updated_at=now - timedelta(minutes=j)
+            ))
+        if drafts:
+            db.drafts.insert_many(drafts, ordered=False)
+
+        template_ids = [new_id(rng) for _ in range(args.templates)]
+        if template_ids:
+            db.templates.insert_many([
+                {
+                    "id": template_id, "user_id": user_id, "name": f"Template {j}", "category": "outreach",
+                    "subject": "Hi {{first_name}}, " + words(rng, 4),
+                    "body": "Hello {{first_name}},\n\n" + words(rng, 100) + "\n\n{{sender_name}}",
+                    "created_at": now - timedelta(days=j), "updated_at": now - timedelta(days=j)
+                }
+                for j, template_id in enumerate(template_ids)
+            ])
+
+        if args.campaigns and template_ids:
+            campaigns = []
+            for j in range(args.campaigns):
+                recipients = rng.sample(contacts, 50)
+                completed = now - timedelta(hours=j * 3)
+                campaigns.append({
+                    "id": new_id(rng), "user_id": user_id, "name": f"Campaign {j}",
+                    "template_id": rng.choice(template_ids), "recipients": recipients,
+                    "variables": {"sender_name": f"Bench {i}"}, "recipient_variables": {}, "attachments": [],
+                    "schedule_at": completed, "status": "completed", "created_at": completed,
+                    "started_at": completed, "completed_at": completed,
+                    "sent_count": len(recipients) - 1, "failed_count": 1
+                })
+            db.campaigns.insert_many(campaigns, ordered=False)
+
+        asyncio.run(reconcile_user(user_id))
+        users.append({
+            "id": user_id, "headers": {"Authorization": f"Bearer {token}"}, "contacts": contacts,
+            "draft_ids": draft_ids, "template_ids": template_ids
+        })
+    return users
+
+
+def cleanup(users: list):
+    import database
+
+    user_ids = [user["id"] for user in users]
+    for name in ("emails", "drafts", "templates", "campaigns", "email_accounts", "sessions", "threads",
+                 "analytics_totals", "analytics_daily", "analytics_recipients"):
+        database.db[name].delete_many({"user_id": {"$in": user_ids}})
+    database.db.users.delete_many({"id": {"$in": user_ids}})
+
+
+# name -> (method, route, request builder taking (user, rng) and returning request kwargs)
+SCENARIOS = {
+    "inbox": ("GET", "/api/emails/inbox", lambda user, rng: {"params": {"limit": 50}}),
+    "send": ("POST", "/api/emails/send", lambda user, rng: {"json": {
+        "to": [rng.choice(user["contacts"])], "subject": words(rng, 5), "body": words(rng, 60)
+    }}),
+    "drafts_list": ("GET", "/api/emails/drafts", lambda user, rng: {"params": {"limit": 50}}),
+    "drafts_save": ("POST", "/api/emails/drafts", lambda user, rng: {
+        "params": {"draft_id": rng.choice(user["draft_ids"])},
+        "json": {"to": [rng.choice(user["contacts"])], "subject": words(rng, 4), "body": words(rng, 120)}
+    }),
+    "campaigns_list": ("GET", "/api/campaigns", lambda user, rng: {"params": {"limit": 50}}),
+    "campaigns_create": ("POST", "/api/campaigns", lambda user, rng: {"json": {
+        "name": words(rng, 3), "template_id": rng.choice(user["template_ids"]),
+        "recipients": rng.sample(user["contacts"], 50), "variables": {"sender_name": "Bench"}
+    }}),
+    "dashboard": ("GET", "/api/analytics/dashboard", lambda user, rng: {}),
+}
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_scenario(client: httpx.AsyncClient, name: str, users: list, args, rng: random.Random) -> dict:
+    from metrics import HTTP_REQUEST_MONGO_COMMANDS
+
+    method, route, build = SCENARIOS[name]
+
+    async def drive(count: int, latencies=None, statuses=None):
+        sequence = iter(range(count))
+
+        async def worker():
+            for i in sequence:
+                user = users[i % len(users)]
+                request = build(user, rng)
+                start = time.perf_counter()
+                response = await client.request(method, route, headers=user["headers"], **request)
+                if latencies is not None:
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+    await drive(args.warmup)
+    commands_before = HTTP_REQUEST_MONGO_COMMANDS.sum(route)
+    observed_before = HTTP_REQUEST_MONGO_COMMANDS.count(route)
+    latencies, statuses = [], {}
+    start = time.perf_counter()
+    await drive(args.requests, latencies, statuses)
+    elapsed = time.perf_counter() - start
+    observed = HTTP_REQUEST_MONGO_COMMANDS.count(route) - observed_before
+
+    latencies.sort()
+    return {
+        "method": method,
+        "route": route,
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if not status.startswith("2")),
+        "status": statuses,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 2),
+            "p50": round(percentile(latencies, 0.50), 2),
+            "p95": round(percentile(latencies, 0.95), 2),
+            "p99": round(percentile(latencies, 0.99), 2),
+            "max": round(latencies[-1], 2)
+        },
+        "mongo_ops_per_request": round((HTTP_REQUEST_MONGO_COMMANDS.sum(route) - commands_before) / observed, 2)
+        if observed else None
+    }
+
+
+async def run(args, scenarios: list, users: list) -> dict:
+    from server import app, lifespan
+
+    rng = random.Random(args.seed)
+    results = {}
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for name in scenarios:
+                results[name] = await run_scenario(client, name, users, args, rng)
+                summary = results[name]
+                print(f"{name:<17} {summary['throughput_rps']:>9.1f} {summary['latency_ms']['p50']:>8.2f} "
+                      f"{summary['latency_ms']['p95']:>8.2f} {summary['latency_ms']['p99']:>8.2f} "
+                      f"{summary['mongo_ops_per_request'] if summary['mongo_ops_per_request'] is not None else '-':>9} "
+                      f"{summary['errors']:>6}", file=sys.stderr)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Print each scenario against the baseline; returns the regressions found"""
+    regressions = []
+    print(f"\n{'vs baseline':<17} {'req/s':>9} {'p95':>9} {'mongo ops':>10}", file=sys.stderr)
+    for name, result in report["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        throughput = result["throughput_rps"] / before["throughput_rps"] - 1
+        p95 = result["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1
+        ops_before, ops = before.get("mongo_ops_per_request"), result["mongo_ops_per_request"]
+        ops_change = ops - ops_before if ops is not None and ops_before is not None else None
+        print(f"{name:<17} {throughput:>+9.1%} {p95:>+9.1%} "
+              f"{'-' if ops_change is None else f'{ops_change:+.2f}':>10}", file=sys.stderr)
+        if throughput < -tolerance:
+            regressions.append(f"{name}: throughput {throughput:+.1%}")
+        if p95 > tolerance:
+            regressions.append(f"{name}: p95 latency {p95:+.1%}")
+        if ops_change is not None and ops_change > ops_before * tolerance:
+            regressions.append(f"{name}: Mongo commands per request {ops_before} -> {ops}")
+    return regressions
+
+
+def main(args):
+    scenarios = args.scenarios.split(",")
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)} (choose from {', '.join(SCENARIOS)})")
+
+    # The backend reads its configuration at import time, so it is only imported from here on
+    os.environ.setdefault('CAMPAIGN_WORKER_ENABLED', 'false')
+    os.environ.setdefault('SCHEDULED_SEND_ENABLED', 'false')
+    os.environ.setdefault('INBOX_SYNC_INTERVAL', '3600')
+    # Every send waits on the mock provider for 0.5 s; without this each one is logged as slow
+    os.environ.setdefault('SLOW_REQUEST_MS', '5000')
+    if args.mongomock:
+        use_mongomock()
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    users = seed(args, rng)
+    print(f"seeded {args.users} users in {time.perf_counter() - start:.1f}s; "
+          f"{args.requests} requests per scenario at concurrency {args.concurrency}", file=sys.stderr)
+    print(f"{'scenario':<17} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'mongo ops':>9} {'errors':>6}",
+          file=sys.stderr)
+    try:
+        results = asyncio.run(run(args, scenarios, users))
+    finally:
+        cleanup(users)
+
+    report = {
+        "benchmark": "api",
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "mongo": "mongomock" if args.mongomock else "mongodb",
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "scenarios": results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongomock", action="store_true", help="run against an in-memory mongomock database")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--emails", type=int, default=2000, help="messages per user")
+    parser.add_argument("--drafts", type=int, default=2000, help="drafts per user")
+    parser.add_argument("--templates", type=int, default=20, help="templates per user")
+    parser.add_argument("--campaigns", type=int, default=200, help="campaigns per user")
+    parser.add_argument("--requests", type=int, default=500, help="recorded requests per scenario")
+    parser.add_argument("--warmup", type=int, default=50, help="unrecorded requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=7, help="seed for the synthetic data and requests")
+    parser.add_argument("--output", default="-", help="JSON results file, - for stdout")
+    parser.add_argument("--baseline", help="earlier JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression")
+    main(parser.parse_args())
@@ -0,0 +1,91 @@
+"""Event-loop responsiveness benchmark.
+
+Hammers GET /api/emails/drafts with a large draft set while sampling
+GET /api/health, and reports health-check latency percentiles. With the
+threaded data layer the health p99 should stay flat under load.
+
+Usage: python scripts/bench_event_loop.py [--drafts 5000] [--concurrency 32] [--duration 10]
+Requires MONGO_URL to point at a disposable MongoDB instance.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import httpx
+
+import database
+from server import app
+
+
+def seed(draft_count: int) -> str:
+    """Create a throwaway user with `draft_count` drafts and return its session token"""
+    user_id = f"bench_{uuid.uuid4()}"
+    token = f"bench_token_{uuid.uuid4()}"
+    now = datetime.utcnow()
+    database.db.users.insert_one({
+        "id": user_id, "email": f"{user_id}@bench.local", "name": "Bench", "created_at": now
+    })
+    database.db.sessions.insert_one({
+        "session_token": token, "user_id": user_id, "created_at": now,
+        "expires_at": now + timedelta(hours=1)
+    })
+    database.db.drafts.insert_many([
+        {
+            "id": str(uuid.uuid4()), "user_id": user_id, "to": ["someone@example.com"],
+            "cc": [], "bcc": [], "subject": f"Draft {i}", "body": "Lorem ipsum " * 50,
+            "is_html": False, "created_at": now, "updated_at": now - timedelta(seconds=i)
+        }
+        for i in range(draft_count)
+    ])
+    return token
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run(args):
+    token = seed(args.drafts)
+    headers = {"Authorization": f"Bearer {token}"}
+    transport = httpx.ASGITransport(app=app)
+    deadline = time.perf_counter() + args.duration
+    health_latencies = []
+    drafts_requests = 0
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def hammer():
+            nonlocal drafts_requests
+            while time.perf_counter() < deadline:
+                await client.get("/api/emails/drafts", headers=headers)
+                drafts_requests += 1
+
+        async def probe():
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                await client.get("/api/health")
+                health_latencies.append((time.perf_counter() - start) * 1000)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(probe(), *(hammer() for _ in range(args.concurrency)))
+
+    print(f"drafts requests: {drafts_requests} ({drafts_requests / args.duration:.1f} req/s)")
+    print(f"health samples:  {len(health_latencies)}")
+    print(f"health p50: {statistics.median(health_latencies):.2f} ms")
+    print(f"health p99: {percentile(health_latencies, 99):.2f} ms")
+    print(f"health max: {max(health_latencies):.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--drafts", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,87 @@
+"""Outbound HTTP client pooling benchmark.
+
+Starts a minimal keep-alive HTTP/1.1 stub server on localhost and measures
+per-call latency of a fresh httpx.AsyncClient per request (the old
+authenticate_session pattern) against the shared HTTPClientPool client.
+
+Usage: python scripts/bench_http_pool.py [--calls 500] [--concurrency 1]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import httpx
+
+from http_clients import HTTPClientPool
+
+RESPONSE_BODY = b'{"id": "stub", "email": "stub@example.com", "name": "Stub"}'
+RESPONSE = (
+    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+    b"Content-Length: " + str(len(RESPONSE_BODY)).encode() + b"\r\n\r\n" + RESPONSE_BODY
+)
+
+
+async def handle(reader, writer):
+    try:
+        while True:
+            request = await reader.readuntil(b"\r\n\r\n")
+            if not request:
+                break
+            writer.write(RESPONSE)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+
+async def measure(label, call, calls, concurrency):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await call()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(calls)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{label:<16} mean {statistics.mean(latencies):7.2f} ms  "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1]:7.2f} ms  {calls / elapsed:8.0f} req/s")
+    return statistics.mean(latencies)
+
+
+async def run(args):
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/auth/v1/env/oauth/session-data"
+    pool = HTTPClientPool()
+
+    async def unpooled():
+        async with httpx.AsyncClient() as client:
+            await client.get(url, headers={"X-Session-ID": "bench"})
+
+    async def pooled():
+        await pool.get("stub").get(url, headers={"X-Session-ID": "bench"})
+
+    async with server:
+        await pooled()  # warm up the keep-alive connection
+        fresh = await measure("client per call", unpooled, args.calls, args.concurrency)
+        shared = await measure("pooled client", pooled, args.calls, args.concurrency)
+        print(f"pooled client is {fresh / shared:.1f}x faster per call")
+        await pool.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,153 @@
+"""IMAP ingestion benchmark: IDLE push vs interval polling.
+
+Runs the IMAP ingestion worker against the in-process IMAP stub
+(scripts/imap_stub.py) for N accounts while mail arrives at random, once
+parked in IDLE and once polling each mailbox with UID FETCH every
+--poll-interval seconds (what the polling sync amounts to). Reports the
+commands and bytes the server had to handle, and the delay from delivery
+to the new-mail notification a client would receive.
+
+Usage: python scripts/bench_imap_ingest.py [--accounts 20] [--duration 60] [--mean-arrival 20] [--poll-interval 5]
+Requires a reachable MONGO_URL (messages are written to the local store).
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from database import email_accounts_collection, emails_collection
+from imap_ingest import IMAPIngestor
+from imap_stub import IMAPStub
+from notifications import mail_notifier
+
+
+class PollingIngestor(IMAPIngestor):
+    """The same fetch path, driven by a timer instead of IDLE"""
+
+    def __init__(self, *args, poll_interval: float, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.poll_interval = poll_interval
+
+    async def _session(self, account):
+        client = self._connect()
+        await client.wait_hello_from_server()
+        await self._command("login", client.login(account["email"], "secret"))
+        await self._command("select", client.select(self.mailbox))
+        last_uid = 0
+        while True:
+            last_uid = await self._fetch_new(client, account, 1, last_uid)
+            self._live.add(account["id"])
+            await asyncio.sleep(self.poll_interval)
+
+
+def make_message(account_email: str, sequence: int) -> bytes:
+    return (
+        f"From: Sender {sequence} <sender{sequence}@example.com>\r\n"
+        f"To: {account_email}\r\n"
+        f"Subject: Benchmark message {sequence}\r\n"
+        f"Message-ID: <{uuid.uuid4()}@example.com>\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n\r\n"
+        + "Hello from the ingestion benchmark.\r\n" * 20
+    ).encode()
+
+
+async def run_mode(mode: str, args) -> dict:
+    stub = IMAPStub()
+    await stub.start()
+    run_id = uuid.uuid4().hex[:8]
+    accounts = [{
+        "id": f"bench-{run_id}-{i}",
+        "user_id": f"bench-user-{run_id}-{i}",
+        "provider": "gmail",
+        "email": f"user{i}-{run_id}@example.com",
+        "access_token": "secret"
+    } for i in range(args.accounts)]
+    await email_accounts_collection.insert_many([dict(account) for account in accounts])
+
+    if mode == "idle":
+        ingestor = IMAPIngestor("127.0.0.1", port=stub.port, use_ssl=False)
+    else:
+        ingestor = PollingIngestor("127.0.0.1", port=stub.port, use_ssl=False, poll_interval=args.poll_interval)
+    for account in accounts:
+        ingestor.watch(account)
+    while not all(account["id"] in ingestor._live for account in accounts):
+        await asyncio.sleep(0.05)
+    baseline = sum(stub.commands.values())
+
+    latencies = []
+    deadline = time.monotonic() + args.duration
+
+    async def mail_arrivals(account):
+        queue = mail_notifier.subscribe(account["user_id"])
+        pending = []
+
+        async def notifications():
+            while True:
+                event = await queue.get()
+                now = time.perf_counter()
+                for delivered in pending[:event["count"]]:
+                    latencies.append(now - delivered)
+                del pending[:event["count"]]
+
+        listener = asyncio.create_task(notifications())
+        sequence = 0
+        try:
+            while True:
+                await asyncio.sleep(random.expovariate(1 / args.mean_arrival))
+                if time.monotonic() >= deadline:
+                    break
+                sequence += 1
+                pending.append(time.perf_counter())
+                stub.deliver(account["email"], make_message(account["email"], sequence))
+            # Let the last deliveries be picked up
+            while pending and time.monotonic() < deadline + args.poll_interval * 2:
+                await asyncio.sleep(0.05)
+        finally:
+            listener.cancel()
+            mail_notifier.unsubscribe(account["user_id"], queue)
+
+    await asyncio.gather(*(mail_arrivals(account) for account in accounts))
+    commands = sum(stub.commands.values()) - baseline
+    await ingestor.stop()
+    await stub.stop()
+
+    account_ids = [account["id"] for account in accounts]
+    stored = await emails_collection.count_documents({"account_id": {"$in": account_ids}})
+    await emails_collection.delete_many({"account_id": {"$in": account_ids}})
+    await email_accounts_collection.delete_many({"id": {"$in": account_ids}})
+    latencies.sort()
+    return {
+        "commands": commands,
+        "bytes": stub.bytes_sent,
+        "messages": stored,
+        "p50": statistics.median(latencies) if latencies else 0.0,
+        "p95": latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0
+    }
+
+
+async def main(args):
+    print(f"{args.accounts} accounts, {args.duration}s, mean arrival {args.mean_arrival}s per account, "
+          f"poll interval {args.poll_interval}s")
+    print(f"{'mode':<8} {'messages':>9} {'commands':>9} {'cmds/msg':>9} {'server KiB':>11} "
+          f"{'notify p50':>11} {'notify p95':>11}")
+    for mode in ("poll", "idle"):
+        result = await run_mode(mode, args)
+        per_message = result["commands"] / max(result["messages"], 1)
+        print(f"{mode:<8} {result['messages']:>9} {result['commands']:>9} {per_message:>9.2f} "
+              f"{result['bytes'] / 1024:>11.1f} {result['p50'] * 1000:>9.1f}ms {result['p95'] * 1000:>9.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--accounts", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--mean-arrival", type=float, default=20.0)
+    parser.add_argument("--poll-interval", type=float, default=5.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,60 @@
+"""Multi-account inbox fan-out benchmark.
+
+Compares the old serial per-account loop (extend + sorted) with the
+concurrent fan-out used by /api/emails/inbox, against MockEmailProvider,
+for 1-50 connected accounts.
+
+Usage: python scripts/bench_inbox_fanout.py [--accounts 1 5 10 25 50]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import server
+
+
+def make_accounts(count: int):
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "provider": "gmail" if i % 2 == 0 else "outlook",
+            "email": f"bench{i}@example.com",
+            "access_token": f"token_{i}"
+        }
+        for i in range(count)
+    ]
+
+
+async def serial_inbox(accounts):
+    all_emails = []
+    for account in accounts:
+        provider_instance = server.get_provider_instance(account["provider"])
+        all_emails.extend(await provider_instance.get_emails(account["access_token"]))
+    return sorted(all_emails, key=lambda x: x['received_at'], reverse=True)
+
+
+async def run(args):
+    print(f"{'accounts':>8} {'serial (s)':>11} {'fan-out (s)':>12} {'speedup':>8}")
+    for count in args.accounts:
+        accounts = make_accounts(count)
+
+        start = time.perf_counter()
+        await serial_inbox(accounts)
+        serial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await server.fetch_inbox_for_accounts(f"bench_{count}", accounts)
+        fanout = time.perf_counter() - start
+
+        print(f"{count:>8} {serial:>11.2f} {fanout:>12.2f} {serial / fanout:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--accounts", type=int, nargs="+", default=[1, 5, 10, 25, 50])
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,137 @@
+"""Scheduled send dispatch jitter benchmark.
+
+Seeds N pending scheduled emails with send times spread over --spread
+seconds, runs --workers ScheduledSendQueue instances against them with a
+no-op send, and reports how late each email was dispatched relative to
+its send_at (p50/p95/p99/max), how many fired more than once, and the
+Mongo commands it took. The same run is repeated with a queue that polls
+Mongo for due items every --poll-interval seconds instead of using the
+timer wheel.
+
+Usage: python scripts/bench_scheduled_send.py [--items 100000] [--spread 60] [--window 30] [--workers 2]
+                                              [--poll-interval 1]
+Requires MONGO_URL to point at a disposable MongoDB instance.
+"""
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import database
+from database import scheduled_emails_collection
+from indexes import ensure_indexes
+from metrics import MONGO_COMMAND_SECONDS
+from scheduled_send import EPOCH, ScheduledSendQueue
+
+
+class PollingQueue(ScheduledSendQueue):
+    """Claims whatever is due every `poll_interval` seconds, without a wheel"""
+
+    def __init__(self, *args, poll_interval: float, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.poll_interval = poll_interval
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._poll_loop())]
+
+    async def _poll_loop(self):
+        while True:
+            due = await scheduled_emails_collection.find(
+                {"status": "scheduled", "send_at": {"$lte": datetime.utcnow()}}, {"_id": 0, "id": 1}
+            ).sort("send_at", 1).to_list()
+            self.enqueue([item["id"] for item in due])
+            await asyncio.sleep(self.poll_interval)
+
+
+def seed(count: int, spread: float, lead: float) -> datetime:
+    database.db.scheduled_emails.delete_many({"user_id": "bench"})
+    start = datetime.utcnow() + timedelta(seconds=lead)
+    batch = []
+    for i in range(count):
+        batch.append({
+            "id": str(uuid.uuid4()), "user_id": "bench", "account_id": "bench",
+            "email": {"to": ["bench@example.com"], "subject": "s", "body": "b"},
+            "send_at": start + timedelta(seconds=spread * i / count),
+            "status": "scheduled", "attempts": 0
+        })
+        if len(batch) == 10000:
+            database.db.scheduled_emails.insert_many(batch)
+            batch = []
+    if batch:
+        database.db.scheduled_emails.insert_many(batch)
+    return start
+
+
+def mongo_commands() -> int:
+    """Commands sent to scheduled_emails so far, counted by the app's command listener"""
+    return sum(
+        MONGO_COMMAND_SECONDS.count(command, "scheduled_emails", "ok")
+        for command in ("find", "getMore", "update", "aggregate")
+    )
+
+
+async def run(mode: str, args) -> dict:
+    start = seed(args.items, args.spread, args.lead)
+    lateness, fired = [], collections.Counter()
+
+    async def send(item):
+        lateness.append(time.time() - (item["send_at"] - EPOCH).total_seconds())
+        fired[item["id"]] += 1
+        return {"id": item["id"]}
+
+    if mode == "wheel":
+        queues = [ScheduledSendQueue(send, concurrency=1000, window=args.window, refill_interval=args.window / 2)
+                  for _ in range(args.workers)]
+    else:
+        queues = [PollingQueue(send, concurrency=1000, poll_interval=args.poll_interval)
+                  for _ in range(args.workers)]
+    commands_before = mongo_commands()
+    for queue in queues:
+        queue.start()
+    deadline = start + timedelta(seconds=args.spread + 5)
+    while len(fired) < args.items and datetime.utcnow() < deadline:
+        await asyncio.sleep(0.2)
+    for queue in queues:
+        await queue.stop()
+
+    lateness.sort()
+
+    def pct(p):
+        return lateness[min(len(lateness) - 1, int(len(lateness) * p))] * 1000 if lateness else float("nan")
+
+    return {
+        "fired": len(fired),
+        "duplicates": sum(count - 1 for count in fired.values()),
+        "p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99), "max": lateness[-1] * 1000 if lateness else float("nan"),
+        "commands": mongo_commands() - commands_before
+    }
+
+
+async def main(args):
+    ensure_indexes()
+    print(f"{args.items} scheduled emails over {args.spread}s, {args.workers} workers, "
+          f"window {args.window}s, poll interval {args.poll_interval}s")
+    print(f"{'mode':<6} {'fired':>7} {'dupes':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'mongo cmds':>11}")
+    for mode in ("poll", "wheel"):
+        result = await run(mode, args)
+        print(f"{mode:<6} {result['fired']:>7} {result['duplicates']:>6} {result['p50']:>8.1f} {result['p95']:>8.1f} "
+              f"{result['p99']:>8.1f} {result['max']:>8.1f} {result['commands']:>11}")
+    database.db.scheduled_emails.delete_many({"user_id": "bench"})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=100000)
+    parser.add_argument("--spread", type=float, default=60.0)
+    parser.add_argument("--window", type=float, default=30.0)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--lead", type=float, default=3.0, help="seconds between seeding and the first send_at")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,103 @@
+"""Email search latency benchmark.
+
+Seeds N synthetic messages (mock-provider senders, subjects and labels
+with varied bodies) for a throwaway user, ensures the search indexes, then
+runs term, phrase, prefix and filtered queries through search_emails and
+reports p50/p95 latency per query kind.
+
+Usage: python scripts/bench_search.py [--messages 1000000] [--runs 50]
+Requires MONGO_URL to point at a disposable MongoDB instance.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import database
+from indexes import ensure_indexes
+from search import search_emails, search_tokens
+
+SENDERS = [
+    "john.doe@example.com", "jane.smith@startup.com", "info@techcompany.com",
+    "support@saasplatform.com", "newsletter@businessnews.com"
+]
+SUBJECTS = [
+    "Project Update - Q1 Results", "New Feature Release", "Meeting Invitation",
+    "Invoice #12345", "Welcome to our platform", "Weekly Newsletter",
+    "Partnership Opportunity", "Customer Feedback", "Security Update"
+]
+LABELS = ["Work", "Personal", "Important", "Follow-up"]
+VOCABULARY = (
+    "investor roadmap pricing hiring launch churn revenue runway onboarding integration "
+    "contract renewal feedback security audit deadline budget forecast pipeline demo"
+).split()
+
+QUERIES = {
+    "term": dict(q="invoice"),
+    "multi-term": dict(q="security audit"),
+    "phrase": dict(q='"Q1 Results"'),
+    "prefix": dict(q="invest*"),
+    "label+date": dict(q="roadmap", labels=["Work"], date_from=datetime.utcnow() - timedelta(days=30)),
+}
+
+
+def seed(user_id: str, count: int, batch: int = 5000):
+    now = datetime.utcnow()
+    for start in range(0, count, batch):
+        documents = []
+        for i in range(start, min(start + batch, count)):
+            document = {
+                "id": str(uuid.uuid4()),
+                "user_id": user_id,
+                "from": random.choice(SENDERS),
+                "subject": random.choice(SUBJECTS),
+                "body": " ".join(random.choices(VOCABULARY, k=40)),
+                "received_at": now - timedelta(minutes=i),
+                "is_read": random.random() < 0.5,
+                "labels": random.sample(LABELS, k=random.randint(0, 2)),
+                "folder": "inbox"
+            }
+            document["search_tokens"] = search_tokens(document)
+            documents.append(document)
+        database.db.emails.insert_many(documents, ordered=False)
+
+
+async def measure(user_id: str, runs: int):
+    print(f"{'query':<12} {'p50 (ms)':>9} {'p95 (ms)':>9} {'hits/page':>10}")
+    for name, params in QUERIES.items():
+        timings = []
+        hits = 0
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = await search_emails(user_id, **params)
+            timings.append((time.perf_counter() - start) * 1000)
+            hits = len(result["results"])
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        print(f"{name:<12} {statistics.median(timings):>9.1f} {p95:>9.1f} {hits:>10}")
+
+
+def main(args):
+    user_id = f"bench_{uuid.uuid4()}"
+    start = time.perf_counter()
+    seed(user_id, args.messages)
+    print(f"seeded {args.messages} messages in {time.perf_counter() - start:.1f}s")
+    ensure_indexes()
+    try:
+        asyncio.run(measure(user_id, args.runs))
+    finally:
+        database.db.emails.delete_many({"user_id": user_id})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--runs", type=int, default=50)
+    main(parser.parse_args())
@@ -0,0 +1,128 @@
+"""SMTP delivery throughput benchmark.
+
+Starts a local aiosmtpd stand-in behind a TCP proxy that adds a simulated
+network round-trip time, then delivers N messages over one connection with:
+
+- connect-per-message: a fresh aiosmtplib session per message (baseline)
+- pooled: SMTPEmailProvider reusing one connection, lock-step commands
+- pooled+pipelined: as above with the server advertising PIPELINING
+
+and reports messages per second per connection.
+
+Usage: python scripts/bench_smtp.py [--messages 500] [--rtt-ms 10]
+Requires aiosmtpd (pip install -r backend/requirements-dev.txt); no MongoDB access is made.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import aiosmtplib
+from aiosmtpd.controller import Controller
+
+from smtp_provider import SMTPConnectionPool, SMTPEmailProvider
+
+
+class CountingHandler:
+    def __init__(self, pipelining: bool):
+        self.pipelining = pipelining
+        self.received = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        session.host_name = hostname
+        if self.pipelining:
+            responses.insert(-1, "250-PIPELINING")
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return "250 OK"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_proxy(upstream_port: int, rtt: float) -> asyncio.AbstractServer:
+    """Forward bytes to the SMTP server, delaying each direction by half the RTT"""
+    loop = asyncio.get_running_loop()
+
+    async def pipe(reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                loop.call_later(rtt / 2, writer.write, data)
+        finally:
+            loop.call_later(rtt / 2, writer.close)
+
+    async def handle(client_reader, client_writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", upstream_port)
+        await asyncio.gather(pipe(client_reader, upstream_writer), pipe(upstream_reader, client_writer))
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+def make_message(i: int):
+    return {
+        "to": [f"recipient{i}@example.com"],
+        "cc": [],
+        "bcc": [],
+        "subject": f"Benchmark message {i}",
+        "body": "<p>Hello from the SMTP throughput benchmark.</p>" * 20,
+        "is_html": True
+    }
+
+
+async def run_mode(mode: str, messages: int, rtt: float) -> float:
+    handler = CountingHandler(pipelining=mode == "pooled+pipelined")
+    controller = Controller(handler, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    proxy = await start_proxy(controller.port, rtt)
+    port = proxy.sockets[0].getsockname()[1]
+    batch = [make_message(i) for i in range(messages)]
+    try:
+        start = time.perf_counter()
+        if mode == "connect-per-message":
+            for email_data in batch:
+                await aiosmtplib.send(
+                    f"Subject: {email_data['subject']}\r\n\r\n{email_data['body']}",
+                    sender="bench@startupmail.local", recipients=email_data["to"],
+                    hostname="127.0.0.1", port=port, start_tls=False
+                )
+        else:
+            pool = SMTPConnectionPool("127.0.0.1", port=port, username=None, use_tls=False, start_tls=False, size=1)
+            provider = SMTPEmailProvider(pool, sender="bench@startupmail.local")
+            try:
+                for email_data in batch:
+                    await provider.send_email("smtp", email_data)
+            finally:
+                await provider.aclose()
+        elapsed = time.perf_counter() - start
+    finally:
+        proxy.close()
+        controller.stop()
+    assert handler.received == messages, (handler.received, messages)
+    return messages / elapsed
+
+
+async def main(args):
+    print(f"{args.messages} messages, simulated RTT {args.rtt_ms} ms, one connection")
+    print(f"{'mode':<22} {'msg/s/connection':>17}")
+    for mode in ("connect-per-message", "pooled", "pooled+pipelined"):
+        rate = await run_mode(mode, args.messages, args.rtt_ms / 1000)
+        print(f"{mode:<22} {rate:>17.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--rtt-ms", type=float, default=10.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,135 @@
+"""Streaming list response benchmark.
+
+Seeds N drafts for a throwaway user, then for each response mode starts
+the app under uvicorn in a fresh subprocess and measures time-to-first-byte,
+total time and the growth in peak RSS while serving every draft. The modes are the chunked
+JSON stream, NDJSON, and a buffered baseline route that materialises the
+whole list through FastAPI's default encoder, as the endpoint did before
+pagination.
+
+Usage: python scripts/bench_streaming.py [--documents 50000]
+Requires MONGO_URL to point at a disposable MongoDB instance.
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+# mode -> (path, query params, extra headers)
+MODES = {
+    "buffered": ("/bench/drafts-buffered", {}, {}),
+    "json-stream": ("/api/emails/drafts", {"stream": "true"}, {}),
+    "ndjson": ("/api/emails/drafts", {}, {"Accept": "application/x-ndjson"}),
+}
+
+
+def seed(document_count: int) -> str:
+    import database
+    user_id = f"bench_{uuid.uuid4()}"
+    token = f"bench_token_{uuid.uuid4()}"
+    now = datetime.utcnow()
+    database.db.users.insert_one({"id": user_id, "email": f"{user_id}@bench.local", "name": "Bench", "created_at": now})
+    database.db.sessions.insert_one({
+        "session_token": token, "user_id": user_id, "created_at": now, "expires_at": now + timedelta(hours=1)
+    })
+    for start in range(0, document_count, 5000):
+        database.db.drafts.insert_many([
+            {
+                "id": str(uuid.uuid4()), "user_id": user_id, "to": ["someone@example.com"], "cc": [], "bcc": [],
+                "subject": f"Draft {i}", "body": "Lorem ipsum dolor sit amet " * 40, "is_html": False,
+                "created_at": now, "updated_at": now - timedelta(seconds=i)
+            }
+            for i in range(start, min(start + 5000, document_count))
+        ])
+    return token
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child(mode: str, token: str):
+    """Serve the app in-process and fetch the full draft list once in `mode`"""
+    import httpx
+    import uvicorn
+    from fastapi import Depends
+    from server import app, drafts_collection, get_current_user
+
+    @app.get("/bench/drafts-buffered")
+    async def drafts_buffered(current_user: dict = Depends(get_current_user)):
+        drafts = await drafts_collection.find(
+            {"user_id": current_user["id"]}, {"_id": 0, "body": 0}
+        ).sort("updated_at", -1).to_list()
+        return {"drafts": drafts}
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    path, params, headers = MODES[mode]
+    headers = {"Authorization": f"Bearer {token}", **headers}
+    baseline = peak_rss_mb()
+
+    start = time.perf_counter()
+    first_byte = None
+    received = 0
+    with httpx.stream("GET", f"http://127.0.0.1:{port}{path}", params=params,
+                      headers=headers, timeout=None) as response:
+        for chunk in response.iter_raw():
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            received += len(chunk)
+    total = time.perf_counter() - start
+
+    server.should_exit = True
+    thread.join()
+    print(json.dumps({
+        "mode": mode, "ttfb_ms": round(first_byte * 1000, 1), "total_s": round(total, 2),
+        "bytes": received, "peak_rss_growth_mb": round(peak_rss_mb() - baseline, 1)
+    }))
+
+
+def main(args):
+    token = seed(args.documents)
+    print(f"{args.documents} drafts")
+    print(f"{'mode':<12} {'TTFB (ms)':>10} {'total (s)':>10} {'MB sent':>8} {'peak RSS +MB':>13}")
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, __file__, "--child", mode, "--token", token],
+            check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{mode:<12} {result['ttfb_ms']:>10.1f} {result['total_s']:>10.2f} "
+              f"{result['bytes'] / 1e6:>8.1f} {result['peak_rss_growth_mb']:>13.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=50000)
+    parser.add_argument("--child", choices=list(MODES), help=argparse.SUPPRESS)
+    parser.add_argument("--token", help=argparse.SUPPRESS)
+    parser.add_argument("--seed", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child, seed(args.documents) if args.seed else args.token)
+    else:
+        main(args)
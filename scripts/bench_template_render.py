@@ -0,0 +1,91 @@
+"""Template rendering microbenchmark.
+
+Renders the predefined startup templates for N recipients with the
+compiled engine, str.format_map and a per-call regex substitution, and
+reports the time per 1000 renders.
+
+Usage: python scripts/bench_template_render.py [--recipients 10000]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+from templates import PLACEHOLDER_RE, STARTUP_TEMPLATES, compile_template
+
+
+class _KeepMissing(dict):
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+
+def naive_format(template, variables):
+    return (
+        template["subject"].format_map(_KeepMissing(variables)),
+        template["body"].format_map(_KeepMissing(variables))
+    )
+
+
+def naive_regex(template, variables):
+    def substitute(match):
+        return str(variables.get(match.group(1), match.group(0)))
+    return (
+        re.sub(PLACEHOLDER_RE.pattern, substitute, template["subject"]),
+        re.sub(PLACEHOLDER_RE.pattern, substitute, template["body"])
+    )
+
+
+def make_variables(count):
+    return [
+        {
+            "company_name": "StartupMail",
+            "product_name": "Inbox Zero",
+            "investor_name": f"Investor {i}",
+            "customer_name": f"Customer {i}",
+            "partner_name": f"Partner {i}"
+        }
+        for i in range(count)
+    ]
+
+
+def timed(label, fn, count):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {elapsed:8.3f} s  {elapsed / count * 1e6:8.2f} us/render")
+    return elapsed
+
+
+def run(args):
+    recipients = make_variables(args.recipients)
+    renders = args.recipients * len(STARTUP_TEMPLATES)
+
+    def compiled():
+        for template in STARTUP_TEMPLATES:
+            for _ in compile_template(template).render_batch(recipients):
+                pass
+
+    def formatted():
+        for template in STARTUP_TEMPLATES:
+            for variables in recipients:
+                naive_format(template, variables)
+
+    def regexed():
+        for template in STARTUP_TEMPLATES:
+            for variables in recipients:
+                naive_regex(template, variables)
+
+    print(f"{renders} renders ({args.recipients} recipients x {len(STARTUP_TEMPLATES)} templates)")
+    base = timed("compiled", compiled, renders)
+    for label, fn in (("str.format_map", formatted), ("re.sub", regexed)):
+        elapsed = timed(label, fn, renders)
+        print(f"{'':<22} compiled is {elapsed / base:.1f}x faster")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recipients", type=int, default=10000)
+    run(parser.parse_args())
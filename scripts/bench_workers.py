@@ -0,0 +1,153 @@
+"""Multi-worker throughput scaling benchmark.
+
+Seeds a user and session, then for each worker count starts the API under
+gunicorn with backend/gunicorn.conf.py and drives GET /api/user/profile
+from --clients load generator processes for --duration seconds, each
+holding --connections keep-alive connections. Reports requests/s, p50/p99
+latency and the speedup and per-worker efficiency against the first
+(smallest) worker count. The load generator runs on the same machine, so
+leave it cores: with N cores, measure up to about N/2 workers.
+
+Usage: python scripts/bench_workers.py [--workers 1,2,4] [--duration 10] [--clients 2] [--connections 32]
+Requires MONGO_URL to point at a disposable MongoDB instance, and gunicorn.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import httpx
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+sys.path.insert(0, BACKEND)
+
+import database
+
+USER_ID = "bench-workers"
+SESSION_TOKEN = "bench-workers-session"
+
+
+def seed():
+    database.db.users.delete_many({"id": USER_ID})
+    database.db.sessions.delete_many({"session_token": SESSION_TOKEN})
+    database.db.users.insert_one({
+        "id": USER_ID, "email": f"{USER_ID}@bench.local", "name": "Bench", "created_at": datetime.utcnow()
+    })
+    database.db.sessions.insert_one({
+        "session_token": SESSION_TOKEN, "user_id": USER_ID,
+        "created_at": datetime.utcnow(), "expires_at": datetime.utcnow() + timedelta(days=1)
+    })
+
+
+def start_server(workers: int, port: int) -> subprocess.Popen:
+    env = dict(
+        os.environ, WEB_CONCURRENCY=str(workers), BIND=f"127.0.0.1:{port}",
+        CAMPAIGN_WORKER_ENABLED="false", SCHEDULED_SEND_ENABLED="false"
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "server:app"],
+        cwd=BACKEND, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 60
+    # Wait until every worker has booted and answers
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/api/health").status_code == 200:
+                time.sleep(1 + workers * 0.5)
+                return server
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"gunicorn with {workers} workers did not start")
+
+
+async def connection_loop(port: int, until: float, latencies: list):
+    """Sequential keep-alive requests on one connection; a bare client keeps the generator cheap"""
+    request = (
+        f"GET /api/user/profile HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+        f"Authorization: Bearer {SESSION_TOKEN}\r\n\r\n"
+    ).encode()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        while time.monotonic() < until:
+            started = time.perf_counter()
+            writer.write(request)
+            head = await reader.readuntil(b"\r\n\r\n")
+            if not head.startswith(b"HTTP/1.1 200"):
+                raise RuntimeError(head.split(b"\r\n", 1)[0].decode())
+            length = 0
+            for line in head.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":", 1)[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+    finally:
+        writer.close()
+
+
+def client_process(port: int, connections: int, start_at: float, duration: float, results):
+    async def main():
+        await asyncio.sleep(max(0.0, start_at - time.time()))
+        latencies = []
+        until = time.monotonic() + duration
+        await asyncio.gather(*(connection_loop(port, until, latencies) for _ in range(connections)))
+        return latencies
+    results.put(asyncio.run(main()))
+
+
+def measure(port: int, args) -> dict:
+    results = multiprocessing.Queue()
+    start_at = time.time() + 1
+    clients = [
+        multiprocessing.Process(target=client_process, args=(port, args.connections, start_at, args.duration, results))
+        for _ in range(args.clients)
+    ]
+    for client in clients:
+        client.start()
+    latencies = sorted(latency for _ in clients for latency in results.get())
+    for client in clients:
+        client.join()
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {"rps": len(latencies) / args.duration, "p50": pct(0.50), "p99": pct(0.99)}
+
+
+def main(args):
+    seed()
+    counts = [int(count) for count in args.workers.split(",")]
+    print(f"GET /api/user/profile, {args.clients} client processes x {args.connections} connections, "
+          f"{args.duration}s per run, {os.cpu_count()} cores")
+    print(f"{'workers':>7} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'speedup':>8} {'efficiency':>10}")
+    baseline = None
+    for count in counts:
+        server = start_server(count, args.port)
+        try:
+            result = measure(args.port, args)
+        finally:
+            server.terminate()
+            server.wait()
+        if baseline is None:
+            baseline = (count, result["rps"])
+        speedup = result["rps"] / baseline[1]
+        efficiency = speedup * baseline[0] / count
+        print(f"{count:>7} {result['rps']:>9,.0f} {result['p50']:>8.2f} {result['p99']:>8.2f} "
+              f"{speedup:>7.2f}x {efficiency:>9.0%}")
+    database.db.users.delete_many({"id": USER_ID})
+    database.db.sessions.delete_many({"session_token": SESSION_TOKEN})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--clients", type=int, default=2, help="load generator processes")
+    parser.add_argument("--connections", type=int, default=32, help="keep-alive connections per client process")
+    parser.add_argument("--port", type=int, default=8011)
+    main(parser.parse_args())
@@ -0,0 +1,208 @@
+"""Minimal in-process IMAP4rev1 server for exercising the IMAP ingestion worker.
+
+Supports just what the worker and a polling client use: CAPABILITY, LOGIN
+(any credentials; the username picks the mailbox), SELECT, UID FETCH with
+header-field and full or partial body sections, IDLE/DONE, NOOP and LOGOUT. Every
+command received is counted per verb so callers can compare provider
+traffic between strategies.
+
+Usage (from another script):
+    stub = IMAPStub(); await stub.start(); stub.deliver("alice@example.com", raw_bytes)
+"""
+import asyncio
+import collections
+import re
+from datetime import datetime, timezone
+from email.parser import BytesHeaderParser
+from typing import Dict, List, Optional, Set
+
+FETCH_SECTION_RE = re.compile(r"BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?", re.IGNORECASE)
+
+
+class StubMessage:
+    def __init__(self, uid: int, raw: bytes, flags=()):
+        self.uid = uid
+        self.raw = raw
+        self.flags = list(flags)
+        self.internal_date = datetime.now(timezone.utc)
+
+    def header_fields(self, names: List[str]) -> bytes:
+        headers = BytesHeaderParser().parsebytes(self.raw)
+        wanted = {name.lower() for name in names}
+        lines = [f"{name}: {value}" for name, value in headers.items() if name.lower() in wanted]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+class Mailbox:
+    def __init__(self, uidvalidity: int):
+        self.uidvalidity = uidvalidity
+        self.messages: List[StubMessage] = []
+        self.next_uid = 1
+        self.idlers: Set["IMAPStubSession"] = set()
+
+
+def _uid_set(spec: str, max_uid: int):
+    """Predicate over UIDs for an IMAP sequence set such as `5:*` or `1,3:4`"""
+    ranges = []
+    for part in spec.split(","):
+        low, _, high = part.partition(":")
+        low_value = max_uid if low == "*" else int(low)
+        high_value = low_value if not high else (max_uid if high == "*" else int(high))
+        ranges.append((min(low_value, high_value), max(low_value, high_value)))
+    return lambda uid: any(low <= uid <= high for low, high in ranges)
+
+
+class IMAPStubSession:
+    def __init__(self, stub: "IMAPStub", reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stub = stub
+        self.reader = reader
+        self.writer = writer
+        self.mailbox: Optional[Mailbox] = None
+        self.username: Optional[str] = None
+        self.idle_tag: Optional[str] = None
+        self.reported_exists = 0
+
+    def report_exists(self):
+        """Announce mail delivered since this session last saw the mailbox, as servers do at command boundaries"""
+        if self.mailbox is not None and len(self.mailbox.messages) > self.reported_exists:
+            self.reported_exists = len(self.mailbox.messages)
+            self.send(f"* {self.reported_exists} EXISTS")
+
+    def send(self, line: str, literal: Optional[bytes] = None):
+        data = line.encode() + b"\r\n"
+        self.stub.bytes_sent += len(data) + (len(literal) if literal else 0)
+        self.writer.write(data)
+        if literal:
+            self.writer.write(literal)
+
+    async def run(self):
+        self.send("* OK [CAPABILITY IMAP4rev1 IDLE UIDPLUS] IMAP stub ready")
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                line = line.decode().rstrip("\r\n")
+                if self.idle_tag is not None:
+                    if line.upper() == "DONE":
+                        self.stub.commands["DONE"] += 1
+                        self.mailbox.idlers.discard(self)
+                        self.send(f"{self.idle_tag} OK IDLE terminated")
+                        self.idle_tag = None
+                    continue
+                tag, _, rest = line.partition(" ")
+                verb, _, args = rest.partition(" ")
+                verb = verb.upper()
+                if verb == "UID":
+                    sub, _, args = args.partition(" ")
+                    verb = f"UID {sub.upper()}"
+                self.stub.commands[verb] += 1
+                if not await self.handle(tag, verb, args):
+                    break
+                await self.writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if self.mailbox is not None:
+                self.mailbox.idlers.discard(self)
+            self.writer.close()
+
+    async def handle(self, tag: str, verb: str, args: str) -> bool:
+        if verb == "CAPABILITY":
+            self.send("* CAPABILITY IMAP4rev1 IDLE UIDPLUS")
+            self.send(f"{tag} OK CAPABILITY completed")
+        elif verb == "LOGIN":
+            self.username = args.split(" ")[0].strip('"')
+            self.send(f"{tag} OK LOGIN completed")
+        elif verb in ("SELECT", "EXAMINE"):
+            self.mailbox = self.stub.mailbox(self.username)
+            self.send("* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)")
+            self.reported_exists = len(self.mailbox.messages)
+            self.send(f"* {self.reported_exists} EXISTS")
+            self.send("* 0 RECENT")
+            self.send(f"* OK [UIDVALIDITY {self.mailbox.uidvalidity}] UIDs valid")
+            self.send(f"* OK [UIDNEXT {self.mailbox.next_uid}] Predicted next UID")
+            self.send(f"{tag} OK [READ-WRITE] {verb} completed")
+        elif verb == "UID FETCH":
+            self.fetch(tag, args)
+        elif verb == "IDLE":
+            self.idle_tag = tag
+            self.mailbox.idlers.add(self)
+            self.send("+ idling")
+            self.report_exists()
+        elif verb == "NOOP":
+            self.report_exists()
+            self.send(f"{tag} OK NOOP completed")
+        elif verb == "LOGOUT":
+            self.send("* BYE logging out")
+            self.send(f"{tag} OK LOGOUT completed")
+            return False
+        else:
+            self.send(f"{tag} BAD unsupported command")
+        return True
+
+    def fetch(self, tag: str, args: str):
+        spec, _, items = args.partition(" ")
+        max_uid = self.mailbox.next_uid - 1
+        matches = _uid_set(spec, max_uid)
+        sections = FETCH_SECTION_RE.findall(items)
+        for seq, message in enumerate(self.mailbox.messages, start=1):
+            if not matches(message.uid):
+                continue
+            date = message.internal_date.strftime("%d-%b-%Y %H:%M:%S %z")
+            attributes = (
+                f"UID {message.uid} FLAGS ({' '.join(message.flags)}) "
+                f"INTERNALDATE \"{date}\" RFC822.SIZE {len(message.raw)}"
+            )
+            for section, offset, length in sections:
+                if section.upper().startswith("HEADER.FIELDS"):
+                    names = section[section.index("(") + 1:section.rindex(")")].split()
+                    literal = message.header_fields(names)
+                else:
+                    literal = message.raw
+                origin = ""
+                if offset:
+                    literal = literal[int(offset):int(offset) + int(length)]
+                    origin = f"<{offset}>"
+                self.send(f"* {seq} FETCH ({attributes} BODY[{section}]{origin} {{{len(literal)}}}", literal)
+                attributes = ""
+                self.send(")")
+            if not sections:
+                self.send(f"* {seq} FETCH ({attributes})")
+        self.report_exists()
+        self.send(f"{tag} OK UID FETCH completed")
+
+
+class IMAPStub:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.commands: Dict[str, int] = collections.Counter()
+        self.bytes_sent = 0
+        self._mailboxes: Dict[str, Mailbox] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._accept, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+
+    async def _accept(self, reader, writer):
+        await IMAPStubSession(self, reader, writer).run()
+
+    def mailbox(self, username: str) -> Mailbox:
+        if username not in self._mailboxes:
+            self._mailboxes[username] = Mailbox(uidvalidity=len(self._mailboxes) + 1)
+        return self._mailboxes[username]
+
+    def deliver(self, username: str, raw: bytes, flags=()) -> int:
+        """Append a message and notify sessions idling on the mailbox; returns its UID"""
+        mailbox = self.mailbox(username)
+        message = StubMessage(mailbox.next_uid, raw, flags)
+        mailbox.next_uid += 1
+        mailbox.messages.append(message)
+        for session in list(mailbox.idlers):
+            session.report_exists()
+        return message.uid
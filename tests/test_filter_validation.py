@@ -0,0 +1,56 @@
+"""Validation tests for filter rules.
+
+Builds the EmailFilter request model from malformed conditions and verifies
+each is rejected with a pydantic ValidationError (a 422 from POST and PUT
+/api/filters) rather than another exception (a 500), and that valid
+filters still compile.
+"""
+import pytest
+from pydantic import ValidationError
+
+from filters import FILTER_PATTERN_MAX_LENGTH, RuleSet
+from server import EmailFilter
+
+ACTIONS = {"add_labels": ["checked"]}
+
+INVALID_CONDITIONS = {
+    "non-string subject_contains": {"subject_contains": 123},
+    "non-string body_contains": {"body_contains": ["invoice"]},
+    "non-string subject_matches": {"subject_matches": 5},
+    "non-string body_matches": {"body_matches": None},
+    "empty subject_contains": {"subject_contains": ""},
+    "empty body_contains": {"body_contains": ""},
+    "empty subject_matches": {"subject_matches": ""},
+    "invalid regex": {"body_matches": "(unclosed"},
+    "overlong regex": {"subject_matches": "a" * (FILTER_PATTERN_MAX_LENGTH + 1)},
+    "empty sender": {"from": ""},
+    "unknown key": {"subject_startswith": "re:"},
+}
+
+
+@pytest.mark.parametrize("conditions", INVALID_CONDITIONS.values(), ids=INVALID_CONDITIONS.keys())
+def test_invalid_conditions_are_rejected(conditions):
+    with pytest.raises(ValidationError):
+        EmailFilter(name="invalid", conditions=conditions, actions=ACTIONS)
+
+
+def test_valid_filter_compiles_and_matches():
+    conditions = {"subject_contains": "invoice", "body_matches": r"due \d+ days", "from_domain": "vendor.com"}
+    EmailFilter(name="valid", conditions=conditions, actions=ACTIONS)
+    rule_set = RuleSet([{"conditions": conditions, "actions": ACTIONS}])
+    assert rule_set.match({"from": "billing@vendor.com", "subject": "Invoice 7", "body": "Due 30 days"})
+    assert not rule_set.match({"from": "billing@vendor.com", "subject": "Hello", "body": "Due 30 days"})
+
+
+def test_pattern_at_length_limit_is_accepted():
+    EmailFilter(name="long", conditions={"subject_matches": "a" * FILTER_PATTERN_MAX_LENGTH}, actions=ACTIONS)
+
+
+def test_stored_invalid_filter_is_skipped():
+    # A filter saved before validation tightened must not take the whole rule set down
+    rule_set = RuleSet([
+        {"id": "old", "conditions": {"subject_contains": ""}, "actions": ACTIONS},
+        {"id": "new", "conditions": {"subject_contains": "invoice"}, "actions": ACTIONS},
+    ])
+    assert [rule.filter_id for rule in rule_set.rules] == ["new"]
+    assert not rule_set.match({"from": "a@b.com", "subject": "Hello", "body": ""})
@@ -0,0 +1,61 @@
+"""Concurrency tests for inbox account attribution.
+
+Runs many concurrent live inbox fetches for pairs of accounts that share
+one MockEmailProvider and verifies every returned message carries the
+account it was fetched for, and that the provider's shared records were
+not modified.
+"""
+import asyncio
+from dataclasses import asdict
+
+import server
+
+ROUNDS = 50
+
+
+def account(index: int, provider: str):
+    return {
+        "id": f"{provider}-account-{index}",
+        "provider": provider,
+        "email": f"user{index}@{provider}.example.com",
+        "access_token": f"token-{index}"
+    }
+
+
+async def fetch_and_check(user_id: str, accounts):
+    emails, failed_accounts = await server.fetch_inbox_for_accounts(user_id, accounts)
+    assert not failed_accounts, failed_accounts
+    by_id = {acc["id"]: acc for acc in accounts}
+    for email in emails:
+        data = email.to_dict()
+        owner = by_id[data["account_id"]]
+        assert data["account_email"] == owner["email"], f"{data['account_email']} != {owner['email']}"
+        assert data["provider"] == owner["provider"]
+    counts = {acc["id"]: 0 for acc in accounts}
+    for email in emails:
+        counts[email.account_id] += 1
+    return counts
+
+
+async def fetch_concurrently(rounds: int):
+    tasks = []
+    for round_number in range(rounds):
+        accounts = [account(round_number * 2, "gmail"), account(round_number * 2 + 1, "gmail")]
+        tasks.append(fetch_and_check(f"user-{round_number}", accounts))
+    return await asyncio.gather(*tasks)
+
+
+def test_concurrent_fetches_keep_account_attribution():
+    snapshot = list(server.gmail_provider.mock_emails)
+    results = asyncio.run(fetch_concurrently(ROUNDS))
+    assert len(results) == ROUNDS
+    for counts in results:
+        assert all(count == len(snapshot) for count in counts.values()), counts
+
+
+def test_concurrent_fetches_leave_provider_records_untouched():
+    snapshot = list(server.gmail_provider.mock_emails)
+    records = [asdict(record) for record in snapshot]
+    asyncio.run(fetch_concurrently(ROUNDS))
+    assert server.gmail_provider.mock_emails == snapshot
+    assert [asdict(record) for record in server.gmail_provider.mock_emails] == records
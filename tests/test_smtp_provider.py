@@ -0,0 +1,111 @@
+"""Tests for SMTP message assembly and delivery.
+
+Messages are built by MimeBuilder and parsed back with the standard
+library, and delivered to a local aiosmtpd server, to check that non-ASCII
+headers are encoded rather than failing the send.
+"""
+import asyncio
+import email
+import socket
+from email import policy
+
+import pytest
+from aiosmtpd.controller import Controller
+
+import smtp_provider
+from smtp_provider import MimeBuilder, SMTPConnectionPool, SMTPEmailProvider
+from templates import STARTUP_TEMPLATES_BY_ID, compile_template
+
+SUBJECTS = ["Café update", "🚀 Introducing X - Now Live!", "Plain ASCII subject"]
+SENDER_NAME = "Zoë from Café Crème"
+ATTACHMENT = b"%PDF-1.4 " + bytes(range(256)) * 40
+
+
+def build(subject: str, **extra):
+    email_data = {"to": ["x@example.com"], "cc": [], "subject": subject, "body": "<p>Héllo</p>", "is_html": True}
+    email_data.update(extra)
+    return asyncio.run(MimeBuilder().build("sender@example.com", SENDER_NAME, email_data))
+
+
+def parse(raw: bytes):
+    return email.message_from_bytes(raw, policy=policy.default)
+
+
+@pytest.fixture
+def stored_attachment(monkeypatch):
+    async def get_blob(sha256):
+        return {"sha256": sha256, "size": len(ATTACHMENT), "location": "memory"}
+
+    async def stream_blob(blob, start, end):
+        for offset in range(start, end + 1, 1000):
+            yield ATTACHMENT[offset:min(offset + 1000, end + 1)]
+
+    monkeypatch.setattr(smtp_provider, "get_blob", get_blob)
+    monkeypatch.setattr(smtp_provider, "stream_blob", stream_blob)
+    return {"sha256": "digest", "filename": "résumé.pdf", "content_type": "application/pdf"}
+
+
+@pytest.mark.parametrize("subject", SUBJECTS)
+def test_non_ascii_headers_are_encoded(subject):
+    raw, message_id = build(subject)
+    raw.decode("ascii")
+    message = parse(raw)
+    assert message["Subject"] == subject
+    assert message["From"].addresses[0].display_name == SENDER_NAME
+    assert message["Message-ID"] == message_id
+    assert message.get_content() == "<p>Héllo</p>"
+
+
+@pytest.mark.parametrize("subject", SUBJECTS)
+def test_non_ascii_headers_with_attachments(subject, stored_attachment):
+    raw, _ = build(subject, attachments=[stored_attachment])
+    raw.decode("ascii")
+    message = parse(raw)
+    assert message["Subject"] == subject
+    assert message["From"].addresses[0].display_name == SENDER_NAME
+    attachment = next(message.iter_attachments())
+    assert attachment.get_filename() == "résumé.pdf"
+    assert attachment.get_content() == ATTACHMENT
+
+
+def test_product_launch_template_subject():
+    subject, _ = compile_template(STARTUP_TEMPLATES_BY_ID["product_launch"]).render({"product_name": "Mail"})
+    raw, _ = build(subject)
+    assert parse(raw)["Subject"] == "🚀 Introducing Mail - Now Live!"
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope.content)
+        return "250 OK"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_send_email_with_non_ascii_subject():
+    handler = RecordingHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=free_port())
+    controller.start()
+
+    async def send():
+        pool = SMTPConnectionPool("127.0.0.1", port=controller.port, username=None, use_tls=False, start_tls=False)
+        provider = SMTPEmailProvider(pool, sender="sender@example.com", sender_name=SENDER_NAME)
+        try:
+            return await provider.send_email("smtp", {"to": ["x@example.com"], "subject": SUBJECTS[1], "body": "Hi"})
+        finally:
+            await provider.aclose()
+
+    try:
+        result = asyncio.run(send())
+    finally:
+        controller.stop()
+    assert result["status"] == "sent"
+    assert len(handler.messages) == 1
+    assert parse(handler.messages[0])["Subject"] == SUBJECTS[1]